@@ -1,4 +1,5 @@
 import datetime
+import pcmcapture
 from os.path import join
 from kivy.app import App
 from kivy.utils import platform
@@ -82,11 +83,10 @@ class AndroidPermissions:
 
 from jnius import autoclass
 # imporing Android API's using pyjnius's autoclass method
-# docs: https://developer.android.com/reference/android/media/MediaRecorder
-MediaRecorder = autoclass('android.media.MediaRecorder')
+# docs: https://developer.android.com/reference/android/media/AudioRecord
+AudioRecord = autoclass('android.media.AudioRecord')
+AudioFormat = autoclass('android.media.AudioFormat')
 AudioSource = autoclass('android.media.MediaRecorder$AudioSource')
-OutputFormat = autoclass('android.media.MediaRecorder$OutputFormat')
-AudioEncoder = autoclass('android.media.MediaRecorder$AudioEncoder') 
 
 
 class AndroidMediaRecorder(App):
@@ -121,31 +121,36 @@ class AndroidMediaRecorder(App):
         ''' 
         This function was created seprately beacuse; as start() method handels GUI it was hindering creation of object 
         resulting in exceptions and erros.
-        The record_audio method creates a MediaRecorder object and sets the audio source,
-        output format, and encoder. The MediaRecorder object is then prepared and started.
+        The record_audio method creates an AudioRecord reading raw 16 bit PCM from the microphone at 44.1 kHz
+        (the same format the desktop app records) and starts a PCMCapture thread that streams it into a WAV file.
         '''
-        self.recorder = MediaRecorder()
-        self.recorder.setAudioSource(AudioSource.MIC)
-        self.recorder.setOutputFormat(OutputFormat.THREE_GPP)
-        self.recorder.setOutputFile(self.file_name)
-        self.recorder.setAudioEncoder(AudioEncoder.AMR_NB)
-        self.recorder.prepare()
-        self.recorder.start()
+        min_buffer = AudioRecord.getMinBufferSize(pcmcapture.RATE,
+                                                  AudioFormat.CHANNEL_IN_MONO,
+                                                  AudioFormat.ENCODING_PCM_16BIT)
+        # reading a few times the minimum per call keeps the read loop relaxed without adding much latency
+        buffer_bytes = max(min_buffer, 4096) * 2
+        record = AudioRecord(AudioSource.MIC,
+                             pcmcapture.RATE,
+                             AudioFormat.CHANNEL_IN_MONO,
+                             AudioFormat.ENCODING_PCM_16BIT,
+                             buffer_bytes * 2)
+        if record.getState() != AudioRecord.STATE_INITIALIZED:
+            record.release()
+            raise OSError("can't access micophone")
+
+        self.capture = pcmcapture.PCMCapture(record, buffer_bytes, [pcmcapture.WavSink(self.file_name)])
+        self.capture.start()
 
     def stop(self, instance):
-        ''' The stop() method stops the MediaRecorder object, releases resources. '''
-        self.recorder.stop()
-        self.recorder.release()
-        self.recorder = None    
-        self.label.text = "Recording stopped"
+        ''' The stop() method stops the capture thread, releases the AudioRecord and finishes the WAV file. '''
+        self.capture.stop()
+        self.label.text = f"Recording stopped ({self.capture.seconds:.1f} s)"
+        if self.capture.error:
+            self.label.text += f"\n{self.capture.error}"
+        self.capture = None
         self.record_button.disabled = False
         self.stop_button.disabled = True
 
-        #printing recorded byte data (would be visible in logs)
-        with open(self.file_name,"rb") as f:
-            data = f.read()
-            print(data)
-
     def on_start(self):
         '''
         The on_start() method is called when the app is started.
@@ -0,0 +1,88 @@
+''' Raw PCM capture loop, kept free of android imports so it runs (and can be driven by a
+    fake AudioRecord) on any machine. main.py plugs the real android.media.AudioRecord in '''
+
+import wave
+import threading
+
+# same format the desktop app records: 44.1 kHz, mono, 16 bit
+RATE = 44100
+CHANNELS = 1
+SAMPLE_WIDTH = 2
+
+
+class WavSink:
+    ''' streams captured buffers into a WAV file, the header is patched on close '''
+    def __init__(self, filename, rate=RATE, channels=CHANNELS):
+        self.filename = filename
+        self.wf = wave.open(filename, 'wb')
+        self.wf.setnchannels(channels)
+        self.wf.setsampwidth(SAMPLE_WIDTH)
+        self.wf.setframerate(rate)
+        self.frames = 0
+
+    def write(self, data):
+        self.wf.writeframesraw(data)
+        self.frames += len(data) // (SAMPLE_WIDTH * self.wf.getnchannels())
+
+    def close(self):
+        self.wf.close()
+
+
+class PCMCapture:
+    '''
+    Reads 16 bit PCM from an AudioRecord on a background thread.
+
+    "record" is anything with AudioRecord's startRecording(), read(byte[], offset, size),
+    stop() and release() methods. every read lands in the same python bytearray and a
+    view of its filled part is handed to each sink's write(), so nothing is kept in
+    memory once the sinks have it. only that bytearray is reused: pyjnius still makes
+    a java byte[] of the buffer's size for every read call and copies it back after.
+    '''
+    def __init__(self, record, buffer_bytes, sinks):
+        self.record = record
+        # whole frames only, a read never splits a sample
+        self.buffer = bytearray(buffer_bytes - buffer_bytes % (SAMPLE_WIDTH * CHANNELS))
+        self.sinks = sinks
+        self.running = False
+        self.error = None
+        self.bytes_read = 0
+        self.thread = None
+
+    def start(self):
+        self.record.startRecording()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        view = memoryview(self.buffer)
+        size = len(self.buffer)
+        try:
+            while self.running:
+                # pyjnius passes a fresh java byte[] and copies it back into the bytearray
+                n = self.record.read(self.buffer, 0, size)
+                if n < 0:
+                    # AudioRecord reports errors as negative return codes
+                    self.error = f"AudioRecord.read failed with code {n}"
+                    break
+                if n:
+                    self.bytes_read += n
+                    for sink in self.sinks:
+                        sink.write(view[:n])
+        finally:
+            self.running = False
+
+    def stop(self):
+        ''' stops the capture thread, releases the recorder and closes every sink '''
+        self.running = False
+        # stop() makes a blocking read return, so the thread can notice
+        self.record.stop()
+        if self.thread is not None:
+            self.thread.join()
+        self.record.release()
+        for sink in self.sinks:
+            sink.close()
+
+    @property
+    def seconds(self):
+        return self.bytes_read / (RATE * CHANNELS * SAMPLE_WIDTH)
@@ -0,0 +1,6 @@
+''' pcmcapture.py has no android imports, it's importable here with the fake recorder '''
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
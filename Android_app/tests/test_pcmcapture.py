@@ -0,0 +1,112 @@
+''' the capture loop and the WAV sink, driven by a fake android.media.AudioRecord '''
+
+import time
+import wave
+import threading
+
+import pcmcapture
+
+
+class FakeAudioRecord:
+    ''' stands in for android.media.AudioRecord: read() fills the java byte[] (here the
+        bytearray pyjnius would copy back) with a known ramp, paced like a sound card
+        "speed" times faster than real time, until "total_bytes" have been delivered.
+        after stop() it returns 0, like a read the recorder was stopped under '''
+
+    def __init__(self, total_bytes, speed=50.0, error_after=None):
+        self.total_bytes = total_bytes
+        self.speed = speed
+        # a negative AudioRecord error code to return once this many bytes are delivered
+        self.error_after = error_after
+        self.delivered = bytearray()
+        self.recording = False
+        self.released = False
+        self.stopped = threading.Event()
+
+    def startRecording(self):
+        self.recording = True
+
+    def read(self, buffer, offset, size):
+        assert self.recording, "read() before startRecording()"
+        if self.error_after is not None and len(self.delivered) >= self.error_after:
+            return -3  # AudioRecord.ERROR_INVALID_OPERATION
+        n = min(size, self.total_bytes - len(self.delivered))
+        if n <= 0 or self.stopped.is_set():
+            # nothing more to capture, block like the real thing until stopped
+            self.stopped.wait(0.01)
+            return 0
+        self.stopped.wait(n / (pcmcapture.RATE * pcmcapture.SAMPLE_WIDTH) / self.speed)
+        start = len(self.delivered) // 2
+        data = b''.join(((start + i) % 65536 - 32768).to_bytes(2, 'little', signed=True)
+                        for i in range(n // 2))
+        buffer[offset:offset + n] = data
+        self.delivered += data
+        return n
+
+    def stop(self):
+        self.recording = False
+        self.stopped.set()
+
+    def release(self):
+        self.released = True
+
+
+def wait_for(condition, timeout=10.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_capture_streams_every_read_into_the_wav(tmp_path):
+    filename = str(tmp_path / 'take.wav')
+    record = FakeAudioRecord(total_bytes=pcmcapture.RATE * 2)
+    # an odd buffer size, the capture must only ever read whole samples
+    capture = pcmcapture.PCMCapture(record, 3001, [pcmcapture.WavSink(filename)])
+    assert len(capture.buffer) == 3000
+    capture.start()
+    assert wait_for(lambda: capture.bytes_read == record.total_bytes)
+    capture.stop()
+
+    assert record.released and not capture.running and capture.error is None
+    assert abs(capture.seconds - 1.0) < 1e-9
+    with wave.open(filename, 'rb') as wf:
+        assert (wf.getnchannels(), wf.getsampwidth(), wf.getframerate()) == (1, 2, pcmcapture.RATE)
+        assert wf.getnframes() == pcmcapture.RATE
+        assert wf.readframes(wf.getnframes()) == bytes(record.delivered)
+
+
+def test_every_sink_gets_the_same_audio(tmp_path):
+    class Collector:
+        def __init__(self):
+            self.data = bytearray()
+            self.closed = False
+
+        def write(self, data):
+            self.data += data
+
+        def close(self):
+            self.closed = True
+
+    record = FakeAudioRecord(total_bytes=20000)
+    collectors = [Collector(), Collector()]
+    capture = pcmcapture.PCMCapture(record, 4096, collectors)
+    capture.start()
+    assert wait_for(lambda: capture.bytes_read == record.total_bytes)
+    capture.stop()
+    for collector in collectors:
+        assert collector.closed
+        assert collector.data == record.delivered
+
+
+def test_read_error_stops_the_capture(tmp_path):
+    filename = str(tmp_path / 'take.wav')
+    record = FakeAudioRecord(total_bytes=10 ** 6, error_after=8192)
+    capture = pcmcapture.PCMCapture(record, 4096, [pcmcapture.WavSink(filename)])
+    capture.start()
+    assert wait_for(lambda: not capture.running)
+    assert capture.error == "AudioRecord.read failed with code -3"
+    capture.stop()
+    # what was captured before the error is still a valid file
+    with wave.open(filename, 'rb') as wf:
+        assert wf.getnframes() == 4096
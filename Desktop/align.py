@@ -0,0 +1,144 @@
+''' Automatic alignment of satellite recordings by cross-correlation.
+
+    satellites start recording whenever their operator presses Record and their network
+    and driver latencies differ, so even with timing maps tracks can be off by a lot.
+    the lag of every track against a reference is found in two steps:
+
+    - coarse: FFT cross-correlation of decimated amplitude envelopes over a bounded
+      window, searching at most max_lag seconds either way
+    - fine: FFT cross-correlation of the full rate waveforms around the coarse lag
+
+    only a few windows ("probes") of each track are ever read, so the cost doesn't grow
+    with the length of the session and memory stays bounded by the window size '''
+
+import numpy as np
+
+
+class Alignment:
+    ''' result for one track: target sample i lines up with reference sample i + lag.
+        confidence is the normalized envelope correlation at that lag (0 to 1) '''
+
+    def __init__(self, lag, confidence, refined_confidence=0.0, probe=None):
+        self.lag = lag
+        self.confidence = confidence
+        self.refined_confidence = refined_confidence
+        self.probe = probe
+
+    def __repr__(self):
+        return f"Alignment(lag={self.lag}, confidence={self.confidence:.3f})"
+
+
+def envelope(samples, factor):
+    ''' amplitude envelope decimated by "factor" (mean of |x| over each group of samples),
+        zero mean so silence doesn't correlate with everything '''
+    count = len(samples) // factor * factor
+    env = np.abs(np.asarray(samples[:count], dtype=np.float32)).reshape(-1, factor).mean(axis=1)
+    env -= env.mean()
+    return env
+
+
+def correlate(needle, haystack):
+    ''' normalized cross-correlation of "needle" at every full overlap position in "haystack".
+        returns an array of len(haystack) - len(needle) + 1 values in [-1, 1] '''
+    n = len(needle)
+    positions = len(haystack) - n + 1
+    if positions <= 0:
+        return np.zeros(0, dtype=np.float32)
+    size = 1 << int(n + len(haystack) - 1).bit_length()
+    spectrum = np.conj(np.fft.rfft(needle, size)) * np.fft.rfft(haystack, size)
+    products = np.fft.irfft(spectrum, size)[:positions]
+
+    # energy of every haystack window from a running sum of squares
+    squares = np.concatenate(([0.0], np.cumsum(np.square(haystack, dtype=np.float64))))
+    energy = squares[n:n + positions] - squares[:positions]
+    norm = np.sqrt(np.maximum(energy, 1e-12) * max(float(np.dot(needle, needle)), 1e-12))
+    return products / norm
+
+
+def probe_lag(reference, target, start, window, guess, max_lag, factor):
+    ''' coarse lag of one probe: reference[start:start + window] searched in the target
+        around "guess" by up to max_lag samples. returns (lag, confidence) or None '''
+    region_start = max(start - guess - max_lag, 0)
+    region_end = min(start - guess + window + max_lag, len(target))
+    if region_end - region_start < window:
+        return None
+
+    needle = envelope(reference[start:start + window], factor)
+    haystack = envelope(target[region_start:region_end], factor)
+    if not len(needle) or not needle.any():
+        return None
+    scores = correlate(needle, haystack)
+    if not len(scores):
+        return None
+    best = int(np.argmax(scores))
+    return start - (region_start + best * factor), float(scores[best])
+
+
+def refine_lag(reference, target, start, window, lag, radius):
+    ''' full rate refinement of a coarse lag within +-radius samples. returns (lag, confidence) '''
+    region_start = max(start - lag - radius, 0)
+    region_end = min(start - lag + window + radius, len(target))
+    needle = np.asarray(reference[start:start + window], dtype=np.float32)
+    haystack = np.asarray(target[region_start:region_end], dtype=np.float32)
+    if len(haystack) < len(needle) or not needle.any():
+        return lag, 0.0
+    scores = correlate(needle - needle.mean(), haystack - haystack.mean())
+    best = int(np.argmax(scores))
+    return start - (region_start + best), float(scores[best])
+
+
+def estimate_lag(reference, target, rate, guess=0, max_lag=10.0, window=30.0,
+                 refine_window=1.0, factor=64, probes=3):
+    ''' estimates the lag of target against reference (both int16 arrays or memmaps).
+
+        "guess" is a prior lag in samples (e.g. from timing maps), the search covers
+        guess +- max_lag seconds. a few probe windows spread over the overlap are tried
+        and the most confident one wins, so one quiet stretch doesn't spoil the result '''
+    window = int(window * rate)
+    max_lag = int(max_lag * rate)
+    overlap = min(len(reference), len(target) + guess) - max(0, guess)
+    window = min(window, max(overlap, 0))
+    if window < factor * 16:
+        return Alignment(guess, 0.0)
+
+    first = max(0, guess)
+    spread = max(overlap - window, 0)
+    starts = sorted({first + spread * (index + 1) // (probes + 1) for index in range(probes)})
+
+    best = None
+    for start in starts:
+        result = probe_lag(reference, target, start, window, guess, max_lag, factor)
+        if result is not None and (best is None or result[1] > best[1]):
+            best = result + (start,)
+    if best is None:
+        return Alignment(guess, 0.0)
+    lag, confidence, start = best
+
+    # refining on the loudest part of the winning probe's reference window
+    refine = int(refine_window * rate)
+    env = envelope(reference[start:start + window], refine)
+    refine_start = start + int(np.argmax(env)) * refine if len(env) else start
+    lag, refined_confidence = refine_lag(reference, target, refine_start, refine, lag, 2 * factor)
+    return Alignment(lag, confidence, refined_confidence, start)
+
+
+def align_tracks(tracks, rate, reference=0, min_confidence=0.3, **options):
+    ''' sets the offset of every merge.Track against tracks[reference], starting from the
+        offsets they already have (e.g. from timing maps). tracks whose alignment isn't
+        confident enough keep their offset. returns one Alignment per track '''
+    ref = tracks[reference]
+    results = []
+    for index, track in enumerate(tracks):
+        if index == reference:
+            results.append(Alignment(0, 1.0))
+            continue
+        result = estimate_lag(ref.samples, track.samples, rate, guess=track.offset - ref.offset, **options)
+        if result.confidence >= min_confidence:
+            track.offset = ref.offset + result.lag
+        results.append(result)
+
+    # the earliest track has to start at 0 on the output timeline
+    earliest = min(track.offset for track in tracks)
+    for track in tracks:
+        track.offset -= earliest
+    return results
@@ -1,19 +1,37 @@
-import wave
 import server
 import client
-import pyaudio 
-import datetime
+import discovery
+import meters
+import merge
+import metrics
+import peaks
+import recorder
+import os
+import time
 import threading
+import numpy as np
 from kivy.app import App
 from kivy.clock import Clock
+from kivy.graphics import Color, Ellipse, Mesh, Rectangle
 from kivy.uix.label import Label
+from kivy.uix.widget import Widget
 from kivy.uix.button import Button
 from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.textinput import TextInput
 from kivy.uix.gridlayout import GridLayout
 from kivy.uix.anchorlayout import AnchorLayout
+from kivy.uix.scrollview import ScrollView
+from kivy.uix.slider import Slider
 from kivy.uix.screenmanager import ScreenManager, Screen
 
+# capture format; one capture buffer is also one AUDIO frame when streaming to a central node,
+# smaller buffers mean lower latency but more frames (and callbacks) per second
+RATE = 44100
+FRAMES_PER_BUFFER = 1024
+
+# seconds between metrics log lines while recording (capture, streaming), None for none
+METRICS_LOG_INTERVAL = 30
+
 class Welcome(Screen):
     '''This class inherits kivy's screen class(for multiple screen) , display's welcome message
        with lisence info and a continue button which switches screen to setallite/central screen '''
@@ -73,7 +91,7 @@ class ClientServerOption(Screen):
     # methods to switch screen to central
     def switch_to_central(self, button_instance):
             self.manager.current = "server"
-            serverthread.start()
+            start_server()
 
     # methods to switch screen to setallite
     def switchto_setallite(self, button_instance):
@@ -92,7 +110,7 @@ class Root_window(Screen):
         self.label = Label(text="Press 'Record' to start recording",font_size='35sp',size_hint_y=None)
 
         # record_button, whihc triggers "start_recording" function on press, enabled bydeault
-        self.button_layout = GridLayout(cols=2,spacing=80,padding=150)  
+        self.button_layout = GridLayout(cols=3,spacing=80,padding=150)  
 
         self.record_button = Button(text="Record",
                                     size_hint=(None, None),
@@ -108,11 +126,19 @@ class Root_window(Screen):
         self.stop_button.bind(on_press=self.stop_recording)
         self.stop_button.disabled = True
 
+        # review_button, shows the last recording's waveform, disabled until there is one
+        self.review_button = Button(text="Review",
+                                    size_hint=(None, None),
+                                    size=(200, 50))
+
+        self.review_button.bind(on_press=self.review_recording)
+        self.review_button.disabled = True
 
         # adding widgets to boxlayout and returning label_layout
         self.label_layout.add_widget(self.label)
         self.button_layout.add_widget(self.record_button)
         self.button_layout.add_widget(self.stop_button)
+        self.button_layout.add_widget(self.review_button)
         self.add_widget(self.label_layout)
         self.add_widget(self.button_layout)
 
@@ -132,104 +158,168 @@ class Root_window(Screen):
         self.label.text = "Recording..."
         self.record_button.disabled = True
         self.stop_button.disabled = False
-        try:
-            # pyaudio object
-            self.audio = pyaudio.PyAudio()
-            # audio stream, "input=true" => record from default microphone
-            self.stream = self.audio.open(format=pyaudio.paInt16,
-                                      channels=1,
-                                      rate=44100,
-                                      input=True,
-                                      frames_per_buffer=1024,
-                                      stream_callback=self.callback)
-        except:
-            raise OSError("can't access micophone")
-        
-        else:
-            #audio streams are stored as a list in frames object
-            self.frames = []
-            self.stream.start_stream()
+        self.review_button.disabled = True
+        # the recording (capture, WAV writer and streaming to a central node) lives in
+        # recorder.py, shared with the headless daemon
+        self.recording = recorder.Recording(self.new_recording_filename(), rate=RATE,
+                                            frames_per_buffer=FRAMES_PER_BUFFER)
+        self.recording.start()
+        # the capture metrics go to the log like the headless satellite's, and on screen
+        self.exporter = metrics.Exporter(log_interval=METRICS_LOG_INTERVAL)
+        Clock.schedule_interval(self.show_capture_metrics, 1)
 
-    def callback(self, in_data, frame_count, time_info, status):
-        ''' A callback function for the audio stream that appends recorded audio frames to a list 
-            takes in new audio data and appends it to frames object '''
-        
-        # appending "in_data" to self.frame and continuing to record audio stream
-        self.frames.append(in_data)
-        return (None, pyaudio.paContinue)
-    
     def stop_recording(self, instance):
         ''' stops & terminates recording and ensures streaming and use of resources has stopped '''
-        self.stream.stop_stream()
-        self.stream.close()
-        self.audio.terminate()
-       
         # when this functon is called:
             # lable changes to "recording stopped."
             # start_record button enables for another recording 
             # stop_record button disables until new recording begins
-        self.label.text = "Recording stopped"
+        Clock.unschedule(self.show_capture_metrics)
+        self.exporter.stop()
+        self.label.text = f"Recording stopped\n{self.describe_capture()}"
         self.record_button.disabled = False
         self.stop_button.disabled = True
+        self.review_button.disabled = False
         self.save_recorded_audio()
 
+    def show_capture_metrics(self, dt):
+        self.label.text = f"Recording...\n{self.describe_capture()}"
+
+    def describe_capture(self):
+        ''' the slowest audio callbacks and the input the sound card lost so far '''
+        p99 = recorder.callback_seconds.quantile(0.99) or 0
+        return f"callback p99 {p99 * 1000:.1f} ms, {recorder.input_overflows.value} input overflows"
+
+    def review_recording(self, instance):
+        ''' opens the last recording on the review screen, which loads it once the writer
+            has finished it (and saved its peaks), waiting on its loading thread '''
+        self.manager.get_screen("review").open(self.recorded_filename, before=self.recording.writer.wait)
+        self.manager.current = "review"
+
+    def new_recording_filename(self):
+        ''' formats the recording file name using the current date and time '''
+        self.recorded_filename = recorder.new_recording_filename()
+        return self.recorded_filename
+
     def save_recorded_audio(self):
-        ''' Saves the recorded audio frames to a WAV file using the
-        current date and time as part of the filename '''
-        date = datetime.datetime.now().strftime("%y_%m_%d")
-        time = datetime.datetime.now().strftime("%H_%M_%S")
-
-        # formating file name
-        self.recorded_filename = f"audiomerge{date}at{time}.wav"
-
-        # checking whether audio data exists
-        if self.frames:
-            with wave.open(self.recorded_filename, 'wb') as wf:
-                wf.setnchannels(1)
-                wf.setsampwidth(self.audio.get_sample_size(pyaudio.paInt16))
-                wf.setframerate(44100)
-                wf.writeframes(b''.join(self.frames))
-        else:
-             raise ValueError("no audio data available to write")
+        ''' Finishes the WAV file the writer thread has been streaming to, the header
+        is patched by the writer once its queue is drained so this returns right away '''
+        self.recording.stop()
         
 
+# address and port the central node listens on, set by server_thread once it runs
+ip_address = None
+port = None
+
+# thread running the central node's event loop, once it's been started
+server_loop = None
+
+def start_server():
+    ''' starts the event loop on its own thread (the GUI only polls server's state),
+        unless it's already running. a loop the server screen stopped may still be
+        closing its session, it's waited for first '''
+    global server_loop
+    if server_loop is not None and server_loop.is_alive():
+        if not server.stop_event.is_set():
+            return
+        server_loop.join()
+    server.stop_event.clear()
+    server_loop = threading.Thread(target=server_thread, daemon=True)
+    server_loop.start()
+
 def server_thread():
     ''' this function is called when server screen is loaded, it starts server thread'''
     global ip_address, port
     ip_address = server.get_ipaddress()
-    port = server.get_port()
-    server_socket = server.bind(ip_address,port)
+    # listening on every interface, ip_address is only what's shown (and what satellites
+    # typing it by hand use), discovered satellites use whatever address the beacon came from.
+    # port 0 lets the OS pick a free port, like the command line central node
+    server_socket = server.bind("", 0)
     server.listen(server_socket)
+    port = server_socket.getsockname()[1]
     server.handle_client(server_socket)
 
-# creating a thread for server
-serverthread = threading.Thread(target= server_thread)
-serverthread.daemon = True
+class LevelBar(Widget):
+    ''' horizontal peak/RMS meter. its canvas instructions are made once, new levels only
+        move and resize them '''
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.peak = self.rms = meters.FLOOR_DB
+        with self.canvas:
+            Color(0.15, 0.15, 0.15)
+            self.background = Rectangle()
+            Color(0.2, 0.75, 0.3)
+            self.rms_bar = Rectangle()
+            self.peak_color = Color(0.9, 0.9, 0.3)
+            self.peak_mark = Rectangle()
+        self.bind(pos=self.redraw, size=self.redraw)
+
+    def set_levels(self, peak, rms):
+        self.peak, self.rms = peak, rms
+        self.redraw()
+
+    def redraw(self, *args):
+        x, y = self.pos
+        width, height = self.size
+        def position(db):
+            return width * (db - meters.FLOOR_DB) / -meters.FLOOR_DB
+        self.background.pos, self.background.size = self.pos, self.size
+        self.rms_bar.pos, self.rms_bar.size = self.pos, (position(self.rms), height)
+        self.peak_mark.pos, self.peak_mark.size = (x + max(position(self.peak) - 3, 0), y), (3, height)
+        # red once the satellite is about to clip
+        self.peak_color.rgb = (1, 0.2, 0.2) if self.peak > -1 else (0.9, 0.9, 0.3)
+
+class SatelliteRow(BoxLayout):
+    ''' one satellite in the monitoring view: health light, address, meter, levels and what it sent '''
+    HEALTH_COLORS = {'ok': (0.2, 0.8, 0.3), 'busy': (0.95, 0.8, 0.2), 'overloaded': (1, 0.5, 0.1),
+                     'stalled': (1, 0.2, 0.2), 'disconnected': (0.5, 0.5, 0.5)}
+
+    def __init__(self, satellite_id, **kwargs):
+        super().__init__(orientation='horizontal', spacing=10, size_hint_y=None, height=30, **kwargs)
+        self.light = Widget(size_hint_x=None, width=20)
+        with self.light.canvas:
+            self.light_color = Color(*self.HEALTH_COLORS['disconnected'])
+            self.light_dot = Ellipse(size=(14, 14))
+        self.light.bind(pos=self.place_light)
+        self.title = Label(text=f"satellite {satellite_id}", font_size='16sp', size_hint_x=0.25)
+        self.meter = LevelBar(size_hint_x=0.35)
+        self.levels = Label(text="", font_size='14sp', size_hint_x=0.15)
+        self.info = Label(text="", font_size='14sp', size_hint_x=0.25)
+        for widget in (self.light, self.title, self.meter, self.levels, self.info):
+            self.add_widget(widget)
+
+    def place_light(self, *args):
+        self.light_dot.pos = (self.light.x + 3, self.light.center_y - 7)
+
+    def show(self, change):
+        self.meter.set_levels(change['peak'], change['rms'])
+        self.levels.text = f"{change['peak']:.0f} / {change['rms']:.0f} dB"
+        self.light_color.rgb = self.HEALTH_COLORS[change['health']]
+        if change['address'] is not None:
+            self.title.text = change['address']
 
 class Server(Screen):
+    ''' central node screen: address to connect to, and a live meter and health light for
+        every satellite. widgets are built once; levels are pushed by the event loop
+        (server.level_listener) and applied in one coalesced Clock callback per frame,
+        the slower counters are polled once a second and only labels that changed are set '''
     # initializing Screen class with super() method
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-
-    def on_enter(self):
-        ''' this function is called when server screen is loaded, it starts server thread'''
-        Clock.schedule_interval(self.update, 1)
         self.label_layout = AnchorLayout(anchor_x='center',anchor_y='top',padding=10)
         self.label = Label(text="central",font_size='35sp',size_hint_y=None)
 
-        self.grid_layout = GridLayout(cols=2,spacing=10,padding=100,row_force_default=True,row_default_height=50)
+        self.grid_layout = GridLayout(cols=2,spacing=10,padding=[100,80,100,0],row_force_default=True,row_default_height=50,
+                                      size_hint_y=None,height=230,pos_hint={'top':1})
 
         self.ip_address_label = Label(text="IP Address: ",font_size='30sp')
-        self.ip_address = Label(text=str(ip_address),font_size='30sp')
+        self.ip_address = Label(text="",font_size='30sp')
 
         self.port_label = Label(text="Port: ",font_size='30sp')
-        self.port = Label(text=str(port),font_size='30sp')
-
-        self.client_label = Label(text="Number of clients: ",font_size='30sp')
-        self.client_number = Label(text=str(server.number_of_clients),font_size='30sp')
+        self.port = Label(text="",font_size='30sp')
 
         self.num_of_connected_clients_label = Label(text="Number of connected clients: ",font_size='30sp')
-        self.num_of_connected_clients = Label(text= self.client_number.text,font_size='30sp')
+        self.num_of_connected_clients = Label(text="0",font_size='30sp')
 
         self.label_layout.add_widget(self.label)
         self.grid_layout.add_widget(self.ip_address_label)
@@ -239,19 +329,265 @@ class Server(Screen):
         self.grid_layout.add_widget(self.num_of_connected_clients_label)   
         self.grid_layout.add_widget(self.num_of_connected_clients)
 
+        # one row per satellite, created the first time it shows up and reused after that
+        self.rows = {}
+        self.row_list = GridLayout(cols=1,spacing=4,size_hint_y=None)
+        self.row_list.bind(minimum_height=self.row_list.setter('height'))
+        self.scroll = ScrollView(size_hint=(0.9,0.5),pos_hint={'center_x':0.5,'y':0.14})
+        self.scroll.add_widget(self.row_list)
+
+        # event loop and disk health, from the same metrics the endpoint serves
+        self.metrics_layout = AnchorLayout(anchor_x='center',anchor_y='bottom',padding=20)
+        self.metrics_label = Label(text="",font_size='18sp',size_hint_y=None,height=60,halign='center')
+        self.metrics_layout.add_widget(self.metrics_label)
+
         self.add_widget(self.label_layout)
         self.add_widget(self.grid_layout)
+        self.add_widget(self.scroll)
+        self.add_widget(self.metrics_layout)
 
-    def update(self,*args):
-        ''' this function is called every second to update number of connected clients'''
-        self.client_number.text = str(server.number_of_clients)
-        self.ip_address.text = str(ip_address)
-        self.port.text = str(port)
+        # level changes from the event loop thread, waiting for the next frame
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.apply_scheduled = False
+
+    def on_enter(self):
+        ''' this function is called when server screen is loaded, it starts listening for levels'''
+        server.level_listener = self.levels_changed
+        self.update()
+        Clock.schedule_interval(self.update, 1)
+
+    def levels_changed(self, changes):
+        ''' called on the event loop thread: keeps the newest change of every satellite and
+            asks for one apply on the next frame, however many changes come before it '''
+        with self.pending_lock:
+            self.pending.update(changes)
+            if self.apply_scheduled:
+                return
+            self.apply_scheduled = True
+        Clock.schedule_once(self.apply_levels)
+
+    def apply_levels(self, *args):
+        with self.pending_lock:
+            changes, self.pending = self.pending, {}
+            self.apply_scheduled = False
+        for satellite_id, change in changes.items():
+            row = self.rows.get(satellite_id)
+            if row is None:
+                row = self.rows[satellite_id] = SatelliteRow(satellite_id)
+                self.row_list.add_widget(row)
+            row.show(change)
 
-    def on_leave(self, serverthread):
+    def update(self,*args):
+        ''' this function is called every second to update number of connected clients and the counters'''
+        self.set_text(self.ip_address, str(ip_address or ""))
+        self.set_text(self.port, str(port or ""))
+        self.set_text(self.num_of_connected_clients, str(server.client_count()))
+        for client in server.client_list():
+            row = self.rows.get(client['satellite_id'])
+            if row is not None:
+                self.set_text(row.info, self.describe_client(client))
+        self.set_text(self.metrics_label, self.describe_metrics(metrics.snapshot()))
+
+    @staticmethod
+    def set_text(label, text):
+        # setting a label's text re-renders its texture even if nothing changed
+        if label.text != text:
+            label.text = text
+
+    def describe_client(self, client):
+        ''' what a satellite sent and how far behind it is '''
+        line = f"{client['frames_received']} frames  {client['bytes_received'] / 1e6:.1f} MB"
+        if client['lag'] is not None:
+            line += f"  lag {client['lag']:.2f} s"
+        if client['jitter'] is not None and client['jitter']['concealed']:
+            line += f"  {client['jitter']['concealed']} concealed"
+        return line
+
+    def describe_metrics(self, snap):
+        ''' event loop load and the slowest rounds and fsyncs '''
+        def p99(name):
+            samples = snap.get(name, {}).get('samples', [])
+            value = max((sample['value']['p99'] or 0 for sample in samples), default=0)
+            return f"{value * 1000:.1f} ms"
+        text = f"event loop {server.loop_load:.0%} busy, rounds p99 {p99('audiomerge_loop_round_seconds')}, " \
+               f"fsync p99 {p99('audiomerge_fsync_seconds')}"
+        if server.metrics_port is not None:
+            text += f"\nmetrics on http://127.0.0.1:{server.metrics_port}/metrics"
+        return text
+
+    def on_leave(self, *args):
         ''' this function is called when server screen is left, it stops server thread'''
-        serverthread.stop()
+        Clock.unschedule(self.update)
+        server.level_listener = None
+        server.stop()
+
 
+class WaveformLane(Widget):
+    ''' one track on the review screen: min/max of every pixel column as a vertical line,
+        the RMS in a brighter band inside it. the two meshes are made once, a redraw only
+        replaces their vertices '''
+    def __init__(self, reader, offset, on_zoom=None, **kwargs):
+        super().__init__(**kwargs)
+        self.reader = reader
+        # where the track starts on the review timeline, in its own samples
+        self.offset = offset
+        self.on_zoom = on_zoom
+        with self.canvas:
+            Color(0.12, 0.12, 0.12)
+            self.background = Rectangle()
+            Color(0.25, 0.55, 0.85)
+            self.peak_mesh = Mesh(mode='lines')
+            Color(0.55, 0.8, 1.0)
+            self.rms_mesh = Mesh(mode='lines')
+
+    def draw(self, start, span):
+        ''' shows "span" seconds of the review timeline from "start" '''
+        self.background.pos, self.background.size = self.pos, self.size
+        columns = max(int(self.width), 1)
+        rate = self.reader.rate
+        first = start * rate - self.offset
+        low, high, rms = self.reader.query(int(first), int(first + span * rate), columns)
+        middle, half = self.center_y, self.height / 2
+        x = self.x + np.arange(columns, dtype=np.float32) + 0.5
+        self.peak_mesh.vertices, self.peak_mesh.indices = self.line_vertices(x, middle + low * half, middle + high * half)
+        self.rms_mesh.vertices, self.rms_mesh.indices = self.line_vertices(x, middle - rms * half, middle + rms * half)
+
+    @staticmethod
+    def line_vertices(x, bottom, top):
+        # (x, y, u, v) of both ends of every column's line
+        vertices = np.zeros((len(x), 2, 4), dtype=np.float32)
+        vertices[:, :, 0] = x[:, None]
+        vertices[:, 0, 1] = bottom
+        # a column of silence still gets one pixel
+        vertices[:, 1, 1] = np.maximum(top, bottom + 1)
+        return vertices.ravel().tolist(), list(range(2 * len(x)))
+
+    def on_touch_down(self, touch):
+        if self.collide_point(*touch.pos) and touch.is_mouse_scrolling and self.on_zoom is not None:
+            # the wheel zooms around the pointer
+            self.on_zoom(touch.button == 'scrolldown', (touch.x - self.x) / max(self.width, 1))
+            return True
+        return super().on_touch_down(touch)
+
+class Review(Screen):
+    ''' zooms and scrolls over the waveforms of a recording or a whole session (live mix
+        and every track), drawn from their peak pyramids (see peaks.py): whatever the zoom,
+        a redraw reads about one entry per pixel column of every lane '''
+    # closest zoom, in seconds across the screen
+    MIN_SPAN = 0.01
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.layout = BoxLayout(orientation='vertical',spacing=8,padding=20)
+
+        self.open_layout = BoxLayout(orientation='horizontal',spacing=10,size_hint_y=None,height=40)
+        self.path_input = TextInput(hint_text="recording, session directory or track directory",multiline=False)
+        self.open_button = Button(text="open",size_hint_x=None,width=120,on_press=self.open_path)
+        self.back_button = Button(text="back",size_hint_x=None,width=120,on_press=self.switch_to_main)
+        for widget in (self.path_input, self.open_button, self.back_button):
+            self.open_layout.add_widget(widget)
+
+        self.lanes_layout = BoxLayout(orientation='vertical',spacing=6)
+        self.status = Label(text="",font_size='16sp',size_hint_y=None,height=30)
+
+        self.zoom_layout = BoxLayout(orientation='horizontal',spacing=10,size_hint_y=None,height=40)
+        self.zoom_out_button = Button(text="zoom out",size_hint_x=None,width=120,on_press=lambda *args: self.zoom(False))
+        self.zoom_in_button = Button(text="zoom in",size_hint_x=None,width=120,on_press=lambda *args: self.zoom(True))
+        self.position = Slider(min=0,max=1,value=0)
+        self.position.bind(value=self.scrolled)
+        for widget in (self.zoom_out_button, self.zoom_in_button, self.position):
+            self.zoom_layout.add_widget(widget)
+
+        for widget in (self.open_layout, self.lanes_layout, self.status, self.zoom_layout):
+            self.layout.add_widget(widget)
+        self.add_widget(self.layout)
+        # sliding, zooming and resizing ask for a redraw, it happens once on the next frame
+        self.redraw_trigger = Clock.create_trigger(self.redraw)
+
+        self.lanes = []
+        # the view: seconds from the start of the timeline, and seconds across the screen
+        self.start = 0.0
+        self.span = 1.0
+        self.duration = 0.0
+
+    def open_path(self, button_instance):
+        self.open(self.path_input.text.strip())
+
+    def open(self, path, before=None):
+        ''' shows "path", loading it in the background: a track recorded before peaks were
+            saved gets them built in one pass over it first. "before" is called on the
+            loading thread first, e.g. to wait for the recording to be finished '''
+        self.path_input.text = path
+        self.status.text = f"loading {os.path.basename(path.rstrip(os.sep))}..."
+        threading.Thread(target=self.load, args=(path, before), daemon=True).start()
+
+    def load(self, path, before=None):
+        if before is not None:
+            before()
+        try:
+            sources = peaks.review_sources(path)
+            # tracks the central node recorded are placed by their timing maps, like a merge
+            tracks = merge.place_tracks(sources, RATE)
+            lanes = []
+            for source, track in zip(sources, tracks):
+                filename = peaks.peaks_filename(source)
+                if not os.path.exists(filename):
+                    peaks.build(source)
+                reader = peaks.PeakReader(filename, track.samples)
+                lanes.append((source, reader, int(track.offset * reader.rate / RATE)))
+        except (OSError, ValueError) as err:
+            message = f"can't open {path}: {err}"
+            Clock.schedule_once(lambda dt: setattr(self.status, 'text', message))
+            return
+        Clock.schedule_once(lambda dt: self.show(lanes))
+
+    def show(self, lanes):
+        self.lanes_layout.clear_widgets()
+        self.lanes = []
+        for source, reader, offset in lanes:
+            row = BoxLayout(orientation='horizontal',spacing=10)
+            name = os.path.basename(source.rstrip(os.sep))
+            row.add_widget(Label(text=name,font_size='14sp',size_hint_x=None,width=220,shorten=True,text_size=(210,None)))
+            lane = WaveformLane(reader, offset, on_zoom=self.zoom)
+            lane.bind(size=self.redraw_trigger, pos=self.redraw_trigger)
+            row.add_widget(lane)
+            self.lanes_layout.add_widget(row)
+            self.lanes.append(lane)
+        self.duration = max((lane.offset / lane.reader.rate + lane.reader.duration for lane in self.lanes), default=0.0)
+        self.start, self.span = 0.0, max(self.duration, self.MIN_SPAN)
+        self.update_slider()
+
+    def zoom(self, zoom_in, anchor=0.5):
+        ''' halves (or doubles) the span, keeping the time at "anchor" (0 left, 1 right) in place '''
+        if not self.lanes:
+            return
+        anchored = self.start + anchor * self.span
+        self.span = min(max(self.span / 2 if zoom_in else self.span * 2, self.MIN_SPAN), max(self.duration, self.MIN_SPAN))
+        self.start = anchored - anchor * self.span
+        self.update_slider()
+
+    def update_slider(self):
+        self.start = min(max(self.start, 0.0), max(self.duration - self.span, 0.0))
+        self.position.max = max(self.duration - self.span, 1e-9)
+        self.position.value = self.start
+        self.redraw_trigger()
+
+    def scrolled(self, slider, value):
+        self.start = value
+        self.redraw_trigger()
+
+    def redraw(self, *args):
+        if not self.lanes:
+            return
+        started = time.perf_counter()
+        for lane in self.lanes:
+            lane.draw(self.start, self.span)
+        self.status.text = f"{self.start:.2f} s - {self.start + self.span:.2f} s of {self.duration:.1f} s, " \
+                           f"drawn in {(time.perf_counter() - started) * 1000:.1f} ms"
+
+    def switch_to_main(self, button_instance):
+        self.manager.current = "main"
 
 class Client(Screen):
     ''' This class inherits kivy's screen class(for multiple screen), and used to connect to central node'''
@@ -272,6 +608,14 @@ class Client(Screen):
         self.connect_button_layout = AnchorLayout(anchor_x='center', anchor_y='center', padding=30)
         self.connect_button = Button(text="connect", size_hint=(None, None), size=(200, 50), on_press=self.connect_to_server)
 
+        # central nodes found on the network, one tap connects to one
+        self.discovered_layout = AnchorLayout(anchor_x='center', anchor_y='bottom', padding=[40, 40, 40, 110])
+        self.discovered_list = BoxLayout(orientation='vertical', spacing=10, size_hint=(0.8, None), height=50)
+        self.discovered_status = Label(text="searching for central nodes...", font_size='20sp', size_hint_y=None, height=40)
+        self.discovered_list.add_widget(self.discovered_status)
+        self.discovered = None
+        self.listener = None
+
         # continue button
         self.continue_button_layout = AnchorLayout(anchor_x='center', anchor_y='bottom', padding=40)
         self.continue_button = Button(text="continue", size_hint=(None, None), size=(200, 50), on_press=self.switch_to_main)
@@ -284,13 +628,65 @@ class Client(Screen):
         self.input_layout.add_widget(self.port)
         self.connect_button_layout.add_widget(self.connect_button)
         self.continue_button_layout.add_widget(self.continue_button)
+        self.discovered_layout.add_widget(self.discovered_list)
 
         # adding layouts to client window
         self.add_widget(self.label_layout)
         self.add_widget(self.input_layout)
         self.add_widget(self.connect_button_layout)
         self.add_widget(self.continue_button_layout)
-    
+        self.add_widget(self.discovered_layout)
+
+    def on_enter(self):
+        ''' starts listening for central nodes' beacons '''
+        self.discovered = None
+        self.discovered_list.clear_widgets()
+        self.discovered_status.text = "searching for central nodes..."
+        self.discovered_list.add_widget(self.discovered_status)
+        self.discovered_list.height = 50
+        try:
+            self.listener = discovery.Listener()
+        except OSError as err:
+            # e.g. the discovery port is taken, typing the address still works
+            print(f"discovery unavailable: {err}")
+            self.discovered_status.text = "enter the central node's address above"
+            return
+        Clock.schedule_interval(self.refresh_discovered, 0.5)
+
+    def on_leave(self, *args):
+        Clock.unschedule(self.refresh_discovered)
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    def refresh_discovered(self, *args):
+        ''' shows a button for every central node heard lately '''
+        centrals = self.listener.centrals()
+        found = [(central.address, central.port, central.name, central.satellites) for central in centrals]
+        # beacons come every half second, "searching" stays up until one surely had a chance
+        searching = not centrals and time.time() - self.listener.started < 1.5
+        if searching or found == self.discovered:
+            return
+        self.discovered = found
+        self.discovered_list.clear_widgets()
+        if not centrals:
+            self.discovered_status.text = "no central node found, enter its address above"
+            self.discovered_list.add_widget(self.discovered_status)
+            self.discovered_list.height = 50
+            return
+        for central in centrals:
+            button = Button(text=f"{central.name}  ({central.address}:{central.port}, {central.satellites} connected)",
+                            font_size='20sp', size_hint_y=None, height=50, disabled=central.free == 0)
+            button.bind(on_press=lambda instance, central=central: self.connect_to_central(central))
+            self.discovered_list.add_widget(button)
+        self.discovered_list.height = 60 * len(centrals)
+
+    def connect_to_central(self, central):
+        ''' fills in a discovered central node's address and connects to it '''
+        self.ip_address.text = central.address
+        self.port.text = str(central.port)
+        self.connect_to_server(None)
+
     def switch_to_main(self, button_instance):
         self.manager.current = "main"
         
@@ -300,7 +696,7 @@ class Client(Screen):
         # connect function from client.py
         status = client.connect(self.ip_address.text, self.port.text)
 
-        if status == 200:
+        if not isinstance(status, str):
             print("connected")
             self.label_layout = BoxLayout(orientation='vertical',spacing=60)
             self.label = Label(text="connected !",font_size='25sp',size_hint_y=None, height=350, font_name='CutiveMono-Regular.ttf')
@@ -327,7 +723,12 @@ class AudiomergeApp(App):
         sm.add_widget(Server(name="server"))
         sm.add_widget(Client(name="client"))
         sm.add_widget(Root_window(name="main"))
+        sm.add_widget(Review(name="review"))
         return sm
+
+    def on_stop(self):
+        # a satellite says goodbye, the central node acknowledging it lets the spools go
+        client.disconnect()
     
 
 if __name__ == '__main__':
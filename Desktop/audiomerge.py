@@ -0,0 +1,238 @@
+''' Command line entry point, runs a central or satellite node without a display.
+
+        python audiomerge.py central [--port 5000] [--output-dir DIR] [--duration S]
+        python audiomerge.py satellite [--connect HOST:PORT] [--wav FILE] [--duration S]
+        python audiomerge.py gui
+        python audiomerge.py peaks PATH...
+        python audiomerge.py recover PATH...
+
+    the nodes use the same server, client and recorder modules as the GUI; Kivy is only
+    imported for "gui" (and PyAudio only when a satellite captures from its microphone),
+    so a headless node starts in a fraction of a second. a node runs until --duration
+    seconds have passed or it gets SIGINT/SIGTERM, then finishes its files and exits.
+
+    a satellite without --connect joins the first central node it discovers on the
+    network. with --wav it streams a WAV file (int16, looped, in real time) instead of
+    its microphone, so many satellite processes can run on one machine for load tests.
+
+    "peaks" builds the waveform peaks the review screen draws from (see peaks.py) for
+    recordings made before they were saved along, PATH being a WAV file, a session
+    directory or one of its track directories.
+
+    "recover" indexes what a central node that crashed wrote to a session after its
+    last index sync (see session.recover_track) and rebuilds the peaks of the tracks it
+    got audio back for; "peaks" recovers session tracks first as well '''
+
+import os
+import sys
+import time
+import wave
+import signal
+import argparse
+import threading
+
+# capture format, the same as the GUI's
+RATE = 44100
+FRAMES_PER_BUFFER = 1024
+
+
+def wait_for_stop(duration, stop_event):
+    ''' blocks until "duration" seconds have passed (0: forever) or a signal arrived '''
+    def handle(signum, frame):
+        stop_event.set()
+    signal.signal(signal.SIGINT, handle)
+    signal.signal(signal.SIGTERM, handle)
+    stop_event.wait(duration or None)
+
+
+def run_central(args):
+    import server
+    os.makedirs(args.output_dir, exist_ok=True)
+    server.output_dir = args.output_dir
+    server.live_mix = not args.no_live_mix
+    server.advertise = not args.no_advertise
+    server.max_satellites = args.max_satellites
+    server.export_wavs = not args.no_wav_export
+    server.metrics_port = args.metrics_port or None
+    server.metrics_log_interval = args.metrics_log or None
+
+    # port 0 lets the OS pick a free port, the one it picked is reported
+    server_socket = server.bind(args.bind, args.port)
+    server.listen(server_socket)
+    port = server_socket.getsockname()[1]
+    print(f"central node listening on {server.get_ipaddress()}:{port}", flush=True)
+
+    loop = threading.Thread(target=server.handle_client, args=(server_socket,), daemon=True)
+    loop.start()
+    stopping = threading.Event()
+    wait_for_stop(args.duration, stopping)
+    server.stop()
+    # the event loop closes the connections and finishes the tracks and the mix
+    loop.join()
+    return 0
+
+
+def play_wav(filename, recording, stop_event):
+    ''' feeds a WAV file into a recording in real time, one capture buffer at a time,
+        starting over at the end, like a microphone would '''
+    with wave.open(filename, 'rb') as wf:
+        if wf.getsampwidth() != 2 or wf.getnchannels() != recording.channels:
+            raise ValueError(f"{filename}: needs {recording.channels} channel int16 audio")
+        data = wf.readframes(wf.getnframes())
+    chunk = recording.frames_per_buffer * 2 * recording.channels
+    data += bytes(-len(data) % chunk)
+    period = recording.frames_per_buffer / recording.rate
+    next_time = time.time()
+    position = 0
+    while not stop_event.is_set():
+        next_time += period
+        if stop_event.wait(max(next_time - time.time(), 0)):
+            break
+        # capture time is the end of the buffer, like the PyAudio callback's
+        recording.write(data[position:position + chunk], next_time)
+        position = (position + chunk) % len(data)
+
+
+def run_satellite(args):
+    import client
+    import metrics
+    import recorder
+    import discovery
+
+    client.voice_gating = args.voice_gating
+    if args.id is not None:
+        client.satellite_id = args.id
+
+    if args.connect:
+        host, _, port = args.connect.rpartition(':')
+    else:
+        centrals = discovery.discover(args.discover_timeout)
+        centrals = [central for central in centrals if central.free]
+        if not centrals:
+            print("no central node found, use --connect HOST:PORT", file=sys.stderr)
+            return 1
+        host, port = centrals[0].address, centrals[0].port
+    status = client.connect(host, port)
+    if isinstance(status, str):
+        print(f"can't connect to {host}:{port}: {status}", file=sys.stderr)
+        return 1
+    print(f"satellite {client.satellite_id} connected to {host}:{port}, session {client.session_id:08x}", flush=True)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    filename = os.path.join(args.output_dir, f"audiomerge_satellite{client.satellite_id}.wav")
+    recording = recorder.Recording(filename, rate=RATE, frames_per_buffer=FRAMES_PER_BUFFER)
+    exporter = metrics.Exporter(args.metrics_port or None, log_interval=args.metrics_log or None)
+    stopping = threading.Event()
+    recording.start(microphone=args.wav is None)
+    if args.wav is not None:
+        threading.Thread(target=play_wav, args=(args.wav, recording, stopping), daemon=True).start()
+
+    wait_for_stop(args.duration, stopping)
+    stopping.set()
+    recording.stop()
+    recording.wait(args.drain_timeout)
+    client.disconnect()
+    exporter.stop()
+    streamer = recording.streamer
+    if streamer is not None:
+        print(f"sent {streamer.frames_sent} frames ({streamer.bytes_sent} bytes), "
+              f"{streamer.backlog_sent} from the backlog", flush=True)
+    return 0
+
+
+def run_gui(args):
+    # Kivy reads sys.argv when it is imported, it shouldn't see this script's arguments
+    sys.argv = sys.argv[:1]
+    import runpy
+    runpy.run_path(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'audiomerge-desktop-GUI.py'),
+                   run_name='__main__')
+    return 0
+
+
+def run_peaks(args):
+    import peaks
+    import session
+    for path in args.paths:
+        for source in peaks.review_sources(path):
+            started = time.perf_counter()
+            try:
+                if os.path.isdir(source):
+                    session.recover_track(source)
+                filename = peaks.build(source)
+            except (OSError, ValueError) as err:
+                print(f"{source}: {err}")
+                continue
+            print(f"{filename}: {time.perf_counter() - started:.2f} s")
+    return 0
+
+
+def run_recover(args):
+    import peaks
+    import session
+    for path in args.paths:
+        try:
+            recovered = session.recover(path)
+        except (OSError, ValueError) as err:
+            print(f"{path}: {err}")
+            continue
+        for directory, chunks in recovered.items():
+            print(f"{directory}: {chunks} chunks recovered")
+            if chunks:
+                # the peaks, if the track got as far as saving them, miss the recovered end
+                peaks.build(directory)
+    return 0
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="audiomerge central and satellite nodes")
+    nodes = parser.add_subparsers(dest='node', required=True)
+
+    central = nodes.add_parser('central', help="run a central node")
+    central.add_argument('--port', type=int, default=0, help="TCP port (default: a random free one)")
+    central.add_argument('--bind', default='', help="address to listen on (default: every interface)")
+    central.add_argument('--output-dir', default='.', help="where the session is recorded")
+    central.add_argument('--duration', type=float, default=0, help="seconds to run (default: until stopped)")
+    central.add_argument('--max-satellites', type=int, default=64)
+    central.add_argument('--no-live-mix', action='store_true', help="don't mix the satellites while recording")
+    central.add_argument('--no-wav-export', action='store_true', help="don't export every track as a WAV")
+    central.add_argument('--no-advertise', action='store_true', help="don't announce the node on the network")
+    central.add_argument('--metrics-port', type=int, default=9464,
+                         help="serve metrics on localhost:PORT/metrics (0: don't)")
+    central.add_argument('--metrics-log', type=float, default=30, help="seconds between metrics log lines (0: none)")
+    central.set_defaults(run=run_central)
+
+    satellite = nodes.add_parser('satellite', help="run a satellite node")
+    satellite.add_argument('--connect', metavar='HOST:PORT', help="central node (default: the first one discovered)")
+    satellite.add_argument('--discover-timeout', type=float, default=1.5)
+    satellite.add_argument('--id', type=int, help="satellite id (default: random)")
+    satellite.add_argument('--wav', help="stream this WAV file (looped) instead of the microphone")
+    satellite.add_argument('--output-dir', default='.', help="where the local recording and spool go")
+    satellite.add_argument('--duration', type=float, default=0, help="seconds to record (default: until stopped)")
+    satellite.add_argument('--drain-timeout', type=float, default=30,
+                           help="seconds to wait for the rest of the audio to be sent when stopping")
+    satellite.add_argument('--voice-gating', action='store_true', help="send silence as SILENCE runs")
+    satellite.add_argument('--metrics-port', type=int, default=0,
+                           help="serve metrics on localhost:PORT/metrics (default: don't)")
+    satellite.add_argument('--metrics-log', type=float, default=30, help="seconds between metrics log lines (0: none)")
+    satellite.set_defaults(run=run_satellite)
+
+    gui = nodes.add_parser('gui', help="start the desktop GUI")
+    gui.set_defaults(run=run_gui)
+
+    build = nodes.add_parser('peaks', help="build the waveform peaks of existing recordings")
+    build.add_argument('paths', nargs='+', metavar='PATH')
+    build.set_defaults(run=run_peaks)
+
+    recover = nodes.add_parser('recover', help="index what a crashed central node wrote after its last index sync")
+    recover.add_argument('paths', nargs='+', metavar='PATH', help="session directory or track directory")
+    recover.set_defaults(run=run_recover)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    return args.run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
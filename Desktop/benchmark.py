@@ -0,0 +1,344 @@
+''' Loopback load test of a central node and N simulated satellites.
+
+        python benchmark.py --satellites 8 --duration 20 --speed 1 --output results.json
+
+    every node runs in its own process, so CPU time and memory are measured per node.
+    the central node is the real server event loop; each satellite is the real capture
+    path (recorder.Recording with its ring buffer, WAV writer and AudioStreamer), fed by
+    FakePyAudio, a drop-in for pyaudio.PyAudio whose streams call the callback with
+    synthetic PCM at real time, or "speed" times faster.
+
+    the central node times every AUDIO frame from the capture of its first sample (the
+    satellite's timestamp, mapped to the central clock) to arrival, so a latency includes
+    the buffer's own duration. the report has its percentiles, the throughput, frames
+    lost (captured but never received) and late (arrived after the jitter buffer gave up
+    on them), CPU and peak RSS of every node, and how many times faster than real time
+    the session's tracks merge. it's written as JSON, so runs of two versions can be
+    compared, and summarized on stdout '''
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+import numpy as np
+
+import recorder
+
+# capture format, the same as the GUI's
+RATE = 44100
+FRAMES_PER_BUFFER = 1024
+
+
+class FakeStream:
+    ''' an input stream calling its callback with synthetic PCM from a thread, paced
+        like a sound card (faster with speed > 1) '''
+
+    def __init__(self, rate, channels, frames_per_buffer, stream_callback, speed=1.0, seed=0):
+        self.rate = rate
+        self.frames_per_buffer = frames_per_buffer
+        self.callback = stream_callback
+        self.speed = speed
+        self.buffers = 0
+        # a tone in bursts over low noise (speech-ish for the voice detector), one loop
+        # of it is computed up front so generating audio costs next to nothing
+        rng = np.random.default_rng(seed)
+        t = np.arange(rate * 2) / rate
+        tone = np.sin(2 * np.pi * (220 + (40 * seed) % 400) * t) * 6000 * (t % 2 < 1.2)
+        noise = rng.normal(0, 60, len(t))
+        loop = np.repeat((tone + noise).astype('<i2')[:, None], channels, axis=1)
+        self.pcm = loop.tobytes()
+        self.buffer_bytes = frames_per_buffer * channels * 2
+        self.pcm += self.pcm[:self.buffer_bytes]
+        self.active = False
+        self.thread = None
+
+    def run(self):
+        period = self.frames_per_buffer / self.rate / self.speed
+        next_time = time.perf_counter()
+        position = 0
+        while self.active:
+            next_time += period
+            delay = next_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            self.callback(self.pcm[position:position + self.buffer_bytes], self.frames_per_buffer, None, 0)
+            self.buffers += 1
+            position = (position + self.buffer_bytes) % (len(self.pcm) - self.buffer_bytes)
+
+    def start_stream(self):
+        self.active = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop_stream(self):
+        self.active = False
+        if self.thread is not None:
+            self.thread.join()
+
+    def is_active(self):
+        return self.active
+
+    def close(self):
+        self.stop_stream()
+
+
+class FakePyAudio:
+    ''' drop-in for pyaudio.PyAudio that opens FakeStreams, for recorder.Recording(audio=...) '''
+
+    def __init__(self, speed=1.0, seed=0):
+        self.speed = speed
+        self.seed = seed
+
+    def open(self, rate, channels, format=recorder.PA_INT16, input=True, frames_per_buffer=1024,
+             stream_callback=None, start=True):
+        stream = FakeStream(rate, channels, frames_per_buffer, stream_callback, self.speed, self.seed)
+        if start:
+            stream.start_stream()
+        return stream
+
+    def get_sample_size(self, format):
+        return 2
+
+    def terminate(self):
+        pass
+
+
+def usage():
+    ''' CPU seconds and peak resident memory (MB) of this process '''
+    ru = resource.getrusage(resource.RUSAGE_SELF)
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return {'cpu_seconds': ru.ru_utime + ru.ru_stime, 'peak_rss_mb': ru.ru_maxrss * scale / 2**20}
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = np.asarray(values) * 1000.0
+    p50, p90, p99, p999 = np.percentile(values, [50, 90, 99, 99.9])
+    return {'p50_ms': p50, 'p90_ms': p90, 'p99_ms': p99, 'p999_ms': p999, 'max_ms': float(values.max()),
+            'frames': len(values)}
+
+
+def run_central(args):
+    ''' central node worker: the server event loop, with every frame's latency recorded '''
+    import server
+    import protocol
+    import clocksync
+    server.output_dir = args.output_dir
+    server.live_mix = not args.no_live_mix
+    server.advertise = False
+    server.metrics_port = None
+    server.metrics_log_interval = None
+
+    latencies = []
+    received = {}
+    handle_frame = server.handle_frame
+
+    def timed_handle_frame(selector, conn, frame):
+        if frame.type in (protocol.AUDIO, protocol.SILENCE, protocol.BACKLOG):
+            clock = server.clocks.get(frame.satellite_id) or clocksync.ClockEstimator()
+            if frame.type != protocol.BACKLOG:
+                latencies.append(conn.last_seen - clock.to_local(frame.timestamp))
+            count = protocol.SILENCE_RUN.unpack(frame.payload)[0] if frame.type == protocol.SILENCE else 1
+            received.setdefault(frame.satellite_id, set()).update(range(frame.seq, frame.seq + count))
+        handle_frame(selector, conn, frame)
+    server.handle_frame = timed_handle_frame
+
+    # the tracks' jitter statistics, before close_tracks forgets them
+    track_states = {}
+    close_tracks = server.close_tracks
+
+    def close_and_keep_states():
+        for track in server.tracks.values():
+            track_states[track.satellite_id] = track.jitter.state()
+        close_tracks()
+    server.close_tracks = close_and_keep_states
+
+    server_socket = server.bind('127.0.0.1', 0)
+    server.listen(server_socket)
+    print(json.dumps({'port': server_socket.getsockname()[1]}), flush=True)
+
+    loop = threading.Thread(target=server.handle_client, args=(server_socket,), daemon=True)
+    started = time.perf_counter()
+    loop.start()
+    # the orchestrator closes stdin once every satellite is done
+    sys.stdin.read()
+    server.stop()
+    loop.join()
+    wall = time.perf_counter() - started
+
+    report = {
+        'wall_seconds': wall,
+        'latency': percentiles(latencies),
+        'frames_received': {str(sat): len(seqs) for sat, seqs in received.items()},
+        'late': sum(state['late'] for state in track_states.values()),
+        'concealed': sum(state['concealed'] for state in track_states.values()),
+        'loop_load': server.loop_load,
+    }
+    report.update(usage())
+    print(json.dumps(report), flush=True)
+    return 0
+
+
+def run_satellite(args):
+    ''' satellite worker: the GUI's capture path on a fake sound card, streaming to the central node '''
+    import client
+    client.satellite_id = args.id
+    client.voice_gating = args.voice_gating
+    status = client.connect('127.0.0.1', args.port)
+    if isinstance(status, str):
+        print(json.dumps({'error': status}), flush=True)
+        return 1
+
+    filename = os.path.join(args.output_dir, f"satellite{args.id}.wav")
+    recording = recorder.Recording(filename, rate=RATE, frames_per_buffer=FRAMES_PER_BUFFER,
+                                   audio=FakePyAudio(args.speed, seed=args.id))
+    recording.start()
+    time.sleep(args.duration / args.speed)
+    recording.stop()
+    drained = recording.wait(60)
+    client.disconnect()
+
+    streamer = recording.streamer
+    report = {
+        'id': args.id,
+        'drained': drained,
+        'frames_captured': recording.ring.written // (FRAMES_PER_BUFFER * 2),
+        'frames_sent': streamer.frames_sent,
+        'backlog_sent': streamer.backlog_sent,
+        'silent_sent': streamer.silent_sent,
+        'bytes_sent': streamer.bytes_sent,
+        'streamer_overruns': streamer.cursor.overruns,
+        'writer_overruns': recording.writer.cursor.overruns,
+    }
+    report.update(usage())
+    print(json.dumps(report), flush=True)
+    return 0
+
+
+def run_benchmark(args):
+    ''' starts the central node and the satellites, waits for them and writes the report '''
+    import merge
+    output_dir = args.output_dir or tempfile.mkdtemp(prefix='audiomerge_benchmark')
+    os.makedirs(output_dir, exist_ok=True)
+    script = os.path.abspath(__file__)
+    common = ['--output-dir', output_dir, '--speed', str(args.speed), '--duration', str(args.duration)]
+
+    central = subprocess.Popen([sys.executable, script, '--role', 'central'] + common +
+                               (['--no-live-mix'] if args.no_live_mix else []),
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+    port = json.loads(central.stdout.readline())['port']
+
+    satellites = [subprocess.Popen([sys.executable, script, '--role', 'satellite', '--port', str(port),
+                                    '--id', str(i + 1)] + common +
+                                   (['--voice-gating'] if args.voice_gating else []),
+                                   stdout=subprocess.PIPE, text=True)
+                  for i in range(args.satellites)]
+    started = time.perf_counter()
+    satellite_reports = [json.loads(satellite.communicate()[0].strip().splitlines()[-1]) for satellite in satellites]
+    central_report = json.loads(central.communicate('')[0].strip().splitlines()[-1])
+    wall = time.perf_counter() - started
+
+    captured = sum(report.get('frames_captured', 0) for report in satellite_reports)
+    received = sum(central_report['frames_received'].values())
+    audio_seconds = captured * FRAMES_PER_BUFFER / RATE
+
+    # merging the exported tracks, the way merge.py is run after a session
+    tracks = sorted(os.path.join(output_dir, name) for name in os.listdir(output_dir)
+                    if name.startswith('audiomerge_session') and '_satellite' in name and name.endswith('.wav'))
+    merge_report = None
+    if tracks:
+        started = time.perf_counter()
+        frames = merge.merge_files(tracks, os.path.join(output_dir, 'benchmark_merged.wav'))
+        elapsed = time.perf_counter() - started
+        merge_report = {'tracks': len(tracks), 'seconds': elapsed, 'audio_seconds': frames / RATE,
+                        'times_real_time': frames / RATE / elapsed if elapsed else None}
+
+    results = {
+        'config': {'satellites': args.satellites, 'duration': args.duration, 'speed': args.speed,
+                   'voice_gating': args.voice_gating, 'live_mix': not args.no_live_mix,
+                   'rate': RATE, 'frames_per_buffer': FRAMES_PER_BUFFER},
+        'wall_seconds': wall,
+        'latency': central_report['latency'],
+        'throughput': {
+            'audio_seconds_per_second': audio_seconds / wall,
+            'megabytes_per_second': sum(report.get('bytes_sent', 0) for report in satellite_reports) / wall / 2**20,
+        },
+        'frames': {
+            'captured': captured,
+            'received': received,
+            'dropped': captured - received,
+            'late': central_report['late'],
+            'concealed': central_report['concealed'],
+            'capture_overruns': sum(report.get('streamer_overruns', 0) + report.get('writer_overruns', 0)
+                                    for report in satellite_reports),
+        },
+        'central': {key: central_report[key] for key in ('cpu_seconds', 'peak_rss_mb', 'loop_load')},
+        'satellites': satellite_reports,
+        'merge': merge_report,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    print_summary(results)
+    if not args.output_dir and not args.keep:
+        shutil.rmtree(output_dir)
+    failed = any('error' in report or not report.get('drained') for report in satellite_reports)
+    return 1 if failed else 0
+
+
+def print_summary(results):
+    config, latency, frames = results['config'], results['latency'], results['frames']
+    print(f"{config['satellites']} satellites, {config['duration']} s of audio at {config['speed']}x real time")
+    if latency:
+        print(f"latency p50 {latency['p50_ms']:.1f} ms, p90 {latency['p90_ms']:.1f} ms, "
+              f"p99 {latency['p99_ms']:.1f} ms, max {latency['max_ms']:.1f} ms")
+    print(f"throughput {results['throughput']['audio_seconds_per_second']:.1f} audio seconds/s, "
+          f"{results['throughput']['megabytes_per_second']:.2f} MB/s")
+    print(f"frames captured {frames['captured']}, dropped {frames['dropped']}, late {frames['late']}, "
+          f"capture overruns {frames['capture_overruns']}")
+    satellites = results['satellites']
+    cpu = [report.get('cpu_seconds', 0) for report in satellites]
+    rss = [report.get('peak_rss_mb', 0) for report in satellites]
+    print(f"central cpu {results['central']['cpu_seconds']:.2f} s, rss {results['central']['peak_rss_mb']:.0f} MB; "
+          f"satellites cpu {np.mean(cpu):.2f} s, rss {np.mean(rss):.0f} MB (mean)")
+    if results['merge']:
+        print(f"merge of {results['merge']['tracks']} tracks: {results['merge']['times_real_time']:.0f}x real time")
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="loopback load test of a central node and simulated satellites")
+    parser.add_argument('--satellites', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=10, help="seconds of audio every satellite captures")
+    parser.add_argument('--speed', type=float, default=1.0, help="capture this many times faster than real time")
+    parser.add_argument('--voice-gating', action='store_true')
+    parser.add_argument('--no-live-mix', action='store_true')
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--output-dir', help="where the nodes write their files (default: a temporary directory)")
+    parser.add_argument('--keep', action='store_true', help="keep the temporary directory")
+    # used by the worker processes the benchmark starts
+    parser.add_argument('--role', choices=('benchmark', 'central', 'satellite'), default='benchmark',
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--id', type=int, help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.role == 'central':
+        return run_central(args)
+    if args.role == 'satellite':
+        return run_satellite(args)
+    return run_benchmark(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
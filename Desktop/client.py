@@ -1,28 +1,497 @@
+import os
+import time
+import random
 import socket
+import threading
+import codec
+import protocol
+import clocksync
+import metrics
+import spool
+import vad
 
-def connect(ip_address, port):
+# identifies this satellite to the central node, stays the same across reconnects
+satellite_id = random.getrandbits(31)
+
+# session id handed out by the central node in its WELCOME frame
+session_id = 0
+
+# socket connected to the central node, set by connect(), None while disconnected
+connection = None
+
+# (ip address, port) of the central node connect() was last called with, reconnects go there
+server_address = None
+
+# sequence number the central node expects next from this satellite, from its WELCOME
+resume_seq = 0
+
+# the central node pings every second, this long without hearing from it means the link is gone
+link_timeout = 5.0
+
+# backoff between reconnect attempts, doubling from the first to the second
+reconnect_delay = (0.5, 10.0)
+
+# guards connection against the receiver, the streamer and the reconnect thread
+connection_lock = threading.Lock()
+reconnecting = False
+
+# codecs offered to the central node in order of preference, empty to always send raw PCM
+codecs = [codec.RICE]
+
+# codec the central node picked for this connection
+codec_id = codec.RAW
+
+# send silent stretches as SILENCE runs instead of PCM (see vad.py)
+voice_gating = False
+
+# with the codec negotiated: "always" compress, or only while the central node is "busy"
+compression = 'always'
+
+# latest FLOW report from the central node: its level and (jitter depth, lag, load)
+flow_level = protocol.FLOW_OK
+flow_state = None
+
+# the streamer and the receiver thread both write to the connection,
+# whole batches of frames go out under this lock so they never interleave
+send_lock = threading.Lock()
+
+def connect(ip_address, port, timeout=5):
     '''
-    connects to server and returns the client socket
+    connects to server, introduces this satellite with a HELLO frame and
+    returns the client socket once the central node has answered
     '''
+    global connection, session_id, codec_id, resume_seq, server_address, flow_level
     try:
-        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # connecting to the server
-        client.connect((ip_address, int(port)))
+        client = socket.create_connection((ip_address, int(port)), timeout=timeout)
+        # audio frames are batched by the streamer, no need for Nagle on top of that
+        client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        client.sendall(protocol.encode(protocol.Frame(protocol.HELLO, satellite_id=satellite_id,
+                                                      payload=bytes(codecs))))
+
+        reader = protocol.FrameReader()
+        welcome = receive_frame(client, reader)
+        if welcome is None or welcome.type != protocol.WELCOME:
+            client.close()
+            raise protocol.ProtocolError("central node did not answer HELLO")
+        session_id = welcome.session_id
+        codec_id = welcome.flags
+        resume_seq = welcome.seq
+        flow_level = protocol.FLOW_OK
+
+        # sends and receives give up after link_timeout, so a dead link is noticed
+        client.settimeout(link_timeout)
+        with connection_lock:
+            connection = client
+            server_address = (ip_address, port)
+
+        # answering the central node's clock pings in the background
+        receiver = threading.Thread(target=receive_data, args=(client, reader), daemon=True)
+        receiver.start()
         return client
     except Exception as err:
         return str(err)
 
+# connections lost and won back, written under connection_lock / by the reconnect thread
+disconnects = metrics.counter('audiomerge_disconnects_total', "connections to the central node lost")
+reconnects = metrics.counter('audiomerge_reconnects_total', "successful reconnects to the central node")
+
+# set by disconnect() to the connection it is closing, so the receiver knows the central
+# node closing its side acknowledges our BYE rather than ending the link
+closing = None
+bye_acknowledged = threading.Event()
+
+# spools of takes the central node was sent completely, removed once it acknowledges our BYE
+delivered_spools = []
+
+def disconnect():
+    ''' says goodbye to the central node and closes the connection for good. only our
+        side is shut after the BYE: the central node reads everything up to it and then
+        closes its side, which the receiver waits for, so the end of the stream isn't
+        lost to a connection reset. returns True if the central node acknowledged '''
+    global server_address, closing
+    with connection_lock:
+        client = connection
+        # no reconnecting after this
+        server_address = None
+        closing = client
+    bye_acknowledged.clear()
+    if client is not None:
+        try:
+            with send_lock:
+                client.sendall(protocol.encode(protocol.Frame(protocol.BYE, session_id=session_id,
+                                                              satellite_id=satellite_id)))
+                client.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        else:
+            bye_acknowledged.wait(link_timeout)
+        connection_lost(client, retry=False)
+    acknowledged = bye_acknowledged.is_set()
+    # until the central node has acknowledged, the spools may be all there is of the takes' ends
+    while delivered_spools:
+        filename = delivered_spools.pop()
+        if acknowledged:
+            os.remove(filename)
+        else:
+            print(f"central node didn't acknowledge the end of the session, the audio is kept in {filename}")
+    return acknowledged
+
+def connection_lost(client, retry=True):
+    ''' forgets a connection that failed (whoever notices first, the receiver or the
+        streamer) and keeps reconnecting to the central node in the background '''
+    global connection, reconnecting
+    with connection_lock:
+        if connection is not client:
+            return
+        connection = None
+        client.close()
+        if retry:
+            disconnects.inc()
+        if not retry or reconnecting or server_address is None:
+            return
+        reconnecting = True
+    threading.Thread(target=reconnect, daemon=True).start()
+
+def reconnect():
+    ''' tries to connect to the last central node again until it works, waiting longer
+        after every failed attempt. returns the new socket, or None if server_address
+        was cleared meanwhile '''
+    global reconnecting
+    delay, max_delay = reconnect_delay
+    try:
+        while server_address is not None:
+            status = connect(*server_address)
+            if not isinstance(status, str):
+                reconnects.inc()
+                print(f"reconnected to central node, it resumes at frame {resume_seq}")
+                return status
+            # randomized so satellites that dropped together don't retry in lockstep
+            time.sleep(delay * random.uniform(0.5, 1.0))
+            delay = min(delay * 2, max_delay)
+    finally:
+        reconnecting = False
+
+def receive_frame(client, reader):
+    ''' blocks until one whole frame has arrived, returns None if the connection closed '''
+    frames = []
+    while not frames:
+        data = client.recv(65536)
+        if not data:
+            return None
+        frames = reader.feed(data)
+    return frames[0]
+
+def receive_data(client, reader):
+    ''' receives frames from the central node until the connection closes.
+        PINGs are answered right away with our own clock readings so the central node
+        can work out this satellite's clock offset and drift '''
+    global flow_level, flow_state
+    try:
+        while True:
+            data = client.recv(65536)
+            received = time.time()
+            if not data:
+                if closing is client:
+                    # the central node has read our BYE and everything before it
+                    bye_acknowledged.set()
+                    connection_lost(client, retry=False)
+                    return
+                break
+            for frame in reader.feed(data):
+                if closing is client:
+                    # our side is shut, whatever still comes in is only read to get to the end
+                    continue
+                if frame.type == protocol.PING:
+                    payload = clocksync.PONG.pack(frame.timestamp, received, time.time())
+                    pong = protocol.encode(protocol.Frame(protocol.PONG,
+                                                          session_id=session_id,
+                                                          satellite_id=satellite_id,
+                                                          payload=payload))
+                    with send_lock:
+                        client.sendall(pong)
+                elif frame.type == protocol.FLOW:
+                    if len(frame.payload) != protocol.FLOW_STATE.size:
+                        raise protocol.ProtocolError(f"{len(frame.payload)} byte FLOW payload, "
+                                                     f"expected {protocol.FLOW_STATE.size}")
+                    flow_state = protocol.FLOW_STATE.unpack(frame.payload)
+                    if frame.flags != flow_level:
+                        print(f"central node reports flow level {frame.flags} "
+                              f"(depth, lag, load: {flow_state[0]}, {flow_state[1]:.2f} s, {flow_state[2]:.0%})")
+                    flow_level = frame.flags
+                elif frame.type == protocol.BYE:
+                    # the central node ended the session, no point in coming back
+                    connection_lost(client, retry=False)
+                    return
+    except (OSError, protocol.ProtocolError) as err:
+        # after disconnect() the socket is closed under us, nothing was lost
+        if connection is client and closing is not client:
+            print(f"connection to central node lost: {err}")
+    connection_lost(client, retry=closing is not client)
+
 # recording state
 recording_active = False
 
-# receiving and sending data from and to the server
-def receive_send_data(client):
-    ''' recieves and sends data from and to the server '''
-    while True:
+class AudioStreamer:
+    ''' Streams captured audio to the central node while recording.
+
+        reads the capture RingBuffer through its own cursor and sends it as AUDIO frames of
+        "frames_per_chunk" samples. up to "batch" frames go out in one sendmsg call, with the
+        payloads as views of one reused buffer so nothing is copied per chunk (unless the
+        connection negotiated a codec, then every chunk is compressed on this thread).
+        the sequence number is the chunk's position in the recording and the timestamp its
+        capture time on this satellite's clock (taken from the ring's write times when the
+        callback passes them), so the central node can place every frame on the timeline.
+
+        every chunk goes to an append-only Spool before it is sent. while the connection is
+        down the streamer just keeps spooling; once reconnect() got through it carries on
+        with the live audio and uploads what the central node missed (from the seq its
+        WELCOME asked for) as BACKLOG frames, "backlog_batch" at a time and only while no
+        live audio is waiting, so the backlog never holds up the live stream. a spool the
+        central node was sent completely stays until disconnect() is acknowledged.
+
+        with voice_gating on every batch goes through a VoiceDetector first and its
+        silent chunks go out as one SILENCE run each instead of their PCM. the spool and
+        the backlog keep the PCM, silence costs little once it is compressed.
+
+        the central node's FLOW reports steer it: while it's busy audio goes out in
+        batches of "busy_batch" chunks, compressed, and the backlog waits; while it's
+        overloaded nothing is sent, the audio is only spooled and uploaded as backlog
+        once the central node has caught up '''
+
+    def __init__(self, sock, ring, start_time, rate=44100, channels=1, frames_per_chunk=1024, batch=8,
+                 spool_filename=None, backlog_batch=64, busy_batch=32):
+        self.sock = sock
+        self.ring = ring
+        self.cursor = ring.cursor(from_start=True)
+        self.start_time = start_time
+        self.rate = rate
+        self.channels = channels
+        self.frame_size = channels * protocol.SAMPLE_WIDTH[protocol.INT16]
+        self.chunk_bytes = frames_per_chunk * self.frame_size
+        self.batch = batch
+        self.busy_batch = max(busy_batch, batch)
+        self.buffer = bytearray(self.chunk_bytes * self.busy_batch)
+        self.running = True
+        # flow level the streamer is acting on, and the seq it stopped sending at when overloaded
+        self.level = protocol.FLOW_OK
+        self.paused_at = None
+
+        if spool_filename is None:
+            spool_filename = f"audiomerge_satellite{satellite_id}_{int(start_time)}.spool"
+        self.spool = spool.Spool(spool_filename, self.chunk_bytes)
+        # [next seq, end seq) ranges of spooled audio the central node is still missing
+        self.backlog = []
+        self.backlog_batch = backlog_batch
+
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.backlog_sent = 0
+        self.silent_sent = 0
+        self.error = None
+        self.codec_stats = codec.Stats(rate, self.frame_size)
+        self.vad = vad.VoiceDetector(rate, frames_per_chunk) if voice_gating else None
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        view = memoryview(self.buffer)
+        cursor = self.cursor
         try:
-            client.send('200'.encode('ascii'))
-        except Exception as err:
-            print(str(err))
-            client.close()
-        
-    
+            while True:
+                running = self.running
+                self.check_connection()
+                if not self.align():
+                    if not running:
+                        break
+                    cursor.wait(0.1)
+                    continue
+
+                self.check_flow()
+                # only whole chunks are sent, a trailing partial chunk waits for more audio
+                batch = self.batch if self.level == protocol.FLOW_OK else self.busy_batch
+                chunks = min(cursor.available() // self.chunk_bytes, batch)
+                if chunks < batch and self.level != protocol.FLOW_OK and running:
+                    # a loaded central node gets fewer, bigger batches
+                    cursor.ready.clear()
+                    cursor.ready.wait(0.1)
+                    continue
+                if not chunks:
+                    # the live stream is caught up, spare time goes to the backlog
+                    if self.upload_backlog():
+                        continue
+                    if not running:
+                        break
+                    cursor.wait(0.1)
+                    continue
+
+                position = cursor.position
+                n = cursor.read_into(view[:chunks * self.chunk_bytes])
+                if n:
+                    chunks = self.chunks(view, position, n)
+                    self.spool.append(chunks)
+                    active = self.vad.detect(view[:n]) if self.vad is not None else None
+                    if self.paused_at is None:
+                        self.send(protocol.AUDIO, chunks, active)
+        except OSError as err:
+            self.error = str(err)
+            print(f"spooling audio failed: {err}")
+        finally:
+            self.ring.remove_cursor(cursor)
+            # the spool is only worth keeping if the central node is still missing some of it
+            complete = self.sock is not None and not self.backlog and self.paused_at is None
+            self.spool.close()
+            if complete:
+                # sent, but only known to be received once disconnect() is acknowledged
+                delivered_spools.append(self.spool.filename)
+            else:
+                print(f"central node is missing audio, it is kept in {self.spool.filename}")
+
+    def align(self):
+        ''' after an overrun the cursor may land inside a chunk, skip to the next chunk
+            boundary so sequence numbers keep matching positions. returns False if there
+            isn't enough audio yet to do so '''
+        misalign = self.cursor.position % self.chunk_bytes
+        if misalign:
+            skip = self.chunk_bytes - misalign
+            if self.cursor.available() < skip:
+                return False
+            self.cursor.position += skip
+            self.cursor.lost_bytes += skip
+        return True
+
+    def chunks(self, view, position, n):
+        ''' splits n bytes of audio read from ring byte offset "position" into
+            (seq, timestamp, payload view) chunks '''
+        out = []
+        bytes_per_second = self.rate * self.frame_size
+        for offset in range(0, n, self.chunk_bytes):
+            timestamp = self.ring.time_at(position + offset, bytes_per_second)
+            if timestamp is None:
+                timestamp = self.start_time + (position + offset) / bytes_per_second
+            out.append(((position + offset) // self.chunk_bytes, timestamp,
+                        view[offset:offset + self.chunk_bytes]))
+        return out
+
+    def check_connection(self):
+        ''' picks up a connection reconnect() made and queues the audio the central node
+            missed meanwhile for upload '''
+        current = connection
+        if current is self.sock:
+            return
+        self.sock = current
+        if current is None:
+            return
+        # whatever wasn't sent since the last connection is covered by the WELCOME's seq
+        self.paused_at = None
+        live = self.cursor.position // self.chunk_bytes
+        if resume_seq > live:
+            # the central node's track is an older take, it has nothing of this one. the
+            # backlog's first frame opens the new take there, it goes out before any live
+            # frame, which would land in the old take otherwise
+            self.backlog = [[self.spool.first_seq or 0, live]]
+            self.upload_backlog(limit=1)
+        elif resume_seq < live:
+            self.backlog.append([resume_seq, live])
+
+    def check_flow(self):
+        ''' follows the central node's latest FLOW level: stops sending live audio when it's
+            overloaded and queues what it skipped for upload once it has recovered '''
+        if self.sock is None:
+            # check_connection() takes care of the gap once we're back
+            return
+        level = flow_level
+        if level == self.level:
+            return
+        live = self.cursor.position // self.chunk_bytes
+        if level == protocol.FLOW_OVERLOADED:
+            self.paused_at = live
+        elif self.paused_at is not None:
+            if self.paused_at < live:
+                self.backlog.append([self.paused_at, live])
+            self.paused_at = None
+        self.level = level
+
+    def upload_backlog(self, limit=None):
+        ''' sends the next batch of spooled audio the central node is missing (the next
+            "limit" chunks whatever the flow level, if given), returns True if the backlog
+            moved on '''
+        if self.sock is None or not self.backlog or (limit is None and self.level != protocol.FLOW_OK):
+            return False
+        first, end = self.backlog[0]
+        chunks = [chunk for chunk in self.spool.read(first, min(limit or self.backlog_batch, end - first))
+                  if chunk[0] < end]
+        if chunks:
+            if not self.send(protocol.BACKLOG, chunks):
+                return False
+            self.backlog_sent += len(chunks)
+            self.backlog[0][0] = chunks[-1][0] + 1
+        if not chunks or self.backlog[0][0] >= end:
+            self.backlog.pop(0)
+        return True
+
+    def send(self, type, chunks, active=None):
+        ''' frames and sends (seq, timestamp, payload) chunks as one batch, chunks that are
+            False in "active" (the VAD's verdict) as SILENCE runs. returns False if there is
+            no connection or it just failed, the chunks are in the spool anyway '''
+        if self.sock is None:
+            return False
+        buffers = []
+        sent = 0
+        silent = 0
+        for i, (seq, timestamp, payload) in enumerate(chunks):
+            if active is not None and not active[i]:
+                # a run is announced by its first chunk, the ones after it only extend it
+                if i and not active[i - 1]:
+                    continue
+                run = 1
+                while i + run < len(chunks) and not active[i + run]:
+                    run += 1
+                payload = protocol.SILENCE_RUN.pack(run, self.chunk_bytes // self.frame_size)
+                buffers.append(protocol.pack_header(protocol.SILENCE, len(payload),
+                                                    session_id=session_id,
+                                                    satellite_id=satellite_id,
+                                                    seq=seq,
+                                                    timestamp=timestamp,
+                                                    rate=self.rate,
+                                                    sample_format=protocol.INT16,
+                                                    channels=self.channels))
+                buffers.append(payload)
+                sent += len(payload)
+                silent += run
+                continue
+            flags = codec.RAW
+            if codec_id == codec.RICE and (compression == 'always' or self.level != protocol.FLOW_OK):
+                coded = codec.timed(codec.encode, payload, self.codec_stats)
+                # a chunk that doesn't get smaller (noise) goes out raw
+                if len(coded) < len(payload):
+                    payload, flags = coded, codec.RICE
+            buffers.append(protocol.pack_header(type, len(payload),
+                                                flags=flags,
+                                                session_id=session_id,
+                                                satellite_id=satellite_id,
+                                                seq=seq,
+                                                timestamp=timestamp,
+                                                rate=self.rate,
+                                                sample_format=protocol.INT16,
+                                                channels=self.channels))
+            buffers.append(payload)
+            sent += len(payload)
+        try:
+            with send_lock:
+                protocol.send_buffers(self.sock, buffers)
+        except OSError as err:
+            print(f"streaming to central node failed: {err}")
+            connection_lost(self.sock)
+            self.sock = None
+            return False
+        self.frames_sent += len(chunks)
+        self.silent_sent += silent
+        self.bytes_sent += sent
+        return True
+
+    def stop(self):
+        ''' sends what's left in the ring (and the backlog, while connected) and ends the
+            streaming thread, without waiting for it '''
+        self.running = False
+        self.cursor.ready.set()
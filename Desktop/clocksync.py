@@ -0,0 +1,208 @@
+''' Clock offset and drift estimation between satellites and the central node.
+
+    the central node pings every satellite with its own clock reading (t0), the satellite
+    answers with when it got the ping (t1) and when it answered (t2), and the central node
+    notes when the answer arrived (t3). the usual NTP arithmetic turns that into the
+    satellite clock's offset and the round trip delay; a line fitted through the least
+    delayed exchanges gives the offset at any moment and how fast it drifts.
+
+    separately every track fits its sample index against capture time, which gives the
+    sound card's real sample rate on the central node's clock. both end up in the track's
+    timing map so the merge step can place and stretch every track sample accurately '''
+
+import json
+import struct
+import collections
+
+# PONG payload: t0 echoed back, t1 ping received, t2 pong sent (satellite clock)
+PONG = struct.Struct('!ddd')
+
+
+def exchange(t0, t1, t2, t3):
+    ''' offset of the remote clock (remote - local) and round trip delay of one exchange '''
+    offset = ((t1 - t0) + (t2 - t3)) / 2
+    delay = (t3 - t0) - (t2 - t1)
+    return offset, delay
+
+
+def fit_line(points):
+    ''' least squares line through (x, y) points, returns (slope, intercept at mean x, mean x) '''
+    n = len(points)
+    mean_x = sum(x for x, y in points) / n
+    mean_y = sum(y for x, y in points) / n
+    sxx = sum((x - mean_x) ** 2 for x, y in points)
+    sxy = sum((x - mean_x) * (y - mean_y) for x, y in points)
+    slope = sxy / sxx if sxx else 0.0
+    return slope, mean_y, mean_x
+
+
+class ClockEstimator:
+    ''' tracks one remote clock against the local clock from ping exchanges. the live
+        estimate is fitted over the latest "window" exchanges, so it follows the drift as
+        it changes; older exchanges are kept thinned out to the least delayed one every
+        "history_interval" seconds, so the whole session can be fitted again at the end
+        (see whole_session) '''
+
+    def __init__(self, window=64, history_interval=30.0):
+        # (local time, offset, delay) of the latest exchanges
+        self.samples = collections.deque(maxlen=window)
+        # older exchanges, at most one per history_interval
+        self.history = []
+        self.history_interval = history_interval
+        self.offset = 0.0
+        self.drift = 0.0
+        self.reference = 0.0
+        self.delay = None
+
+    def add(self, t0, t1, t2, t3):
+        ''' adds one exchange (see module docstring for t0..t3) '''
+        offset, delay = exchange(t0, t1, t2, t3)
+        if self.samples.maxlen is not None and len(self.samples) == self.samples.maxlen:
+            self.keep(self.samples[0])
+        self.samples.append(((t0 + t3) / 2, offset, delay))
+        self.update()
+
+    def keep(self, sample):
+        ''' files an exchange leaving the window into the history '''
+        if self.history and sample[0] - self.history[-1][0] < self.history_interval:
+            if sample[2] < self.history[-1][2]:
+                self.history[-1] = sample
+            return
+        self.history.append(sample)
+
+    def update(self):
+        if not self.samples:
+            return
+        # exchanges with the lowest round trip delay are the least disturbed by queueing,
+        # fitting only the better half of them keeps wifi jitter out of the estimate
+        best = sorted(self.samples, key=lambda sample: sample[2])
+        best = best[:max(4, len(best) // 2)]
+        self.delay = best[0][2]
+        if len(best) < 2:
+            self.reference, self.offset = best[0][0], best[0][1]
+            self.drift = 0.0
+            return
+        self.drift, self.offset, self.reference = fit_line([(t, offset) for t, offset, delay in best])
+
+    def whole_session(self):
+        ''' an estimator fitted over every exchange since the start (the history and the
+            window), for converting timestamps from hours ago: the window's slope is only
+            measured over its last minute or so, extrapolated back over a long take its
+            error would grow with every hour '''
+        clock = ClockEstimator(window=None, history_interval=self.history_interval)
+        clock.samples.extend(self.history)
+        clock.samples.extend(self.samples)
+        clock.update()
+        return clock
+
+    def offset_at(self, local_time):
+        ''' estimated offset (remote - local) at a local time '''
+        return self.offset + self.drift * (local_time - self.reference)
+
+    def to_local(self, remote_time):
+        ''' converts a remote clock reading to the local clock '''
+        # remote = local + offset + drift * (local - reference), solved for local
+        return (remote_time - self.offset + self.drift * self.reference) / (1 + self.drift)
+
+    def state(self):
+        return {
+            'offset': self.offset,
+            'drift_ppm': self.drift * 1e6,
+            'reference': self.reference,
+            'delay': self.delay,
+            'exchanges': len(self.samples),
+            'history': len(self.history),
+        }
+
+
+class RateEstimator:
+    ''' fits sample index against capture time with running sums, which gives the real
+        sample rate of a sound card measured in another clock's seconds '''
+
+    def __init__(self, nominal_rate):
+        self.nominal_rate = nominal_rate
+        self.n = 0
+        self.origin = None
+        self.sx = self.sy = self.sxx = self.sxy = 0.0
+
+    def add(self, sample_index, time):
+        # sums are kept relative to the first point so they don't lose precision
+        if self.origin is None:
+            self.origin = (sample_index, time)
+        x = time - self.origin[1]
+        y = sample_index - self.origin[0]
+        self.n += 1
+        self.sx += x
+        self.sy += y
+        self.sxx += x * x
+        self.sxy += x * y
+
+    def rate(self):
+        ''' samples per second, the nominal rate until there is enough data '''
+        denominator = self.n * self.sxx - self.sx * self.sx
+        if self.n < 2 or denominator <= 0:
+            return float(self.nominal_rate)
+        return (self.n * self.sxy - self.sx * self.sy) / denominator
+
+    def start_time(self):
+        ''' fitted capture time of sample 0 '''
+        if self.origin is None:
+            return None
+        rate = self.rate()
+        # mean point lies on the fitted line, walking back from it to sample 0
+        mean_x = self.sx / self.n
+        mean_y = self.sy / self.n
+        return self.origin[1] + mean_x - (mean_y + self.origin[0]) / rate
+
+    def drift_ppm(self):
+        return (self.rate() / self.nominal_rate - 1) * 1e6
+
+
+class TrackTiming:
+    ''' timing map of one track, filled while the track is recorded and saved next to it.
+
+        capture timestamps arrive on the satellite clock, they are kept as they are and
+        only converted when the map is saved, with a clock model fitted over the whole
+        session's exchanges, so neither early (less accurate) estimates nor the latest
+        window's slope extrapolated back over hours leak into it '''
+
+    def __init__(self, nominal_rate, point_interval=1.0):
+        self.nominal_rate = nominal_rate
+        self.point_interval = point_interval
+        # (sample index, satellite capture time), one per point_interval
+        self.points = []
+
+    def add(self, sample_index, satellite_time):
+        if self.points and satellite_time - self.points[-1][1] < self.point_interval:
+            return
+        self.points.append((sample_index, satellite_time))
+
+    def build(self, clock, extra=None):
+        ''' timing map of the track on the central clock, using clock (a ClockEstimator)
+            fitted over the whole session. "extra" holds more track metadata to store
+            along (e.g. concealed gaps) '''
+        clock = clock.whole_session()
+        rate = RateEstimator(self.nominal_rate)
+        for sample_index, satellite_time in self.points:
+            rate.add(sample_index, clock.to_local(satellite_time))
+        timing = dict(extra or {})
+        timing.update({
+            'nominal_rate': self.nominal_rate,
+            # central clock time of the track's first sample and its real sample rate
+            'start_time': rate.start_time(),
+            'rate': rate.rate(),
+            'rate_drift_ppm': rate.drift_ppm(),
+            'clock': clock.state(),
+            'points': self.points,
+        })
+        return timing
+
+    def save(self, filename, clock, extra=None):
+        with open(filename, 'w') as f:
+            json.dump(self.build(clock, extra), f, indent=1)
+
+
+def load_timing(filename):
+    ''' reads a timing map saved by TrackTiming.save '''
+    with open(filename) as f:
+        return json.load(f)
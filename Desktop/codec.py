@@ -0,0 +1,189 @@
+''' Lossless compression of satellite audio frames.
+
+    every AUDIO payload is coded on its own (a lost or resent frame never breaks the
+    next one): the best of FLAC's fixed predictors (order 0, 1 or 2) turns samples into
+    small residuals, which are zigzag mapped and Rice coded. the unary quotients and the
+    k bit remainders go to two separate bit streams so both directions are plain NumPy
+    array operations, nothing loops over samples in python.
+
+    the codec is negotiated per connection: the satellite lists what it can send in its
+    HELLO payload and the central node picks one in the flags of its WELCOME. AUDIO frames
+    carry the codec they were coded with in their flags, a frame that wouldn't get
+    smaller is sent RAW '''
+
+import time
+import struct
+import numpy as np
+
+import protocol
+
+# codec ids, as used in HELLO payloads and AUDIO frame flags
+RAW = 0
+RICE = 1
+
+SUPPORTED = (RAW, RICE)
+
+# predictor order, rice parameter, sample count, unary stream length in bytes
+HEADER = struct.Struct('<BBII')
+
+
+def residuals(samples, order):
+    ''' fixed predictor residuals of int16 samples, as int32 '''
+    x = samples.astype(np.int32)
+    if order == 0:
+        return x
+    if order == 1:
+        return x[1:] - x[:-1]
+    return x[2:] - 2 * x[1:-1] + x[:-2]
+
+
+def encode(payload):
+    ''' codes one int16 PCM payload, returns the coded bytes (possibly bigger than the input,
+        the caller decides whether to send it) '''
+    samples = np.frombuffer(payload, dtype='<i2')
+    n = len(samples)
+
+    # picking the predictor with the smallest residuals for this frame
+    best = None
+    for order in (0, 1, 2):
+        if n <= order:
+            break
+        e = residuals(samples, order)
+        cost = int(np.abs(e).sum())
+        if best is None or cost < best[0]:
+            best = (cost, order, e)
+    if best is None:
+        return HEADER.pack(0, 0, n, 0) + bytes(payload)
+    cost, order, e = best
+
+    # zigzag: 0, -1, 1, -2, 2 ... -> 0, 1, 2, 3, 4 ...
+    u = ((e << 1) ^ (e >> 31)).astype(np.uint32)
+    mean = cost * 2 / max(len(u), 1)
+    k = max(int(np.log2(mean * 0.69 + 1)), 0) if mean else 0
+
+    quotients = u >> k
+    # unary stream: q zero bits and a closing one bit per residual
+    ends = np.cumsum(quotients.astype(np.int64) + 1) - 1
+    total = int(ends[-1]) + 1 if len(ends) else 0
+    unary = np.zeros(total, dtype=np.uint8)
+    unary[ends] = 1
+    unary = np.packbits(unary)
+
+    # remainder stream: k bits per residual, most significant first
+    if k:
+        shifts = np.arange(k - 1, -1, -1, dtype=np.uint32)
+        bits = ((u[:, None] >> shifts) & 1).astype(np.uint8)
+        remainders = np.packbits(bits.ravel())
+    else:
+        remainders = np.zeros(0, dtype=np.uint8)
+
+    warmup = samples[:order].astype('<i2')
+    return b''.join((HEADER.pack(order, k, n, len(unary)), warmup.tobytes(),
+                     unary.tobytes(), remainders.tobytes()))
+
+
+# encode() never needs more than this many bytes per sample (k bits of remainder, at most
+# 18, and a few unary bits on average), decoding bigger payloads would only waste memory
+MAX_CODED_BYTES_PER_SAMPLE = 4
+
+
+def decode(data, max_samples=None):
+    ''' inverse of encode(), returns the int16 PCM payload as bytes. data that can't
+        have come from encode() (truncated, bad header, more than "max_samples" samples)
+        raises protocol.ProtocolError before anything its size depends on is allocated '''
+    if len(data) < HEADER.size:
+        raise protocol.ProtocolError(f"{len(data)} byte RICE payload, shorter than its header")
+    order, k, n, unary_length = HEADER.unpack_from(data)
+    if n == 0:
+        return b''
+    if order > 2 or n < order or k > 32:
+        raise protocol.ProtocolError(f"bad RICE header: order {order}, k {k}, {n} samples")
+    if 2 * n > protocol.MAX_PAYLOAD or (max_samples is not None and n > max_samples):
+        raise protocol.ProtocolError(f"RICE payload of {n} samples is too large")
+    if len(data) > HEADER.size + MAX_CODED_BYTES_PER_SAMPLE * n:
+        raise protocol.ProtocolError(f"{len(data)} byte RICE payload for {n} samples")
+    offset = HEADER.size
+    if offset + 2 * order + unary_length > len(data):
+        raise protocol.ProtocolError("RICE payload truncated")
+    warmup = np.frombuffer(data, dtype='<i2', count=order, offset=offset).astype(np.int64)
+    offset += 2 * order
+    count = n - order
+
+    unary = np.unpackbits(np.frombuffer(data, dtype=np.uint8, count=unary_length, offset=offset))
+    offset += unary_length
+    ends = np.flatnonzero(unary)
+    if len(ends) < count:
+        raise protocol.ProtocolError(f"RICE payload has {len(ends)} of {count} residuals")
+    ends = ends[:count]
+    quotients = np.diff(ends, prepend=-1) - 1
+
+    if k:
+        if len(data) - offset < (count * k + 7) // 8:
+            raise protocol.ProtocolError("RICE payload truncated")
+        remainder_bits = np.unpackbits(np.frombuffer(data, dtype=np.uint8, offset=offset))[:count * k]
+        weights = (1 << np.arange(k - 1, -1, -1)).astype(np.int64)
+        remainders = remainder_bits.reshape(count, k).astype(np.int64) @ weights
+    else:
+        remainders = 0
+
+    u = (quotients.astype(np.int64) << k) | remainders
+    e = (u >> 1) ^ -(u & 1)
+
+    # undoing the predictor: every order is one running sum
+    if order == 0:
+        x = e
+    elif order == 1:
+        x = np.concatenate((warmup, warmup[0] + np.cumsum(e)))
+    else:
+        slopes = (warmup[1] - warmup[0]) + np.cumsum(e)
+        x = np.concatenate((warmup, warmup[1] + np.cumsum(slopes)))
+    return x.astype('<i2').tobytes()
+
+
+def choose(offered, accepted=SUPPORTED):
+    ''' picks the codec for a connection: the first one the satellite offered that we accept '''
+    for codec in offered:
+        if codec in accepted:
+            return codec
+    return RAW
+
+
+class Stats:
+    ''' compression ratio and cpu cost per second of audio, for one side of a connection '''
+
+    def __init__(self, rate=44100, sample_width=2):
+        self.bytes_per_second = rate * sample_width
+        self.raw_bytes = 0
+        self.coded_bytes = 0
+        self.cpu_seconds = 0.0
+
+    def add(self, raw_bytes, coded_bytes, cpu_seconds):
+        self.raw_bytes += raw_bytes
+        self.coded_bytes += coded_bytes
+        self.cpu_seconds += cpu_seconds
+
+    @property
+    def ratio(self):
+        return self.raw_bytes / self.coded_bytes if self.coded_bytes else 1.0
+
+    @property
+    def cpu_per_audio_second(self):
+        ''' cpu seconds spent per second of audio, 0.01 means 1 % of a core per stream '''
+        audio_seconds = self.raw_bytes / self.bytes_per_second
+        return self.cpu_seconds / audio_seconds if audio_seconds else 0.0
+
+    def state(self):
+        return {'ratio': self.ratio, 'cpu_per_audio_second': self.cpu_per_audio_second,
+                'raw_bytes': self.raw_bytes, 'coded_bytes': self.coded_bytes}
+
+
+def timed(function, data, stats, *args):
+    ''' runs encode or decode on data (and args) and accounts it in stats, returns the result '''
+    start = time.thread_time()
+    result = function(data, *args)
+    elapsed = time.thread_time() - start
+    if function is encode:
+        stats.add(len(data), min(len(result), len(data)), elapsed)
+    else:
+        stats.add(len(result), len(data), elapsed)
+    return result
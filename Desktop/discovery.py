@@ -0,0 +1,169 @@
+''' Zero configuration discovery of central nodes on the local network.
+
+    a running central node sends a small UDP beacon every "interval" seconds, both as a
+    broadcast and to a multicast group (networks that filter one usually pass the other).
+    the beacon carries the TCP port satellites connect to, the session id, how many
+    satellites are connected and how many more it takes, and the host name to show.
+    the central node's address is the source address of the datagram, which is right
+    whichever interface it went out on.
+
+    satellites run a Listener that keeps the list of centrals heard from lately, so the
+    client screen can offer them as one tap choices; typing the address by hand still
+    works when nothing is found (e.g. a network that blocks broadcasts) '''
+
+import time
+import socket
+import struct
+import threading
+
+MAGIC = b'AMRD'
+VERSION = 1
+
+# UDP port the beacons are sent to and the multicast group they're also sent to
+DISCOVERY_PORT = 47811
+MULTICAST_GROUP = '239.255.77.11'
+
+# magic, version, TCP port, session id, satellites connected, free slots, name length
+BEACON = struct.Struct('!4sBHIHHB')
+
+
+class Central:
+    ''' one central node heard on the network '''
+    __slots__ = ('address', 'port', 'session_id', 'satellites', 'free', 'name', 'last_seen')
+
+    def __init__(self, address, port, session_id, satellites, free, name, last_seen):
+        self.address = address
+        self.port = port
+        self.session_id = session_id
+        self.satellites = satellites
+        self.free = free
+        self.name = name
+        self.last_seen = last_seen
+
+    def __repr__(self):
+        return (f"Central({self.name} at {self.address}:{self.port}, session {self.session_id:08x}, "
+                f"{self.satellites} satellites, {self.free} free)")
+
+
+def pack_beacon(port, session_id, satellites, free, name):
+    name = name.encode('utf-8')[:255]
+    return BEACON.pack(MAGIC, VERSION, port, session_id, min(satellites, 0xffff), min(free, 0xffff),
+                       len(name)) + name
+
+
+def unpack_beacon(data, address, now):
+    ''' decodes a beacon, returns a Central or None if the datagram isn't one '''
+    if len(data) < BEACON.size:
+        return None
+    magic, version, port, session_id, satellites, free, length = BEACON.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        return None
+    name = data[BEACON.size:BEACON.size + length].decode('utf-8', 'replace')
+    return Central(address[0], port, session_id, satellites, free, name or address[0], now)
+
+
+class Beacon:
+    ''' announces a central node until stop() is called.
+
+        "state" is called before every beacon and returns (session id, satellites
+        connected, free slots), so the beacon always tells the current numbers '''
+
+    def __init__(self, port, state, interval=0.5, name=None):
+        self.port = port
+        self.state = state
+        self.interval = interval
+        self.name = name or socket.gethostname()
+        self.stop_event = threading.Event()
+        self.sent = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+        try:
+            while not self.stop_event.is_set():
+                datagram = pack_beacon(self.port, *self.state(), self.name)
+                for destination in (('<broadcast>', DISCOVERY_PORT), (MULTICAST_GROUP, DISCOVERY_PORT)):
+                    try:
+                        sock.sendto(datagram, destination)
+                        self.sent += 1
+                    except OSError:
+                        # no route for this one (e.g. no network at all), the other may work
+                        pass
+                self.stop_event.wait(self.interval)
+        finally:
+            sock.close()
+
+    def stop(self):
+        self.stop_event.set()
+
+
+class Listener:
+    ''' collects beacons in the background. centrals() lists the ones heard within the
+        last "expiry" seconds, sorted by name '''
+
+    def __init__(self, expiry=3.0):
+        self.expiry = expiry
+        self.found = {}
+        self.lock = threading.Lock()
+        self.error = None
+        self.started = time.time()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # several apps on one machine can listen at once, every one gets every beacon
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            try:
+                self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            except OSError:
+                pass
+        self.sock.bind(('', DISCOVERY_PORT))
+        try:
+            membership = struct.pack('4s4s', socket.inet_aton(MULTICAST_GROUP), socket.inet_aton('0.0.0.0'))
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        except OSError:
+            # no multicast capable interface, broadcasts still arrive
+            pass
+        self.sock.settimeout(0.25)
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            while self.running:
+                try:
+                    data, address = self.sock.recvfrom(1024)
+                except socket.timeout:
+                    continue
+                central = unpack_beacon(data, address, time.time())
+                if central is not None:
+                    with self.lock:
+                        # the same beacon arrives twice (broadcast and multicast)
+                        self.found[(central.address, central.port)] = central
+        except OSError as err:
+            if self.running:
+                self.error = str(err)
+        finally:
+            self.sock.close()
+
+    def centrals(self):
+        now = time.time()
+        with self.lock:
+            for key in [key for key, central in self.found.items() if now - central.last_seen > self.expiry]:
+                del self.found[key]
+            return sorted(self.found.values(), key=lambda central: central.name)
+
+    def stop(self):
+        self.running = False
+
+
+def discover(timeout=1.0):
+    ''' listens for "timeout" seconds and returns the centrals heard, for scripts '''
+    listener = Listener()
+    try:
+        time.sleep(timeout)
+        return listener.centrals()
+    finally:
+        listener.stop()
@@ -0,0 +1,187 @@
+''' Per satellite jitter buffer on the central node.
+
+    wifi jitter and retransmit stalls make AUDIO frames arrive in bursts, with gaps and
+    out of order. frames are held by sequence number and released strictly in order; when
+    the next frame is missing the buffer waits up to an adaptive target delay (derived from
+    the measured arrival jitter, like RFC 3550) for it before concealing it: short gaps are
+    bridged by interpolating between the neighbouring samples, longer ones become silence
+    with short fades so they don't click. every concealed gap is recorded, and taken out
+    again where the satellite's spooled backlog fills it in later '''
+
+import bisect
+import numpy as np
+
+
+class JitterBuffer:
+    ''' holds one satellite's frames until they can be released in order '''
+
+    def __init__(self, chunk_bytes, first_seq=0, min_delay=0.05, max_delay=2.0, max_frames=256,
+                 frame_rate=None, max_lead=2500, started=None, interpolate_frames=2, fade_samples=220):
+        self.chunk_bytes = chunk_bytes
+        self.chunk_samples = chunk_bytes // 2
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        # hard cap on held frames, past it gaps are concealed without waiting
+        self.max_frames = max_frames
+        # frames per second and how many frames past the time since the first frame (or
+        # "started", when the recording is known to be older) a seq may lead by: a frame
+        # further along than that (a corrupt or forged seq) would have everything up to it
+        # concealed in one go, it's dropped instead. a gap the session really went through
+        # (an outage, however long) always fits
+        self.frame_rate = frame_rate
+        self.max_lead = max_lead
+        self.first_seq = first_seq
+        self.started = started
+        self.interpolate_frames = interpolate_frames
+        self.fade_samples = min(fade_samples, self.chunk_samples)
+
+        # seq -> (payload, arrival time, capture timestamp), the payload is None for a
+        # chunk the satellite reported as silent
+        self.frames = {}
+        self.next_seq = first_seq
+        self.last_sample = 0
+        self.silence = bytes(chunk_bytes)
+
+        # interarrival jitter estimate, in seconds
+        self.jitter = 0.0
+        self.last_transit = None
+        self.target_delay = min_delay
+
+        self.late = 0
+        self.duplicates = 0
+        self.out_of_range = 0
+        self.concealed = 0
+        self.recovered = 0
+        # (first seq, frame count) of every concealed gap
+        self.gaps = []
+
+    @property
+    def depth(self):
+        return len(self.frames)
+
+    def push(self, frame, arrival):
+        ''' holds a frame until it can be released in order, returns False if it was dropped '''
+        # transit time differences between frames are the jitter, the clock offset cancels out
+        transit = arrival - frame.timestamp
+        if self.last_transit is not None:
+            self.jitter += (abs(transit - self.last_transit) - self.jitter) / 16
+            self.target_delay = min(max(self.min_delay, 4 * self.jitter), self.max_delay)
+        self.last_transit = transit
+
+        if frame.seq < self.next_seq:
+            # its place on the timeline has already been written (or concealed)
+            self.late += 1
+            return False
+        if frame.seq in self.frames:
+            self.duplicates += 1
+            return False
+        if not self.in_range(frame.seq, arrival):
+            return False
+        self.frames[frame.seq] = (frame.payload, arrival, frame.timestamp)
+        return True
+
+    def in_range(self, seq, arrival):
+        ''' False (and counted) if seq is further along than the time since the first
+            frame arrived can explain '''
+        if self.started is None:
+            self.started = arrival
+        if self.frame_rate is None:
+            return True
+        if seq - self.first_seq > self.max_lead + (arrival - self.started) * self.frame_rate:
+            self.out_of_range += 1
+            return False
+        return True
+
+    def hold(self, frame, arrival):
+        ''' like push() but for a frame uploaded late on purpose (spooled while the satellite
+            was offline), which says nothing about network jitter '''
+        if frame.seq < self.next_seq or frame.seq in self.frames:
+            self.duplicates += 1
+            return False
+        if not self.in_range(frame.seq, arrival):
+            return False
+        self.frames[frame.seq] = (frame.payload, arrival, frame.timestamp)
+        return True
+
+    def fill(self, seq):
+        ''' marks one concealed frame as recovered after all, returns False if seq wasn't
+            concealed (it was written from a real frame already) '''
+        i = bisect.bisect_right(self.gaps, (seq, float('inf'))) - 1
+        if i < 0:
+            return False
+        first, count = self.gaps[i]
+        if seq >= first + count:
+            return False
+        # the gap splits around the recovered frame
+        self.gaps[i:i + 1] = [gap for gap in ((first, seq - first), (seq + 1, first + count - seq - 1))
+                              if gap[1] > 0]
+        self.concealed -= 1
+        self.recovered += 1
+        return True
+
+    def pop(self, now, flush=False):
+        ''' releases everything that is ready, in order, as a list of
+            (seq, payload or None if silent, capture timestamp or None if concealed) '''
+        out = []
+        frames = self.frames
+        while frames:
+            entry = frames.pop(self.next_seq, None)
+            if entry is not None:
+                payload, arrival, timestamp = entry
+                out.append((self.next_seq, payload, timestamp))
+                self.next_seq += 1
+                if payload is None:
+                    self.last_sample = 0
+                elif len(payload) >= 2:
+                    self.last_sample = int.from_bytes(payload[-2:], 'little', signed=True)
+                continue
+
+            # the next frame is missing, waiting for it as long as the oldest held frame allows
+            oldest = min(frames)
+            waited = now - frames[oldest][1]
+            if not (flush or len(frames) > self.max_frames or waited >= self.target_delay):
+                break
+            count = oldest - self.next_seq
+            out.extend(self.conceal(count, frames[oldest][0]))
+            self.gaps.append((self.next_seq, count))
+            self.concealed += count
+            self.next_seq = oldest
+        return out
+
+    def conceal(self, count, following):
+        ''' fill for "count" missing frames before the frame holding "following" '''
+        first = self.next_seq
+        after = 0
+        if following is not None and len(following) >= 2:
+            after = int.from_bytes(following[:2], 'little', signed=True)
+        if count <= max(self.interpolate_frames, 1):
+            # short gap: a straight line from the last sample we have to the next one
+            samples = count * self.chunk_samples
+            fill = np.linspace(self.last_sample, after, samples + 2)[1:-1]
+            fill = np.rint(fill).astype('<i2').tobytes()
+            return [(first + i, fill[i * self.chunk_bytes:(i + 1) * self.chunk_bytes], None)
+                    for i in range(count)]
+
+        # long gap: silence, fading out of the last sample and into the next one
+        fade = self.fade_samples
+        fade_out = np.zeros(self.chunk_samples)
+        fade_out[:fade] = np.linspace(self.last_sample, 0, fade + 1)[1:]
+        fade_in = np.zeros(self.chunk_samples)
+        fade_in[-fade:] = np.linspace(0, after, fade + 1)[:-1]
+        out = [(first, np.rint(fade_out).astype('<i2').tobytes(), None)]
+        out.extend((first + i, self.silence, None) for i in range(1, count - 1))
+        out.append((first + count - 1, np.rint(fade_in).astype('<i2').tobytes(), None))
+        return out
+
+    def state(self):
+        return {
+            'depth': self.depth,
+            'target_delay': self.target_delay,
+            'jitter': self.jitter,
+            'late': self.late,
+            'duplicates': self.duplicates,
+            'out_of_range': self.out_of_range,
+            'concealed': self.concealed,
+            'recovered': self.recovered,
+            'gaps': len(self.gaps),
+        }
@@ -0,0 +1,172 @@
+''' Live incremental mix on the central node.
+
+    every track feeds the PCM its jitter buffer releases into a Source placed on the session
+    timeline (central clock, sample 0 is the moment the earliest track started). the mixer
+    appends blocks to a rolling merged WAV as soon as every active source has covered
+    them, or once a block is "latency" seconds overdue, then a source that hasn't caught up
+    counts as silence for it. satellites can join at any point (their source starts where
+    their first sample lands) and leave (their source just ends), memory is bounded by the
+    per source cap, and the mix is done seconds after the last track stops, waveform
+    peaks (see peaks.py) included '''
+
+import wave
+import collections
+import numpy as np
+
+import merge
+import peaks
+
+
+class Source:
+    ''' one track's PCM on the session timeline, waiting to be mixed '''
+
+    def __init__(self, offset, max_samples):
+        self.offset = offset
+        self.max_samples = max_samples
+        # (timeline position, int16 samples) in order, contiguous
+        self.chunks = collections.deque()
+        self.buffered = 0
+        # timeline position just past the last sample received
+        self.end = offset
+        self.ended = False
+        self.dropped = 0
+
+    def append(self, samples):
+        self.chunks.append((self.end, samples))
+        self.end += len(samples)
+        self.buffered += len(samples)
+        # the cap only bites if the mixer stopped consuming, the oldest audio goes first
+        while self.buffered > self.max_samples and len(self.chunks) > 1:
+            start, old = self.chunks.popleft()
+            self.buffered -= len(old)
+            self.dropped += len(old)
+
+    def shift(self, samples):
+        ''' moves the source "samples" later on the timeline '''
+        self.offset += samples
+        self.end += samples
+        self.chunks = collections.deque((position + samples, chunk) for position, chunk in self.chunks)
+
+    def read(self, start, count, out):
+        ''' adds this source's samples in [start, start + count) to "out" (float32),
+            and forgets everything before start + count '''
+        end = start + count
+        while self.chunks:
+            position, samples = self.chunks[0]
+            first = max(position, start)
+            last = min(position + len(samples), end)
+            if last > first:
+                out[first - start:last - start] += samples[first - position:last - position]
+            if position + len(samples) <= end:
+                self.chunks.popleft()
+                self.buffered -= len(samples)
+            else:
+                if position < end:
+                    # keeping only the part that hasn't been mixed yet
+                    kept = samples[end - position:]
+                    self.chunks[0] = (end, kept)
+                    self.buffered -= len(samples) - len(kept)
+                break
+
+
+class LiveMixer:
+    ''' mixes the sources into a rolling WAV file as their audio arrives '''
+
+    def __init__(self, filename, rate=44100, block_size=4096, latency=2.0, max_buffered=10.0):
+        self.filename = filename
+        self.rate = rate
+        self.block_size = block_size
+        self.latency = latency
+        self.max_samples = int(max_buffered * rate)
+        self.sources = {}
+        # central clock time of timeline sample 0, set by the earliest source
+        self.origin = None
+        # timeline position up to which the mix has been written
+        self.position = 0
+        self.rng = np.random.default_rng()
+        self.mix = np.zeros(block_size, dtype=np.float32)
+        self.blocks_mixed = 0
+
+        self.wf = wave.open(filename, 'wb')
+        self.wf.setnchannels(1)
+        self.wf.setsampwidth(2)
+        self.wf.setframerate(rate)
+        self.peaks = peaks.PeakBuilder(rate)
+
+    def add_source(self, key, start_time):
+        ''' registers a track whose first sample was captured at start_time (central clock).
+            a track that started before the timeline does while nothing has been mixed yet
+            moves the timeline's start back to it; once mixing has begun, whatever of it lies
+            before the mix position is left out '''
+        if self.origin is None:
+            self.origin = start_time
+        offset = int(round((start_time - self.origin) * self.rate))
+        if offset < 0 and not self.position:
+            for source in self.sources.values():
+                source.shift(-offset)
+            self.origin = start_time
+            offset = 0
+        self.sources[key] = Source(offset, self.max_samples)
+        return self.sources[key]
+
+    def feed(self, key, payload):
+        ''' appends a track's next int16 PCM (released in order by its jitter buffer) '''
+        source = self.sources.get(key)
+        if source is not None:
+            source.append(np.frombuffer(payload, dtype='<i2'))
+
+    def end_source(self, key):
+        ''' the track stopped, the mixer no longer waits for it once its audio is mixed '''
+        source = self.sources.get(key)
+        if source is not None:
+            source.ended = True
+
+    def tick(self, now, flush=False):
+        ''' mixes and writes everything that is ready, "now" is the central clock.
+            flush=True mixes everything received, without waiting for anyone '''
+        if self.origin is None:
+            return
+        ends = [source.end for source in self.sources.values()]
+        waiting = [source.end for source in self.sources.values() if not source.ended]
+        if flush or not waiting:
+            limit = max(ends, default=0)
+        else:
+            # everyone still recording has covered this far, and everything up to "overdue"
+            # gets mixed anyway, a source that hasn't caught up by then counts as silence
+            overdue = int((now - self.latency - self.origin) * self.rate)
+            limit = max(min(waiting), overdue)
+        while self.position < limit:
+            self.mix_block(min(self.block_size, limit - self.position))
+
+        # forgetting sources that ended and have nothing left to mix
+        for key in [key for key, source in self.sources.items()
+                    if source.ended and source.end <= self.position]:
+            del self.sources[key]
+
+    def mix_block(self, count):
+        mix = self.mix[:count]
+        mix[:] = 0
+        for source in self.sources.values():
+            source.read(self.position, count, mix)
+        mix *= 1.0 / 32768.0
+        block = merge.dither_to_int16(merge.soft_limit(mix), self.rng)
+        self.wf.writeframesraw(block.tobytes())
+        self.peaks.add(block)
+        self.position += count
+        self.blocks_mixed += 1
+
+    def close(self):
+        ''' mixes whatever is left and finishes the WAV header '''
+        for source in self.sources.values():
+            source.ended = True
+        self.tick(0.0, flush=True)
+        self.wf.close()
+        self.peaks.save(peaks.peaks_filename(self.filename))
+
+    def state(self):
+        return {
+            'position': self.position / self.rate,
+            'sources': len(self.sources),
+            'blocks_mixed': self.blocks_mixed,
+            'buffered': {str(key): source.buffered / self.rate for key, source in self.sources.items()},
+        }
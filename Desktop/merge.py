@@ -0,0 +1,440 @@
+''' Mixdown engine, merges N recorded satellite tracks into one output.
+
+    every track is placed on a common timeline by its offset (and stretched by its
+    real sample rate when a timing map says it drifted), then mixed block by block:
+    int16 -> float32, per track gain, sum (or one channel per track, or the best
+    microphone of every short segment), soft limiting
+    and TPDF dither back to int16. all the work happens on whole NumPy blocks,
+    nothing loops over samples in python '''
+
+import os
+import json
+import mmap
+import wave
+import struct
+import numpy as np
+
+import align
+import session
+import clocksync
+import metrics
+import peaks
+
+# samples per processing block, about 3 seconds at 44.1 kHz (0.5 MB of float32 per track)
+BLOCK_SIZE = 1 << 17
+
+
+class Track:
+    ''' one input of the mix: int16 samples, where they start on the output timeline
+        (in output samples), their gain and how many of their samples make one second
+        of output (ratio, 1.0 unless the sound card drifted) '''
+
+    def __init__(self, samples, offset=0, gain=1.0, ratio=1.0, name=None):
+        self.samples = samples
+        self.offset = offset
+        self.gain = gain
+        self.ratio = ratio
+        self.name = name
+        # bytes at the start of a memmapped track already given back to the OS
+        self.released = 0
+
+    @property
+    def end(self):
+        ''' output sample index just past this track's last sample '''
+        return self.offset + int(len(self.samples) / self.ratio)
+
+    def read(self, start, count, out):
+        ''' writes this track's contribution to output samples [start, start + count) into
+            "out" (float32, zeroed where the track has no audio) '''
+        out[:] = 0
+        first = max(start, self.offset)
+        last = min(start + count, self.end)
+        if last <= first:
+            return
+
+        if self.ratio == 1.0:
+            source = self.samples[first - self.offset:last - self.offset]
+            out[first - start:last - start] = source
+        else:
+            # the track's clock ran at a different speed, reading it on a stretched
+            # grid with linear interpolation puts every sample where it belongs
+            count = last - first
+            begin = (first - self.offset) * self.ratio
+            low = int(begin)
+            # input position of output sample i is low + i + shift[i], for a drift of a few
+            # ppm the whole part of shift only changes a handful of times per block
+            shift = ramp(count) * np.float32(self.ratio - 1)
+            shift += np.float32(begin - low)
+            whole = np.floor(shift)
+            fraction = shift - whole
+            steps = np.flatnonzero(np.diff(whole)) + 1
+            source = self.samples[low:low + count + max(int(whole.max()), 0) + 2].astype(np.float32)
+            if len(source) < count + int(whole.max()) + 2:
+                # the last output sample sits on the track's last input sample
+                source = np.append(source, source[-1])
+
+            if len(steps) < 256:
+                # copying runs of constant shift as slices is much cheaper than a gather
+                below = np.empty(count, dtype=np.float32)
+                above = np.empty(count, dtype=np.float32)
+                edges = [0, *steps.tolist(), count]
+                for a, b in zip(edges[:-1], edges[1:]):
+                    k = int(whole[a])
+                    below[a:b] = source[a + k:b + k]
+                    above[a:b] = source[a + k + 1:b + k + 1]
+            else:
+                index = np.arange(count) + whole.astype(np.intp)
+                below = source[index]
+                above = source[index + 1]
+            above -= below
+            above *= fraction
+            below += above
+            out[first - start:last - start] = below
+
+        out[first - start:last - start] *= self.gain / 32768.0
+
+    def release(self, upto):
+        ''' drops the pages of a memory mapped track that lie before output sample "upto",
+            they won't be read again, so resident memory stays about one block per track '''
+        if isinstance(self.samples, session.TrackReader):
+            self.samples.release(int((upto - self.offset) * self.ratio) - 2)
+            return
+        mapping = getattr(self.samples, '_mmap', None)
+        if mapping is None or not hasattr(mapping, 'madvise'):
+            return
+        consumed = int((upto - self.offset) * self.ratio) - 2
+        if consumed <= 0:
+            return
+        # the mapping starts at the allocation boundary below the data chunk
+        head = self.samples.offset % mmap.ALLOCATIONGRANULARITY
+        end = min(head + consumed * 2, len(mapping)) // mmap.PAGESIZE * mmap.PAGESIZE
+        if end > self.released:
+            mapping.madvise(mmap.MADV_DONTNEED, self.released, end - self.released)
+            self.released = end
+
+
+_ramp = np.arange(BLOCK_SIZE, dtype=np.float32)
+
+def ramp(count):
+    ''' 0, 1, ... count - 1 as float32, cached so it isn't rebuilt for every block '''
+    global _ramp
+    if count > len(_ramp):
+        _ramp = np.arange(count, dtype=np.float32)
+    return _ramp[:count]
+
+
+def soft_limit(x, threshold=0.8):
+    ''' leaves samples below threshold alone and bends everything above it smoothly
+        towards full scale with tanh, instead of hard clipping the sum (in place) '''
+    magnitude = np.abs(x)
+    over = magnitude > threshold
+    if over.any():
+        headroom = 1.0 - threshold
+        limited = threshold + headroom * np.tanh((magnitude[over] - threshold) / headroom)
+        x[over] = np.copysign(limited, x[over])
+    return x
+
+
+def dither_to_int16(x, rng):
+    ''' converts float32 samples in [-1, 1) to int16 with triangular (TPDF) dither '''
+    noise = rng.random(x.shape, dtype=np.float32) - rng.random(x.shape, dtype=np.float32)
+    scaled = x * 32767.0 + noise
+    np.rint(scaled, out=scaled)
+    np.clip(scaled, -32768, 32767, out=scaled)
+    return scaled.astype(np.int16)
+
+
+def mixdown(tracks, multichannel=False, block_size=BLOCK_SIZE, limit=0.8, seed=0, start=0):
+    ''' generator of int16 output blocks.
+
+        by default all tracks are summed into one mono output, with multichannel=True
+        every track gets its own channel and blocks come out as (samples, len(tracks)).
+        "start" skips the output before it, so a merge of tracks that are still growing
+        (session tracks after TrackReader.refresh) only mixes what is new '''
+    length = max(track.end for track in tracks)
+    rng = np.random.default_rng(seed)
+
+    # buffers are allocated once and reused for every block
+    scratch = np.empty(block_size, dtype=np.float32)
+    if multichannel:
+        mix = np.empty((block_size, len(tracks)), dtype=np.float32)
+    else:
+        mix = np.empty(block_size, dtype=np.float32)
+
+    for start in range(start, length, block_size):
+        count = min(block_size, length - start)
+        if multichannel:
+            for channel, track in enumerate(tracks):
+                track.read(start, count, scratch[:count])
+                mix[:count, channel] = scratch[:count]
+        else:
+            mix[:count] = 0
+            for track in tracks:
+                track.read(start, count, scratch[:count])
+                mix[:count] += scratch[:count]
+        for track in tracks:
+            track.release(start + count)
+        yield dither_to_int16(soft_limit(mix[:count], limit), rng)
+
+
+def initial_floors(tracks, start, segment, count=64, percentile=10.0, min_floor=-70.0):
+    ''' a noise floor (dB) per track to start select_mixdown from: a low percentile of the
+        levels of "count" segments spread over the part of the track that gets mixed.
+        only those segments are read, a few hundred kB whatever the take's length '''
+    buffer = np.empty(segment, dtype=np.float32)
+    floors = []
+    for track in tracks:
+        first = max(start, track.offset)
+        last = max(track.end - segment, first)
+        levels = []
+        for position in np.unique(np.linspace(first, last, count).astype(np.int64)):
+            track.read(int(position), segment, buffer)
+            levels.append(10 * np.log10(float(np.dot(buffer, buffer)) / segment + 1e-12))
+        floors.append(np.percentile(levels, percentile))
+    return np.maximum(np.array(floors, dtype=np.float64), min_floor)
+
+
+def select_mixdown(tracks, rate, block_size=BLOCK_SIZE, segment=8192, crossfade=1024, switch_margin=3.0,
+                   clip_penalty=2000.0, min_floor=-70.0, floor_rise=3.0, floor_percentile=10.0, limit=0.8,
+                   seed=0, decisions=None, start=0):
+    ''' generator of int16 output blocks that play the best microphone of every segment
+        instead of the sum of all of them.
+
+        the (aligned) tracks are cut into segments of "segment" samples; each track gets a
+        score per segment, its signal to noise ratio in dB (energy over its own noise floor,
+        tracked like vad.VoiceDetector does) minus clip_penalty dB per unit of clipped
+        samples. the best track wins the segment, but the current one is only dropped for a
+        track that beats it by switch_margin dB, so the choice doesn't flap between similar
+        mics; a switch crossfades over "crossfade" samples. every segment's scores and
+        winner are appended to "decisions" (a list, or a DecisionLog that writes them out
+        as they come) when it is given.
+
+        the floors start at the floor_percentile-th percentile of segment levels sampled
+        over each track (see initial_floors), so a take that is loud from its first
+        segment on isn't measured against itself. "start" skips the output before it,
+        like mixdown's '''
+    length = max(track.end for track in tracks)
+    rng = np.random.default_rng(seed)
+    segment = min(segment, block_size)
+    crossfade = min(crossfade, segment)
+    # whole segments per block, so a segment never straddles two blocks
+    block_size -= block_size % segment
+    fade = (np.arange(crossfade, dtype=np.float32) + 0.5) / crossfade
+
+    signals = np.empty((len(tracks), block_size), dtype=np.float32)
+    weights = np.empty((len(tracks), block_size), dtype=np.float32)
+    floors = initial_floors(tracks, start, segment, percentile=floor_percentile, min_floor=min_floor)
+    current = None
+    rise = floor_rise * segment / rate
+
+    for start in range(start, length, block_size):
+        count = min(block_size, length - start)
+        x = signals[:, :count]
+        for row, track in zip(x, tracks):
+            track.read(start, count, row)
+        for track in tracks:
+            track.release(start + count)
+
+        # per track, per segment features, all segments of the block at once
+        starts = np.arange(0, count, segment)
+        lengths = np.diff(np.append(starts, count)).astype(np.float32)
+        energy = np.add.reduceat(x * x, starts, axis=1) / lengths
+        level = 10 * np.log10(energy + 1e-12)
+        clipped = np.add.reduceat(np.abs(x) >= 0.999, starts, axis=1) / lengths
+
+        w = weights[:, :count]
+        w[:] = 0
+        for i, first in enumerate(starts):
+            floors = np.minimum(level[:, i], floors + rise)
+            floors = np.maximum(floors, min_floor)
+            score = level[:, i] - floors - clip_penalty * clipped[:, i]
+            best = int(np.argmax(score))
+            last = first + int(lengths[i])
+            if current is None:
+                current = best
+            elif best != current and score[best] >= score[current] + switch_margin:
+                # the outgoing mic fades out while the new one fades in, both play the same
+                # (aligned) sound so a linear fade keeps the level
+                n = min(crossfade, last - first)
+                w[current, first:first + n] = 1 - fade[:n]
+                w[best, first:first + n] = fade[:n]
+                first += n
+                current = best
+            w[current, first:last] = 1
+            if decisions is not None:
+                decisions.append({
+                    'start': (start + int(starts[i])) / rate,
+                    'winner': tracks[current].name,
+                    'scores': [round(float(value), 2) for value in score],
+                })
+
+        mix = np.einsum('ts,ts->s', w, x)
+        yield dither_to_int16(soft_limit(mix, limit), rng)
+
+
+class DecisionLog:
+    ''' decision log of a best microphone merge, written segment by segment as
+        select_mixdown appends them, so a long session doesn't keep them all in memory.
+        the file is one JSON object: {"tracks": [names], "segments": [decisions]} '''
+
+    def __init__(self, filename, tracks):
+        self.file = open(filename, 'w')
+        self.file.write('{"tracks": ' + json.dumps([track.name for track in tracks]) + ', "segments": [')
+        self.count = 0
+
+    def append(self, decision):
+        if self.count:
+            self.file.write(', ')
+        json.dump(decision, self.file)
+        self.count += 1
+
+    def close(self):
+        self.file.write(']}')
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def find_data_chunk(f):
+    ''' walks the RIFF chunks of an open WAV file, returns (fmt fields, data offset, data size) '''
+    riff, size, kind = struct.unpack('<4sI4s', f.read(12))
+    if riff != b'RIFF' or kind != b'WAVE':
+        raise ValueError(f"{f.name}: not a WAV file")
+    fmt = None
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            raise ValueError(f"{f.name}: no data chunk")
+        chunk, size = struct.unpack('<4sI', header)
+        if chunk == b'fmt ':
+            fmt = struct.unpack('<HHIIHH', f.read(16))
+            f.seek(size - 16 + (size & 1), os.SEEK_CUR)
+        elif chunk == b'data':
+            return fmt, f.tell(), size
+        else:
+            # chunks are padded to an even size
+            f.seek(size + (size & 1), os.SEEK_CUR)
+
+
+def open_wav(filename):
+    ''' maps the PCM data of a mono int16 WAV file as a read only numpy.memmap, nothing is
+        read until a block is actually used. returns (samples, rate) '''
+    with open(filename, 'rb') as f:
+        fmt, offset, size = find_data_chunk(f)
+        file_size = os.fstat(f.fileno()).st_size
+    if fmt is None:
+        raise ValueError(f"{filename}: no fmt chunk")
+    audio_format, channels, rate, byte_rate, block_align, bits = fmt
+    if audio_format != 1 or channels != 1 or bits != 16:
+        raise ValueError(f"{filename}: only mono 16 bit PCM WAV files can be merged")
+
+    # a recording that never got its header patched (crash, still being written)
+    # claims a wrong data size, the file size is what counts then
+    if size == 0 or offset + size > file_size:
+        size = file_size - offset
+    count = size // 2
+    if not count:
+        return np.zeros(0, dtype='<i2'), rate
+    return np.memmap(filename, dtype='<i2', mode='r', offset=offset, shape=(count,)), rate
+
+
+# blocks mixed and written by merges, its rate is the merge speed
+merge_blocks = metrics.counter('audiomerge_merge_blocks_total', "blocks written by merges")
+
+
+def write_wav(filename, blocks, rate, channels=1):
+    ''' streams int16 blocks to a WAV file, returns the number of frames written.
+        a mono file gets its waveform peaks (see peaks.py) saved next to it '''
+    frames = 0
+    builder = peaks.PeakBuilder(rate) if channels == 1 else None
+    with wave.open(filename, 'wb') as wf:
+        wf.setnchannels(channels)
+        wf.setsampwidth(2)
+        wf.setframerate(rate)
+        for block in blocks:
+            data = block.astype('<i2', copy=False).tobytes()
+            wf.writeframesraw(data)
+            if builder is not None:
+                builder.add(data)
+            frames += len(block)
+            merge_blocks.inc()
+    if builder is not None:
+        builder.save(peaks.peaks_filename(filename))
+    return frames
+
+
+def timing_filename(filename):
+    ''' timing map written next to a track (or into a session track directory)
+        by the central node (see clocksync) '''
+    if os.path.isdir(filename):
+        return os.path.join(filename, 'timing.json')
+    return os.path.splitext(filename)[0] + '.timing.json'
+
+
+def open_track(filename):
+    ''' samples and rate of a track WAV file or a session track directory (see session.py) '''
+    if os.path.isdir(filename):
+        reader = session.TrackReader(filename)
+        return reader, reader.rate
+    return open_wav(filename)
+
+
+def place_tracks(filenames, rate, gains=None):
+    ''' maps tracks (WAV files or session track directories) and places them on a common
+        timeline, using their timing maps when the central node wrote them. tracks without
+        one start at 0 '''
+    tracks = []
+    starts = []
+    for index, filename in enumerate(filenames):
+        samples, track_rate = open_track(filename)
+        gain = gains[index] if gains else 1.0
+        ratio = track_rate / rate
+        start = None
+        if os.path.exists(timing_filename(filename)):
+            timing = clocksync.load_timing(timing_filename(filename))
+            start = timing['start_time']
+            ratio = timing['rate'] / rate
+        tracks.append(Track(samples, gain=gain, ratio=ratio, name=filename))
+        starts.append(start)
+
+    known = [start for start in starts if start is not None]
+    if known:
+        earliest = min(known)
+        for track, start in zip(tracks, starts):
+            if start is not None:
+                track.offset = int(round((start - earliest) * rate))
+    return tracks
+
+
+def merge_files(filenames, output, rate=44100, multichannel=False, gains=None, block_size=BLOCK_SIZE,
+                auto_align=False, select=False):
+    ''' merges track WAV files (or session track directories) into "output",
+        returns the number of frames written.
+
+        tracks are memory mapped and mixed block_size samples at a time, straight into the
+        output file, so peak memory is about one block per track whatever the session length.
+        bigger blocks mean fewer calls (and page faults) per second of audio, smaller ones less memory.
+        with auto_align=True the timing map offsets are refined by cross-correlation
+        against the first track (see align.align_tracks).
+        with select=True every segment plays only the best microphone instead of the sum
+        (see select_mixdown), and which one won each segment is written to a decision log
+        next to the output '''
+    if select and multichannel:
+        raise ValueError("select picks one microphone per segment, it can't be multichannel")
+    # a session that crashed has chunks its index doesn't cover yet
+    for filename in filenames:
+        if os.path.isdir(filename):
+            session.recover_track(filename)
+    tracks = place_tracks(filenames, rate, gains)
+    if auto_align:
+        for track, result in zip(tracks, align.align_tracks(tracks, rate)):
+            print(f"{track.name}: offset {track.offset} samples, confidence {result.confidence:.2f}")
+    if select:
+        with DecisionLog(os.path.splitext(output)[0] + '.decisions.json', tracks) as decisions:
+            return write_wav(output, select_mixdown(tracks, rate, block_size, decisions=decisions), rate)
+    channels = len(tracks) if multichannel else 1
+    return write_wav(output, mixdown(tracks, multichannel, block_size), rate, channels)
@@ -0,0 +1,75 @@
+''' Peak and RMS level meters of the satellites' audio, for the live monitoring view.
+
+    levels are computed on the central node's event loop thread as the jitter buffers
+    release audio: a strided view keeps every "decimation"-th sample of the chunk and
+    the peak and RMS of that come out of two NumPy reductions, no Python loop per
+    sample. a meter's peak falls back slowly, like a hardware meter's, and readings are
+    rounded to "step_db" so the view only hears about changes it could show '''
+
+import math
+import numpy as np
+
+# level shown for silence, and the bottom of the meter scale
+FLOOR_DB = -60.0
+
+
+def chunk_levels(pcm, decimation=4):
+    ''' peak and RMS of int16 PCM in dB full scale, from every "decimation"-th sample '''
+    samples = np.frombuffer(pcm, dtype='<i2')[::decimation]
+    if not len(samples):
+        return FLOOR_DB, FLOOR_DB
+    x = samples.astype(np.float32)
+    # on the float copy, np.abs of int16 -32768 would wrap around
+    peak = float(np.abs(x).max())
+    mean_square = float(np.dot(x, x)) / len(x)
+    return to_db(peak / 32768.0), to_db(math.sqrt(mean_square) / 32768.0)
+
+
+def to_db(value):
+    return max(20 * math.log10(value), FLOOR_DB) if value > 0 else FLOOR_DB
+
+
+class LevelMeter:
+    ''' level of one track: the RMS of the newest audio and a falling peak '''
+
+    def __init__(self, decimation=4, fall_db=20.0, step_db=0.5):
+        self.decimation = decimation
+        # dB per second the peak falls when the audio gets quieter
+        self.fall_db = fall_db
+        self.step_db = step_db
+        self.peak = FLOOR_DB
+        self.rms = FLOOR_DB
+        self.updated = None
+        # when audio last came through, a meter that hears nothing drops to the floor
+        self.heard = None
+        # the reading last reported, to tell whether anything changed
+        self.reported = None
+
+    def update(self, pcm, now):
+        peak, rms = chunk_levels(pcm, self.decimation)
+        self.fall(now)
+        self.peak = max(self.peak, peak)
+        self.rms = rms
+        self.heard = now
+
+    def silence(self, now):
+        self.fall(now)
+        self.rms = FLOOR_DB
+        self.heard = now
+
+    def fall(self, now):
+        if self.updated is not None:
+            self.peak = max(self.peak - self.fall_db * (now - self.updated), FLOOR_DB)
+        self.updated = now
+
+    def reading(self, now):
+        ''' (peak dB, RMS dB) rounded to step_db, or None if it's the same as last time '''
+        self.fall(now)
+        if self.heard is not None and now - self.heard > 0.5:
+            self.rms = FLOOR_DB
+        step = self.step_db
+        reading = (round(self.peak / step) * step, round(self.rms / step) * step)
+        if reading == self.reported:
+            return None
+        self.reported = reading
+        return reading
@@ -0,0 +1,273 @@
+''' Low overhead counters and histograms for the capture, network and merge stages.
+
+    every metric has a single writer thread (the audio callback, the event loop, a
+    writer...), so recording one is a plain attribute update or a list increment, no
+    lock and no allocation, cheap enough for the audio callback. readers only ever copy
+    the numbers; a snapshot taken while a writer is busy may be one update behind.
+
+    state the modules already keep (frames received per connection, jitter buffer
+    concealments, ...) isn't duplicated: a collector registered with add_collector()
+    reads it when a snapshot is taken.
+
+    snapshots are exported as JSON and as Prometheus text by a small HTTP server on
+    localhost (GET /metrics and /metrics.json), and summarized in a periodic log line '''
+
+import json
+import time
+import bisect
+import threading
+import http.server
+
+COUNTER, GAUGE, HISTOGRAM = 'counter', 'gauge', 'histogram'
+
+# upper bounds (seconds) of the histogram buckets, 10 us to 10 s in steps of about x1.8
+DEFAULT_BUCKETS = tuple(round(1e-5 * 1.78 ** i, 7) for i in range(25))
+
+
+class Counter:
+    ''' a count that only goes up, written by one thread '''
+    kind = COUNTER
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+
+class Gauge:
+    ''' a value that goes up and down, written by one thread '''
+    kind = GAUGE
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram:
+    ''' distribution of a duration (or any value) in fixed buckets, written by one thread '''
+    kind = HISTOGRAM
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.bounds = buckets
+        # one more bucket for everything above the last bound
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q, counts=None):
+        ''' estimated q-quantile (upper bound of the bucket it falls in) '''
+        counts = counts or list(self.counts)
+        total = sum(counts)
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        for i, n in enumerate(counts):
+            seen += n
+            if seen >= rank:
+                return self.bounds[min(i, len(self.bounds) - 1)]
+
+
+# (name, sorted label items) -> metric, and name -> (kind, help)
+metrics = {}
+families = {}
+collectors = []
+registry_lock = threading.Lock()
+
+
+def metric(cls, name, help='', **labels):
+    ''' the metric called "name" with these labels, created on first use. hot paths keep
+        the returned object instead of looking it up every time '''
+    key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+    with registry_lock:
+        if key not in metrics:
+            metrics[key] = cls()
+            families.setdefault(name, (cls.kind, help))
+        return metrics[key]
+
+
+def counter(name, help='', **labels):
+    return metric(Counter, name, help, **labels)
+
+
+def gauge(name, help='', **labels):
+    return metric(Gauge, name, help, **labels)
+
+
+def histogram(name, help='', **labels):
+    return metric(Histogram, name, help, **labels)
+
+
+def add_collector(collect):
+    ''' registers a function called for every snapshot, it returns a list of
+        (name, kind, help, labels dict, value) for state kept elsewhere '''
+    with registry_lock:
+        if collect not in collectors:
+            collectors.append(collect)
+
+
+def remove_collector(collect):
+    with registry_lock:
+        if collect in collectors:
+            collectors.remove(collect)
+
+
+def snapshot():
+    ''' every metric as {name: {'kind', 'help', 'samples': [{'labels', 'value'}]}}, histogram
+        values are {'count', 'sum', 'p50', 'p99', 'buckets': [[bound, cumulative count], ...]}
+        with '+Inf' as the last bound '''
+    with registry_lock:
+        items = list(metrics.items())
+        kinds = dict(families)
+        collect_all = list(collectors)
+    out = {}
+
+    def add(name, kind, help, labels, value):
+        family = out.setdefault(name, {'kind': kind, 'help': help, 'samples': []})
+        family['samples'].append({'labels': labels, 'value': value})
+
+    for (name, labels), m in items:
+        kind, help = kinds[name]
+        if kind == HISTOGRAM:
+            counts = list(m.counts)
+            cumulative, buckets = 0, []
+            for bound, n in zip(m.bounds + ('+Inf',), counts):
+                cumulative += n
+                buckets.append([bound, cumulative])
+            value = {'count': cumulative, 'sum': m.sum, 'buckets': buckets,
+                     'p50': m.quantile(0.5, counts), 'p99': m.quantile(0.99, counts)}
+        else:
+            value = m.value
+        add(name, kind, help, dict(labels), value)
+    for collect in collect_all:
+        for name, kind, help, labels, value in collect():
+            add(name, kind, help, {k: str(v) for k, v in labels.items()}, value)
+    return out
+
+
+def format_labels(labels, extra=None):
+    items = list(labels.items()) + ([extra] if extra else [])
+    if not items:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in items) + '}'
+
+
+def prometheus_text(snap=None):
+    ''' a snapshot in the Prometheus text exposition format '''
+    lines = []
+    for name, family in sorted((snap or snapshot()).items()):
+        lines.append(f"# HELP {name} {family['help']}")
+        lines.append(f"# TYPE {name} {family['kind']}")
+        for sample in family['samples']:
+            labels, value = sample['labels'], sample['value']
+            if family['kind'] == HISTOGRAM:
+                for bound, count in value['buckets']:
+                    lines.append(f"{name}_bucket{format_labels(labels, ('le', bound))} {count}")
+                lines.append(f"{name}_sum{format_labels(labels)} {value['sum']}")
+                lines.append(f"{name}_count{format_labels(labels)} {value['count']}")
+            else:
+                lines.append(f"{name}{format_labels(labels)} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+def json_text(snap=None):
+    return json.dumps(snap or snapshot())
+
+
+def summary(snap, previous=None, elapsed=None):
+    ''' one line: counters summed over their labels (with the rate since "previous"),
+        gauges summed, histograms' p50/p99 in ms (histograms hold seconds) '''
+    parts = []
+    for name, family in sorted(snap.items()):
+        short = name.replace('audiomerge_', '')
+        samples = family['samples']
+        if family['kind'] == HISTOGRAM:
+            count = sum(sample['value']['count'] for sample in samples)
+            if not count:
+                continue
+            p99 = max((sample['value']['p99'] or 0) for sample in samples)
+            p50 = max((sample['value']['p50'] or 0) for sample in samples)
+            parts.append(f"{short} p50 {p50 * 1000:.2f} ms p99 {p99 * 1000:.2f} ms")
+            continue
+        total = sum(sample['value'] for sample in samples)
+        if family['kind'] == COUNTER and not total:
+            # nothing happened (no overflows, no reconnects...), not worth the space
+            continue
+        if family['kind'] == COUNTER and previous is not None and elapsed:
+            before = sum(sample['value'] for sample in previous.get(name, {}).get('samples', []))
+            parts.append(f"{short} {total:g} (+{(total - before) / elapsed:.1f}/s)")
+        elif isinstance(total, float):
+            parts.append(f"{short} {total:.3g}")
+        else:
+            parts.append(f"{short} {total}")
+    return ', '.join(parts)
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.startswith('/metrics.json'):
+            body, content_type = json_text(), 'application/json'
+        elif self.path.startswith('/metrics'):
+            body, content_type = prometheus_text(), 'text/plain; version=0.0.4'
+        else:
+            self.send_error(404)
+            return
+        data = body.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # scrapes every few seconds would flood the console
+        pass
+
+
+class Exporter:
+    ''' serves the metrics on http://host:port/metrics (Prometheus) and /metrics.json,
+        and prints a summary line every "log_interval" seconds (None: never) '''
+
+    def __init__(self, port=None, host='127.0.0.1', log_interval=None, log=print):
+        self.httpd = None
+        if port is not None:
+            try:
+                self.httpd = http.server.ThreadingHTTPServer((host, port), Handler)
+            except OSError as err:
+                # metrics are nice to have, the recording goes on without them
+                print(f"metrics endpoint unavailable on {host}:{port}: {err}")
+            else:
+                self.httpd.daemon_threads = True
+                threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.log_interval = log_interval
+        self.log = log
+        self.stop_event = threading.Event()
+        if log_interval:
+            threading.Thread(target=self.log_lines, daemon=True).start()
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1] if self.httpd is not None else None
+
+    def log_lines(self):
+        previous, last = snapshot(), time.time()
+        while not self.stop_event.wait(self.log_interval):
+            snap, now = snapshot(), time.time()
+            line = summary(snap, previous, now - last)
+            if line:
+                self.log(f"metrics: {line}")
+            previous, last = snap, now
+
+    def stop(self):
+        self.stop_event.set()
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
@@ -0,0 +1,288 @@
+''' Multi-resolution waveform peaks of a track (or a mix), for the review screen.
+
+    level 0 keeps the min, max and RMS of every "base" samples, every level above
+    keeps them for "factor" entries of the one below, up to a single entry for the
+    whole track. a screen column covers some number of samples, the coarsest level
+    with at least one entry per column answers it, so drawing an hour of audio reads
+    a few thousand entries, not 160 million samples.
+
+    the pyramid is built incrementally from int16 PCM as it's recorded (PeakBuilder)
+    or in one streaming pass over a finished track (build), and saved next to it as a
+    sidecar: a small header, the entry count of every level, then the levels one after
+    the other as packed (min int16, max int16, rms uint16) entries. PeakReader maps the
+    file, a query only pages in the part of the one level it reads '''
+
+import os
+import math
+import struct
+import numpy as np
+
+import session
+
+MAGIC = b'AMPK'
+VERSION = 1
+# magic, version, number of levels, factor, rate, base, samples
+HEADER = struct.Struct('<4sBBHIIQ')
+LEVEL_COUNT = struct.Struct('<Q')
+
+# one entry: the smallest and largest sample and the RMS of the samples it covers
+ENTRY = np.dtype([('min', '<i2'), ('max', '<i2'), ('rms', '<u2')])
+
+# samples per level 0 entry, 6 bytes of sidecar for 256 bytes of 16 bit audio
+BASE = 256
+# entries of a level summed up by one entry of the level above
+FACTOR = 4
+# samples the builder collects before reducing them, so a track fed a 1024 sample
+# chunk at a time doesn't pay for a dozen NumPy calls per chunk
+BATCH = BASE * FACTOR ** 3
+# arrays of entries a level collects before they're joined into one
+COMPACT = 64
+
+
+def peaks_filename(filename):
+    ''' sidecar of a track WAV file (or of a session track directory, see session.py) '''
+    if os.path.isdir(filename):
+        return os.path.join(filename, 'peaks.bin')
+    return os.path.splitext(filename)[0] + '.peaks'
+
+
+def review_sources(path):
+    ''' what reviewing "path" shows: a WAV file, a session track directory, or a whole
+        session directory (its live mix first when there is one, then its tracks) '''
+    if not os.path.isdir(path):
+        return [path]
+    if os.path.exists(os.path.join(path, 'track.json')):
+        return [path]
+    path = path.rstrip(os.sep)
+    live = path + '_live.wav'
+    return ([live] if os.path.exists(live) else []) + session.track_directories(path)
+
+
+def reduce_entries(entries, factor):
+    ''' entries grouped by "factor" (the last group may be shorter) into one entry each '''
+    count = len(entries)
+    groups = np.arange(0, count, factor)
+    out = np.empty(len(groups), dtype=ENTRY)
+    out['min'] = np.minimum.reduceat(entries['min'], groups)
+    out['max'] = np.maximum.reduceat(entries['max'], groups)
+    # the RMS of equal parts is the root of their mean square, a short last group
+    # is weighted like the others, close enough for a drawing
+    squares = np.square(entries['rms'].astype(np.float32))
+    sizes = np.diff(np.append(groups, count))
+    out['rms'] = np.sqrt(np.add.reduceat(squares, groups) / sizes)
+    return out
+
+
+def sample_entries(samples, base):
+    ''' level 0 entries of int16 samples, the last one covering what's left '''
+    count = len(samples)
+    groups = np.arange(0, count, base)
+    out = np.empty(len(groups), dtype=ENTRY)
+    if not count:
+        return out
+    out['min'] = np.minimum.reduceat(samples, groups)
+    out['max'] = np.maximum.reduceat(samples, groups)
+    x = samples.astype(np.float32)
+    sizes = np.diff(np.append(groups, count))
+    out['rms'] = np.minimum(np.sqrt(np.add.reduceat(x * x, groups) / sizes), 65535)
+    return out
+
+
+class PeakBuilder:
+    ''' builds the pyramid of int16 mono PCM fed in order with add(), from a single thread '''
+
+    def __init__(self, rate=44100, base=BASE, factor=FACTOR, batch=BATCH):
+        self.rate = rate
+        self.base = base
+        self.factor = factor
+        self.batch_bytes = max(batch // base, 1) * base * 2
+        self.pending = bytearray()
+        self.samples = 0
+        # the entries of every level, as a list of arrays, and the entries of every
+        # level not yet summed up in the level above
+        self.levels = [[]]
+        self.carry = [np.empty(0, dtype=ENTRY)]
+        self.finished = False
+
+    def add(self, pcm):
+        ''' appends int16 PCM (bytes, memoryview or a numpy array) '''
+        if self.finished:
+            raise ValueError("the pyramid is finished")
+        data = memoryview(pcm).cast('B')
+        self.pending += data
+        self.samples += len(data) // 2
+        if len(self.pending) >= self.batch_bytes:
+            self.reduce(len(self.pending) // (self.base * 2) * self.base * 2)
+
+    def reduce(self, size):
+        ''' turns the first "size" bytes of pending PCM into level 0 entries '''
+        if not size:
+            return
+        samples = np.frombuffer(self.pending, dtype='<i2', count=size // 2)
+        entries = sample_entries(samples, self.base)
+        del samples
+        del self.pending[:size]
+        self.push(0, entries)
+
+    def push(self, level, entries):
+        arrays = self.levels[level]
+        arrays.append(entries)
+        if len(arrays) >= COMPACT:
+            # hours of recording would otherwise keep a hundred thousand tiny arrays
+            arrays[-COMPACT:] = [np.concatenate(arrays[-COMPACT:])]
+        combined = np.concatenate((self.carry[level], entries))
+        whole = len(combined) // self.factor * self.factor
+        self.carry[level] = combined[whole:]
+        if whole:
+            if level + 1 == len(self.levels):
+                self.levels.append([])
+                self.carry.append(np.empty(0, dtype=ENTRY))
+            self.push(level + 1, reduce_entries(combined[:whole], self.factor))
+
+    def finish(self):
+        ''' sums up the last, partial entries, nothing can be added after that '''
+        if self.finished:
+            return
+        self.reduce(len(self.pending) - len(self.pending) % 2)
+        self.finished = True
+        level = 0
+        while level < len(self.levels):
+            if sum(len(entries) for entries in self.levels[level]) <= 1:
+                # the top of the pyramid, one entry for the whole track
+                del self.levels[level + 1:]
+                break
+            carry, self.carry[level] = self.carry[level], self.carry[level][:0]
+            if len(carry):
+                if level + 1 == len(self.levels):
+                    self.levels.append([])
+                    self.carry.append(np.empty(0, dtype=ENTRY))
+                self.push(level + 1, reduce_entries(carry, self.factor))
+            level += 1
+
+    def level(self, level):
+        return np.concatenate(self.levels[level]) if self.levels[level] else np.empty(0, dtype=ENTRY)
+
+    def save(self, filename):
+        ''' finishes the pyramid and writes it to "filename" (see peaks_filename) '''
+        self.finish()
+        levels = [self.level(level) for level in range(len(self.levels))]
+        temporary = filename + '.tmp'
+        with open(temporary, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, len(levels), self.factor, self.rate, self.base, self.samples))
+            for entries in levels:
+                f.write(LEVEL_COUNT.pack(len(entries)))
+            for entries in levels:
+                f.write(entries.tobytes())
+        # a reader never sees half a sidecar
+        os.replace(temporary, filename)
+
+
+def build(source, filename=None, block_samples=1 << 18):
+    ''' builds the sidecar of a track WAV file or a session track directory in one
+        streaming pass, returns its file name '''
+    # merge writes peaks with every mix, it imports this module
+    import merge
+    samples, rate = merge.open_track(source)
+    builder = PeakBuilder(rate)
+    for start in range(0, len(samples), block_samples):
+        builder.add(np.ascontiguousarray(samples[start:start + block_samples], dtype='<i2'))
+        if hasattr(samples, 'release'):
+            samples.release(start + block_samples)
+    filename = filename or peaks_filename(source)
+    builder.save(filename)
+    return filename
+
+
+class PeakReader:
+    ''' a saved pyramid, memory mapped. "samples" (the track's int16 samples, e.g. from
+        merge.open_track) lets query() zoom in closer than one level 0 entry per column '''
+
+    def __init__(self, filename, samples=None):
+        self.filename = filename
+        self.samples = samples
+        with open(filename, 'rb') as f:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                raise ValueError(f"{filename}: not a peaks file")
+            magic, version, levels, self.factor, self.rate, self.base, self.length = HEADER.unpack(header)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError(f"{filename}: not a peaks file (or a newer version)")
+            counts = [LEVEL_COUNT.unpack(f.read(LEVEL_COUNT.size))[0] for _ in range(levels)]
+        self.levels = []
+        offset = HEADER.size + LEVEL_COUNT.size * levels
+        for count in counts:
+            if count:
+                self.levels.append(np.memmap(filename, dtype=ENTRY, mode='r', offset=offset, shape=(count,)))
+            else:
+                self.levels.append(np.empty(0, dtype=ENTRY))
+            offset += count * ENTRY.itemsize
+
+    @property
+    def duration(self):
+        return self.length / self.rate
+
+    def samples_per_entry(self, level):
+        return self.base * self.factor ** level
+
+    def level_for(self, samples_per_column):
+        ''' the coarsest level with at least one entry per column '''
+        if samples_per_column < self.base:
+            return 0
+        level = int(math.log(samples_per_column / self.base, self.factor) + 1e-9)
+        return min(level, len(self.levels) - 1)
+
+    def query(self, start, end, columns):
+        ''' min, max and RMS (float32 arrays, full scale 1.0) of "columns" equal parts
+            of samples [start, end), zero where the track has no audio '''
+        out = np.zeros((3, columns), dtype=np.float32)
+        if columns <= 0 or end <= start or not self.levels:
+            return out
+        per_column = (end - start) / columns
+        bounds = start + np.arange(columns) * per_column
+        inside = (bounds >= 0) & (bounds < self.length)
+        if not inside.any():
+            return out
+        if per_column < self.base and self.samples is not None:
+            # closer than the pyramid goes, the samples themselves are few enough
+            entries = self.sample_columns(bounds[inside], per_column)
+        else:
+            level = self.level_for(per_column)
+            size = self.samples_per_entry(level)
+            data = self.levels[level]
+            first = int(bounds[inside][0]) // size
+            last = min(int(math.ceil(min(end, self.length) / size)), len(data))
+            if last <= first:
+                return out
+            # the slice of the one level the view needs is all that's read
+            part = np.asarray(data[first:last])
+            index = np.clip((bounds[inside] // size).astype(np.int64) - first, 0, len(part) - 1)
+            entries = reduce_runs(part, index)
+        out[0, inside] = entries['min'] / 32768.0
+        out[1, inside] = entries['max'] / 32768.0
+        out[2, inside] = entries['rms'] / 32768.0
+        return out
+
+    def sample_columns(self, bounds, per_column):
+        first = int(bounds[0])
+        last = min(int(math.ceil(bounds[-1] + per_column)), self.length)
+        samples = np.asarray(self.samples[first:last], dtype='<i2')
+        index = np.minimum((bounds - first).astype(np.int64), len(samples) - 1)
+        out = np.empty(len(index), dtype=ENTRY)
+        out['min'] = np.minimum.reduceat(samples, index)
+        out['max'] = np.maximum.reduceat(samples, index)
+        x = samples.astype(np.float32)
+        sizes = np.maximum(np.diff(np.append(index, len(samples))), 1)
+        out['rms'] = np.minimum(np.sqrt(np.add.reduceat(x * x, index) / sizes), 65535)
+        return out
+
+
+def reduce_runs(entries, index):
+    ''' one entry per column from entries [index[i], index[i + 1]), a column whose
+        run is empty (zoomed in past the entries) repeats the entry it falls in '''
+    out = np.empty(len(index), dtype=ENTRY)
+    out['min'] = np.minimum.reduceat(entries['min'], index)
+    out['max'] = np.maximum.reduceat(entries['max'], index)
+    squares = np.square(entries['rms'].astype(np.float32))
+    sizes = np.maximum(np.diff(np.append(index, len(entries))), 1)
+    out['rms'] = np.sqrt(np.add.reduceat(squares, index) / sizes)
+    return out
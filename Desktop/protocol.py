@@ -0,0 +1,153 @@
+''' Wire protocol between satellites and the central node.
+
+    everything on the connection is a frame: a fixed size binary header followed by
+    "length" bytes of payload. the header carries who sent it (session id, satellite id),
+    where it belongs on the timeline (sequence number, capture timestamp) and how to read
+    the payload (sample rate, sample format, channels). all fields are network byte order '''
+
+import struct
+
+MAGIC = b'AMRG'
+VERSION = 1
+
+# magic, version, type, flags, session id, satellite id, sequence number,
+# capture timestamp, sample rate, sample format, channels, payload length
+HEADER = struct.Struct('!4sBBHIIIdIBBI')
+
+# frame types
+HELLO = 1    # satellite -> central, first frame on a connection, payload lists the codecs it can send
+WELCOME = 2  # central -> satellite, answer to HELLO with the session id, the chosen codec in flags
+             # and in seq the next sequence number it expects from this satellite's track
+AUDIO = 3    # satellite -> central, PCM payload, flags hold the codec it's coded with (see codec.py)
+BYE = 4      # either side, connection is about to close
+PING = 5     # central -> satellite, timestamp is the central clock when sent
+PONG = 6     # satellite -> central, answer to PING (see clocksync.PONG)
+BACKLOG = 7  # satellite -> central, like AUDIO but spooled while disconnected, spliced in at its seq
+SILENCE = 8  # satellite -> central, a run of silent chunks from seq on instead of their PCM (see SILENCE_RUN)
+FLOW = 9     # central -> satellite, how loaded the central node is (see FLOW_STATE), the level in flags
+
+# SILENCE payload: number of chunks in the run, samples per chunk
+SILENCE_RUN = struct.Struct('!II')
+
+# FLOW payload: frames waiting in the satellite's jitter buffer, seconds from capture to
+# reception on the central node, fraction of the time its event loop is busy
+FLOW_STATE = struct.Struct('!Iff')
+
+# FLOW levels: satellites send normally, send bigger batches and compressed, or only spool
+FLOW_OK = 0
+FLOW_BUSY = 1
+FLOW_OVERLOADED = 2
+
+# sample formats
+INT16 = 1
+
+SAMPLE_WIDTH = {INT16: 2}
+
+# upper bound for a single payload, anything bigger means the stream is corrupt
+MAX_PAYLOAD = 16 * 1024 * 1024
+
+
+class ProtocolError(Exception):
+    ''' raised when a peer sends something that isn't a valid frame '''
+
+
+def check_format(frame):
+    ''' raises ProtocolError unless the header describes PCM the central node can store,
+        returns the size of one sample frame (all channels) in bytes '''
+    if frame.sample_format not in SAMPLE_WIDTH:
+        raise ProtocolError(f"unknown sample format {frame.sample_format}")
+    if frame.channels < 1:
+        raise ProtocolError("frame without channels")
+    if frame.rate < 1:
+        raise ProtocolError("frame without a sample rate")
+    return frame.channels * SAMPLE_WIDTH[frame.sample_format]
+
+
+class Frame:
+    ''' one decoded frame '''
+    __slots__ = ('type', 'flags', 'session_id', 'satellite_id', 'seq', 'timestamp',
+                 'rate', 'sample_format', 'channels', 'payload')
+
+    def __init__(self, type, flags=0, session_id=0, satellite_id=0, seq=0, timestamp=0.0,
+                 rate=0, sample_format=0, channels=0, payload=b''):
+        self.type = type
+        self.flags = flags
+        self.session_id = session_id
+        self.satellite_id = satellite_id
+        self.seq = seq
+        self.timestamp = timestamp
+        self.rate = rate
+        self.sample_format = sample_format
+        self.channels = channels
+        self.payload = payload
+
+    def __repr__(self):
+        return (f"Frame(type={self.type}, satellite={self.satellite_id}, seq={self.seq}, "
+                f"timestamp={self.timestamp:.6f}, {len(self.payload)} bytes)")
+
+
+def pack_header(type, length, flags=0, session_id=0, satellite_id=0, seq=0, timestamp=0.0,
+                rate=0, sample_format=0, channels=0):
+    ''' packs a frame header, the payload is sent separately so it never gets copied '''
+    return HEADER.pack(MAGIC, VERSION, type, flags, session_id, satellite_id, seq,
+                       timestamp, rate, sample_format, channels, length)
+
+
+def encode(frame):
+    ''' encodes a whole frame into one bytes object, for small control frames '''
+    return pack_header(frame.type, len(frame.payload), frame.flags, frame.session_id,
+                       frame.satellite_id, frame.seq, frame.timestamp, frame.rate,
+                       frame.sample_format, frame.channels) + bytes(frame.payload)
+
+
+def send_buffers(sock, buffers):
+    ''' writes a batch of buffers (headers and payload views) to a blocking socket.
+        uses one sendmsg (scatter/gather) call so payloads aren't joined into a new
+        buffer, platforms without sendmsg fall back to a single sendall '''
+    if not hasattr(sock, 'sendmsg'):
+        sock.sendall(b''.join(buffers))
+        return
+
+    buffers = [memoryview(b).cast('B') for b in buffers]
+    while buffers:
+        sent = sock.sendmsg(buffers)
+        # dropping whatever was fully sent, a partial send leaves a tail to retry
+        while buffers and sent >= len(buffers[0]):
+            sent -= len(buffers[0])
+            buffers.pop(0)
+        if buffers and sent:
+            buffers[0] = buffers[0][sent:]
+
+
+class FrameReader:
+    ''' incremental decoder, feed() it bytes as they arrive and it returns complete frames '''
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.offset = 0
+
+    def feed(self, data):
+        self.buffer += data
+        frames = []
+        buffer = self.buffer
+        while len(buffer) - self.offset >= HEADER.size:
+            (magic, version, type, flags, session_id, satellite_id, seq, timestamp,
+             rate, sample_format, channels, length) = HEADER.unpack_from(buffer, self.offset)
+            if magic != MAGIC or version != VERSION:
+                raise ProtocolError(f"bad frame header {magic!r} v{version}")
+            if length > MAX_PAYLOAD:
+                raise ProtocolError(f"frame payload too large ({length} bytes)")
+
+            start = self.offset + HEADER.size
+            end = start + length
+            if end > len(buffer):
+                break
+            frames.append(Frame(type, flags, session_id, satellite_id, seq, timestamp,
+                                rate, sample_format, channels, buffer[start:end]))
+            self.offset = end
+
+        # compacting once the consumed part dominates, so the buffer doesn't grow forever
+        if self.offset and self.offset * 2 >= len(buffer):
+            del buffer[:self.offset]
+            self.offset = 0
+        return frames
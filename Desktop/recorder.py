@@ -0,0 +1,236 @@
+import os
+import time
+import wave
+import datetime
+import threading
+
+import client
+import metrics
+import peaks
+import ringbuffer
+
+
+# PortAudio's sample format and callback return code, as pyaudio.paInt16 and pyaudio.paContinue
+PA_INT16 = 8
+PA_CONTINUE = 0
+# bit of the callback's status flags set when the sound card overwrote input we didn't
+# take in time (pyaudio.paInputOverflow)
+PA_INPUT_OVERFLOW = 2
+
+# written by the audio callback only
+callback_seconds = metrics.histogram('audiomerge_callback_seconds', "time spent in the audio callback")
+input_overflows = metrics.counter('audiomerge_input_overflows_total', "callbacks reporting lost input")
+
+
+class WaveWriter:
+    ''' Streams recorded audio to an open WAV file from a background thread.
+
+        the audio callback copies every buffer into a shared RingBuffer and returns at once,
+        the writer thread reads it back through its own cursor and appends it to the file.
+        memory use stays flat no matter how long the recording runs, and the WAV header
+        (riff/data sizes) is fixed up when the writer is closed. the writer also builds
+        the recording's waveform peaks (see peaks.py) and saves them next to it '''
+
+    def __init__(self, filename, ring, channels=1, sampwidth=2, rate=44100, chunk_bytes=65536):
+        self.filename = filename
+        self.ring = ring
+        self.cursor = ring.cursor()
+        self.chunk = bytearray(chunk_bytes)
+        self.closing = False
+
+        # counters, only written by the writer thread
+        self.frames_written = 0
+        self.frame_size = channels * sampwidth
+
+        self.wf = wave.open(filename, 'wb')
+        self.wf.setnchannels(channels)
+        self.wf.setsampwidth(sampwidth)
+        self.wf.setframerate(rate)
+        self.peaks = peaks.PeakBuilder(rate) if channels == 1 and sampwidth == 2 else None
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    @property
+    def dropped(self):
+        ''' bytes lost because the disk fell behind and the ring lapped the writer '''
+        return self.cursor.lost_bytes
+
+    def run(self):
+        ''' writer thread, appends everything the ring receives until close() is called '''
+        view = memoryview(self.chunk)
+        try:
+            while True:
+                closing = self.closing
+                n = self.cursor.read_into(view)
+                if n:
+                    # writeframesraw skips the header patch on every write,
+                    # close() patches it once at the end
+                    self.wf.writeframesraw(view[:n])
+                    self.frames_written += n // self.frame_size
+                    if self.peaks is not None:
+                        self.peaks.add(view[:n])
+                elif closing:
+                    break
+                else:
+                    self.cursor.wait(0.1)
+        finally:
+            self.ring.remove_cursor(self.cursor)
+            self.wf.close()
+            if self.peaks is not None:
+                self.peaks.save(peaks.peaks_filename(self.filename))
+
+    def close(self):
+        ''' asks the writer thread to flush what's left in the ring and finish the file,
+            returns without waiting for it (use wait() for that) '''
+        self.closing = True
+        self.cursor.ready.set()
+
+    def wait(self, timeout=None):
+        ''' blocks until the writer thread has finished the file '''
+        self.thread.join(timeout)
+        return not self.thread.is_alive()
+
+
+def new_recording_filename(directory='.'):
+    ''' names a recording after the current date and time '''
+    now = datetime.datetime.now()
+    return os.path.join(directory, f"audiomerge{now:%y_%m_%d}at{now:%H_%M_%S}.wav")
+
+
+class Recording:
+    ''' One recording on a satellite, the part the GUI and the headless daemon share.
+
+        the capture (the microphone's PyAudio callback, or anything else calling write())
+        copies every buffer into a ring buffer "buffer_seconds" deep, a WaveWriter streams
+        it to "filename" and, while the satellite is connected to a central node, an
+        AudioStreamer streams it there too, spooling it next to the recording.
+        PyAudio is only imported when the microphone is used '''
+
+    def __init__(self, filename, rate=44100, frames_per_buffer=1024, channels=1, buffer_seconds=10, audio=None):
+        self.filename = filename
+        self.rate = rate
+        self.frames_per_buffer = frames_per_buffer
+        self.channels = channels
+        self.ring = ringbuffer.RingBuffer(rate * 2 * channels * buffer_seconds, frame_size=2 * channels)
+        # a PyAudio instance, or anything that opens streams the same way (see benchmark.py)
+        self.audio = audio
+        self.stream = None
+        self.writer = None
+        self.streamer = None
+        self.started_at = None
+
+    def start(self, microphone=True):
+        ''' starts writing (and streaming). with microphone=False nothing is captured,
+            the caller feeds int16 PCM through write() instead '''
+        if microphone:
+            try:
+                if self.audio is None:
+                    import pyaudio
+                    # pyaudio object
+                    self.audio = pyaudio.PyAudio()
+                # audio stream, "input=true" => record from default microphone
+                # start=False so the callback can't fire before the writer exists
+                self.stream = self.audio.open(format=PA_INT16,
+                                              channels=self.channels,
+                                              rate=self.rate,
+                                              input=True,
+                                              frames_per_buffer=self.frames_per_buffer,
+                                              stream_callback=self.callback,
+                                              start=False)
+            except Exception:
+                raise OSError("can't access micophone")
+
+        self.writer = WaveWriter(self.filename, self.ring, channels=self.channels, sampwidth=2, rate=self.rate)
+        self.started_at = time.time()
+        global current
+        current = self
+        if self.stream is not None:
+            self.stream.start_stream()
+
+        # a satellite connected to a central node streams its capture there live,
+        # spooling it next to the recording in case the connection drops
+        if client.server_address is not None:
+            self.streamer = client.AudioStreamer(client.connection, self.ring, self.started_at,
+                                                 rate=self.rate, channels=self.channels,
+                                                 frames_per_chunk=self.frames_per_buffer,
+                                                 spool_filename=os.path.splitext(self.filename)[0] + '.spool')
+
+    def callback(self, in_data, frame_count, time_info, status):
+        ''' PyAudio callback, copies the new audio into the ring and keeps recording '''
+        started = time.perf_counter()
+        self.ring.write(in_data, time.time())
+        if status & PA_INPUT_OVERFLOW:
+            input_overflows.inc()
+        callback_seconds.observe(time.perf_counter() - started)
+        return (None, PA_CONTINUE)
+
+    def write(self, data, timestamp=None):
+        ''' feeds captured int16 PCM in, for sources other than the microphone '''
+        self.ring.write(data, time.time() if timestamp is None else timestamp)
+
+    def stop(self):
+        ''' stops the capture and finishes the file and the stream, without waiting for
+            them (use wait() for that) '''
+        if self.stream is not None:
+            self.stream.stop_stream()
+            self.stream.close()
+            self.audio.terminate()
+        self.writer.close()
+        if self.streamer is not None:
+            self.streamer.stop()
+        if not self.ring.written:
+            raise ValueError("no audio data available to write")
+        if self.writer.cursor.overruns:
+            print(f"writer fell behind {self.writer.cursor.overruns} times, lost {self.writer.dropped} bytes")
+
+    def wait(self, timeout=None):
+        ''' blocks until the file is finished and whatever was left has been streamed '''
+        deadline = None if timeout is None else time.time() + timeout
+        done = self.writer.wait(timeout)
+        if self.streamer is not None:
+            self.streamer.thread.join(None if deadline is None else max(deadline - time.time(), 0))
+            done = done and not self.streamer.thread.is_alive()
+        return done
+
+
+# the recording the metrics describe, the latest one started
+current = None
+
+
+def collect_metrics():
+    ''' queue depths and counters the running recording already keeps, for metrics.snapshot() '''
+    recording = current
+    if recording is None:
+        return []
+    bytes_per_second = recording.rate * 2 * recording.channels
+
+    def waiting(cursor):
+        # read without cursor.available(), which belongs to the consumer's thread
+        return min(recording.ring.written - cursor.position, recording.ring.size) / bytes_per_second
+
+    out = [
+        ('audiomerge_captured_seconds', metrics.COUNTER, "audio captured", {}, recording.ring.written / bytes_per_second),
+        ('audiomerge_queue_seconds', metrics.GAUGE, "captured audio a consumer hasn't read yet",
+         {'consumer': 'writer'}, waiting(recording.writer.cursor)),
+        ('audiomerge_overruns_total', metrics.COUNTER, "times a consumer was lapped by the capture",
+         {'consumer': 'writer'}, recording.writer.cursor.overruns),
+    ]
+    streamer = recording.streamer
+    if streamer is not None:
+        out += [
+            ('audiomerge_queue_seconds', metrics.GAUGE, "", {'consumer': 'streamer'},
+             waiting(streamer.cursor)),
+            ('audiomerge_overruns_total', metrics.COUNTER, "", {'consumer': 'streamer'}, streamer.cursor.overruns),
+            ('audiomerge_frames_sent_total', metrics.COUNTER, "frames sent to the central node", {}, streamer.frames_sent),
+            ('audiomerge_bytes_sent_total', metrics.COUNTER, "bytes sent to the central node", {}, streamer.bytes_sent),
+            ('audiomerge_backlog_frames_sent_total', metrics.COUNTER, "spooled frames uploaded after reconnecting",
+             {}, streamer.backlog_sent),
+            ('audiomerge_backlog_frames', metrics.GAUGE, "spooled frames the central node is still missing",
+             {}, sum(end - start for start, end in streamer.backlog)),
+            ('audiomerge_flow_level', metrics.GAUGE, "flow level the central node reports", {}, streamer.level),
+        ]
+    return out
+
+
+metrics.add_collector(collect_metrics)
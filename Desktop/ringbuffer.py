@@ -0,0 +1,133 @@
+import threading
+
+
+class RingBuffer:
+    ''' Fixed size ring buffer between the audio callback and its consumers.
+
+        the whole buffer is a preallocated bytearray, the callback copies every
+        in_data into it through a memoryview so nothing is allocated per buffer.
+        consumers (disk writer, network sender, level meter) each read through their
+        own Cursor, a slow consumer never blocks the callback, it just gets lapped
+        and the overrun is counted on its cursor '''
+
+    def __init__(self, size, frame_size=2):
+        # keeping the size a multiple of the frame size keeps every read frame aligned
+        self.size = size - size % frame_size
+        self.frame_size = frame_size
+        self.buffer = bytearray(self.size)
+        self.view = memoryview(self.buffer)
+
+        # total number of bytes ever written, only the writer moves it
+        self.written = 0
+        # capture time of the newest byte, if the writer passes one
+        self.write_time = None
+        self.cursors = []
+
+    def write(self, data, timestamp=None):
+        ''' copies data into the ring, called from the audio callback.
+            "timestamp" is the capture time of the end of data, if known '''
+        data = memoryview(data).cast('B')
+        n = len(data)
+        if n > self.size:
+            # only the newest part of an oversized write can be kept
+            self.written += n - self.size
+            data = data[n - self.size:]
+            n = self.size
+
+        pos = self.written % self.size
+        first = min(n, self.size - pos)
+        self.view[pos:pos + first] = data[:first]
+        if first < n:
+            self.view[:n - first] = data[first:]
+
+        # publishing the new write position, consumers only read below it
+        if timestamp is not None:
+            self.write_time = (self.written + n, timestamp)
+        self.written += n
+        for cursor in self.cursors:
+            cursor.ready.set()
+
+    def cursor(self, from_start=False):
+        ''' creates a new read cursor, by default starting at the current write position '''
+        cursor = Cursor(self, 0 if from_start else self.written)
+        self.cursors = self.cursors + [cursor]
+        return cursor
+
+    def time_at(self, position, bytes_per_second):
+        ''' capture time of the byte at "position", extrapolated from the newest write time '''
+        if self.write_time is None:
+            return None
+        end, timestamp = self.write_time
+        return timestamp - (end - position) / bytes_per_second
+
+    def remove_cursor(self, cursor):
+        self.cursors = [c for c in self.cursors if c is not cursor]
+
+
+class Cursor:
+    ''' A consumer's read position in a RingBuffer, with its own overrun counters '''
+
+    def __init__(self, ring, position):
+        self.ring = ring
+        self.position = position
+        self.ready = threading.Event()
+
+        # how many times this consumer got lapped by the writer, and bytes lost to it
+        self.overruns = 0
+        self.lost_bytes = 0
+
+    def available(self):
+        ''' number of bytes that can be read right now '''
+        self.check_overrun()
+        return self.ring.written - self.position
+
+    def check_overrun(self):
+        ''' if the writer lapped this cursor, skip ahead to data that is still valid.
+            we jump a quarter ring past the oldest byte so the writer isn't about to
+            overwrite what we read next '''
+        ring = self.ring
+        written = ring.written
+        if written - self.position > ring.size:
+            new_position = written - ring.size + ring.size // 4
+            new_position -= new_position % ring.frame_size
+            self.lost_bytes += new_position - self.position
+            self.overruns += 1
+            self.position = new_position
+
+    def read_into(self, out):
+        ''' copies up to len(out) bytes into the caller's preallocated buffer,
+            returns the number of bytes copied '''
+        ring = self.ring
+        out = memoryview(out).cast('B')
+        n = min(len(out), self.available())
+        n -= n % ring.frame_size
+        if n <= 0:
+            return 0
+
+        start = self.position
+        pos = start % ring.size
+        first = min(n, ring.size - pos)
+        out[:first] = ring.view[pos:pos + first]
+        if first < n:
+            out[first:n] = ring.view[:n - first]
+
+        # the writer might have lapped us while we were copying, then the copy is torn
+        if ring.written - start > ring.size:
+            self.check_overrun()
+            return 0
+
+        self.position = start + n
+        return n
+
+    def read(self, max_bytes):
+        ''' convenience read that returns a new bytes object '''
+        out = bytearray(max_bytes)
+        n = self.read_into(out)
+        return bytes(out[:n])
+
+    def wait(self, timeout=None):
+        ''' waits until there is something to read, returns False on timeout '''
+        self.ready.clear()
+        if self.available():
+            return True
+        return self.ready.wait(timeout)
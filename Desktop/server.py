@@ -1,59 +1,820 @@
 
+import os
+import shutil
+import collections
 import socket
+import time
 import random
+import selectors
 import threading
+import codec
+import jitter
+import livemix
+import protocol
+import session
+import clocksync
+import discovery
+import meters
+import metrics
+import peaks
 
 # Get the IP address
 def get_ipaddress():
-    try:
-        # Create a socket object and connect to a remote server (e.g., Google DNS)
-        # This step is not required to get the local IP, but it ensures that you are connected to a network.
+    ''' address of this machine on the local network, works without internet access.
+        connecting a UDP socket sends nothing, it only makes the system pick the interface
+        (and so the source address) it would route through '''
+    for target in ("8.8.8.8", "10.255.255.255", "192.168.255.255", "172.31.255.255"):
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.connect(("8.8.8.8", 80))
-        ip_address = s.getsockname()[0]
-        s.close()
-        print(ip_address)
-        return ip_address
-    except Exception as err:
-        return str(err)
-
-# Get port number
-def get_port():
-    return random.randint(5000,65534)
-
-# number of connected clients
-number_of_clients = 0
+        try:
+            s.connect((target, 80))
+            ip_address = s.getsockname()[0]
+        except OSError:
+            # no route there (e.g. no default gateway on an offline LAN), trying the next one
+            continue
+        finally:
+            s.close()
+        if not ip_address.startswith("127.") and ip_address != "0.0.0.0":
+            print(ip_address)
+            return ip_address
+    try:
+        for ip_address in socket.gethostbyname_ex(socket.gethostname())[2]:
+            if not ip_address.startswith("127."):
+                print(ip_address)
+                return ip_address
+    except OSError:
+        pass
+    # no network at all, satellites on this machine can still connect
+    return "127.0.0.1"
 
 # recording flag
 recording_active = False
 
+# live satellite connections keyed by socket file descriptor,
+# written by the event loop thread and read by the GUI thread
+clients = {}
+clients_lock = threading.Lock()
+
+# set to make the event loop close every connection and return
+stop_event = threading.Event()
+
+# session id handed to satellites in WELCOME, new for every run of the event loop
+session_id = 0
+
+# one open track per satellite, keyed by satellite id, kept across reconnects
+tracks = {}
+
+# directory the session containers (and exported track files) are written to
+output_dir = '.'
+
+# write every track out as a WAV file too once it's closed, for merging and playback
+export_wavs = True
+
+# clock estimate of every satellite, keyed by satellite id, kept across reconnects
+clocks = {}
+
+# tracks and clocks are written by the event loop thread and read by the GUI and
+# metrics threads, the loop takes this lock to add or remove entries and the other
+# threads to look them up
+tracks_lock = threading.Lock()
+
+# seconds between clock pings to each satellite
+ping_interval = 1.0
+
+# connection requests the kernel queues before accept() (capped by the system's SOMAXCONN)
+listen_backlog = 128
+
+# seconds between FLOW reports to each satellite
+flow_interval = 0.5
+
+# capture to reception lag (seconds) and event loop busy fraction at which a satellite is
+# reported busy, and overloaded
+busy_lag, overloaded_lag = 1.0, 3.0
+busy_load, overloaded_load = 0.7, 0.9
+
+# fraction of the time the event loop spent working rather than waiting, smoothed
+loop_load = 0.0
+
+# most frames a track's jitter buffer may hold (about 6 seconds of 1024 sample frames)
+jitter_max_frames = 256
+
+# seconds a frame's seq may run ahead of the time since its track's first frame, frames
+# further along can't be real and are dropped rather than concealed up to
+jitter_max_lead = 60.0
+
+# mix incoming satellites into a rolling WAV while recording
+live_mix = True
+
+# the session's LiveMixer while the event loop runs with live_mix on
+mixer = None
+
+# codecs the central node accepts from satellites
+accepted_codecs = codec.SUPPORTED
+
+# most samples (of all channels) a compressed frame starting a take may decode to
+max_chunk_samples = 16384
+
+# announce the central node on the local network so satellites find it without typing
+advertise = True
+
+# seconds between discovery beacons
+beacon_interval = 0.5
+
+# most satellites connected at once, further ones are turned away (the beacon tells how
+# many slots are free)
+max_satellites = 64
+
+# the running discovery.Beacon while the event loop runs with advertise on
+beacon = None
+
+# localhost port the metrics are served on (GET /metrics, /metrics.json), None for none
+metrics_port = 9464
+
+# seconds between metrics log lines, None for none
+metrics_log_interval = 30.0
+
+# called on the event loop thread with {satellite id: {'peak', 'rms', 'health', 'address'}}
+# for the satellites whose level or connection health changed, at most every meter_interval
+level_listener = None
+meter_interval = 1 / 30
+
+# meters look at every meter_decimation-th sample, plenty for a level display
+meter_decimation = 4
+
+# seconds without data after which a connected satellite counts as stalled
+stall_timeout = 2.0
+
+# when levels were last published, and the health last published per satellite
+levels_published = 0.0
+reported_health = {}
+
+# how long each round of the event loop takes, written by the event loop thread
+round_seconds = metrics.histogram('audiomerge_loop_round_seconds', "work done per event loop round, waiting excluded")
+
+class Connection:
+    ''' state of one satellite connection, owned by the event loop thread '''
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.address = address
+        self.connected_at = time.time()
+        self.last_seen = self.connected_at
+        self.bytes_received = 0
+        self.frames_received = 0
+
+        # frames are decoded incrementally as bytes arrive
+        self.reader = protocol.FrameReader()
+        # satellite id from the HELLO frame, None until it arrives
+        self.satellite_id = None
+        # bytes waiting to be sent when the socket is writable again
+        self.outbuf = bytearray()
+        # set once a send failed, nothing more is sent but the connection is read to its end
+        self.write_failed = False
+        # central clock when this satellite was last pinged
+        self.last_ping = 0.0
+        # central clock when this satellite last got a FLOW report, and what it said
+        self.last_flow = 0.0
+        self.flow_level = protocol.FLOW_OK
+        # capture time of the newest audio received and how long before its reception
+        # it was captured (on the central clock), which grows when we fall behind
+        self.newest_capture = None
+        self.last_audio = 0.0
+        self.lag = 0.0
+        # codec negotiated in HELLO/WELCOME and what decoding it costs
+        self.codec = codec.RAW
+        self.codec_stats = codec.Stats()
+        # PCM bytes the satellite didn't have to send because they were silent
+        self.silent_bytes = 0
+
+    def info(self):
+        ''' snapshot of the connection for the GUI '''
+        with tracks_lock:
+            clock = clocks.get(self.satellite_id)
+            track = tracks.get(self.satellite_id)
+        return {
+            'address': f"{self.address[0]}:{self.address[1]}",
+            'connected_at': self.connected_at,
+            'last_seen': self.last_seen,
+            'bytes_received': self.bytes_received,
+            'frames_received': self.frames_received,
+            'satellite_id': self.satellite_id,
+            'clock': clock.state() if clock is not None else None,
+            'codec': self.codec,
+            'compression': self.codec_stats.state(),
+            'silent_bytes': self.silent_bytes,
+            'lag': self.lag,
+            'flow_level': self.flow_level,
+            'jitter': track.jitter.state() if track is not None else None,
+        }
+
+class Track:
+    ''' one satellite's recording on the central node. AUDIO frames from that satellite are
+        demultiplexed here, put back in order by a jitter buffer and written at the position
+        their sequence number points to; frames that never arrive are concealed so the
+        timeline stays intact, and every gap is recorded in the track's metadata '''
+    def __init__(self, satellite_id, frame, take=0, started=None):
+        self.satellite_id = satellite_id
+        self.take = take
+        self.rate = frame.rate
+        self.channels = frame.channels
+        self.sampwidth = protocol.SAMPLE_WIDTH[frame.sample_format]
+        if frame.type == protocol.SILENCE:
+            # a track may start silent, the run says how long its chunks are
+            self.samples_per_chunk = protocol.SILENCE_RUN.unpack(frame.payload)[1]
+            self.chunk_bytes = self.samples_per_chunk * self.channels * self.sampwidth
+        else:
+            self.chunk_bytes = len(frame.payload)
+            self.samples_per_chunk = self.chunk_bytes // (self.channels * self.sampwidth)
+        # a take starts at sequence 0, unless we only joined it later (e.g. a central restart)
+        self.first_seq = 0 if frame.seq < jitter_max_frames else frame.seq
+        self.jitter = jitter.JitterBuffer(self.chunk_bytes, self.first_seq, max_frames=jitter_max_frames,
+                                          frame_rate=self.rate / self.samples_per_chunk,
+                                          max_lead=int(jitter_max_lead * self.rate / self.samples_per_chunk),
+                                          started=started)
+
+        self.frames_written = 0
+        self.silent_frames = 0
+        # key of this track's source in the live mix, and concealed audio released before
+        # the first real frame told us where the track starts
+        self.live_key = (satellite_id, take)
+        self.live_source = None
+        self.live_pending = collections.deque()
+        # (seq, capture time) of the first real frame, which places the track once the
+        # satellite's clock is known, and pending audio dropped meanwhile (oldest first)
+        self.live_anchor = None
+        self.live_skipped = 0
+
+        # the track is recorded into the session container (see session.py), so a crash
+        # loses nothing but the last moments, and exported as a WAV file when it's closed
+        self.directory = os.path.join(output_dir, f"audiomerge_session{session_id:08x}",
+                                      f"satellite{satellite_id}_take{take}")
+        self.filename = os.path.join(output_dir,
+            f"audiomerge_session{session_id:08x}_satellite{satellite_id}_take{take}.wav")
+        # sample index -> capture time points, saved next to the track for the merge step
+        self.timing = clocksync.TrackTiming(self.rate)
+        self.store = session.TrackWriter(self.directory, self.rate, self.channels, self.sampwidth,
+                                         info={'session_id': session_id, 'satellite_id': satellite_id,
+                                               'take': take, 'first_seq': self.first_seq})
+        self.spliced = 0
+        # level of the audio released lately, for the monitoring view
+        self.meter = meters.LevelMeter(meter_decimation)
+        # waveform peaks of everything released, saved with the track for the review screen
+        self.peaks = peaks.PeakBuilder(self.rate)
+
+    @property
+    def next_seq(self):
+        return self.jitter.next_seq
+
+    def write(self, frame, arrival):
+        ''' hands a frame to the jitter buffer, drain() writes it once it's in order '''
+        self.jitter.push(frame, arrival)
+
+    def write_silence(self, frame, arrival):
+        ''' hands the chunks of a SILENCE run to the jitter buffer, as chunks without PCM '''
+        count, samples = protocol.SILENCE_RUN.unpack(frame.payload)
+        for i in range(count):
+            self.jitter.push(protocol.Frame(protocol.SILENCE, seq=frame.seq + i, payload=None,
+                                            timestamp=frame.timestamp + i * samples / self.rate), arrival)
+
+    def splice(self, frame, arrival):
+        ''' places a BACKLOG frame (audio the satellite spooled while it was offline): one
+            the jitter buffer is still waiting for goes in like a live frame, one that has
+            been concealed by now overwrites its concealment on disk. the live mix
+            keeps the concealment, it's long past that point '''
+        if frame.seq >= self.jitter.next_seq:
+            self.jitter.hold(frame, arrival)
+            return
+        if len(frame.payload) != self.chunk_bytes or not self.jitter.fill(frame.seq):
+            return
+        self.store.write_at((frame.seq - self.first_seq) * self.samples_per_chunk, frame.payload)
+        self.spliced += 1
+
+    def drain(self, now, flush=False):
+        ''' writes every frame the jitter buffer releases (flush=True conceals whatever
+            is still missing and releases everything) '''
+        for seq, payload, timestamp in self.jitter.pop(now, flush):
+            if payload is None:
+                # silence is left out of the files, the position still moves on
+                self.store.skip(self.samples_per_chunk, seq, timestamp)
+                self.silent_frames += 1
+                self.meter.silence(now)
+                payload = self.jitter.silence
+            else:
+                self.store.write(payload, seq, timestamp)
+                self.meter.update(payload, now)
+            self.peaks.add(payload)
+            self.frames_written += 1
+            if timestamp is not None:
+                self.timing.add((seq - self.first_seq) * self.samples_per_chunk, timestamp)
+            if mixer is not None:
+                self.feed_live(seq, payload, timestamp)
+
+    def feed_live(self, seq, payload, timestamp):
+        ''' passes released audio on to the live mix. the track is placed on the session
+            timeline by its first real frame once the satellite's clock is known (at least
+            one PING answered), until then its audio waits here, as much as a source holds '''
+        if self.live_source is not None:
+            mixer.feed(self.live_key, payload)
+            return
+        if self.live_anchor is None and timestamp is not None:
+            self.live_anchor = (seq, timestamp)
+        self.live_pending.append(payload)
+        if len(self.live_pending) > max(mixer.max_samples // self.samples_per_chunk, 1):
+            self.live_pending.popleft()
+            self.live_skipped += 1
+        clock = clocks.get(self.satellite_id)
+        if self.live_anchor is None or clock is None or not clock.samples:
+            return
+        anchor_seq, anchor_time = self.live_anchor
+        # the pending audio starts live_skipped chunks into the track
+        chunks = anchor_seq - self.first_seq - self.live_skipped
+        start = clock.to_local(anchor_time) - chunks * self.samples_per_chunk / self.rate
+        self.live_source = mixer.add_source(self.live_key, start)
+        for pending in self.live_pending:
+            mixer.feed(self.live_key, pending)
+        self.live_pending.clear()
+
+    def metadata(self):
+        ''' gaps in samples from the start of the track and how much of it was silence
+            (not sent, not stored), for the timing map '''
+        return {
+            'gaps': [[(seq - self.first_seq) * self.samples_per_chunk, count * self.samples_per_chunk]
+                     for seq, count in self.jitter.gaps],
+            'jitter': self.jitter.state(),
+            'silent_samples': self.silent_frames * self.samples_per_chunk,
+        }
+
+    def close(self):
+        self.drain(time.time(), flush=True)
+        if mixer is not None:
+            mixer.end_source(self.live_key)
+        self.store.close()
+        clock = clocks.get(self.satellite_id) or clocksync.ClockEstimator()
+        self.timing.save(os.path.join(self.directory, 'timing.json'), clock, self.metadata())
+        if self.spliced:
+            # backlog overwrote concealed audio the peaks were built from, one pass
+            # over the finished track gets them right
+            peaks.build(self.directory)
+        else:
+            self.peaks.save(peaks.peaks_filename(self.directory))
+        if export_wavs:
+            session.export_wav(self.directory, self.filename)
+            self.timing.save(os.path.splitext(self.filename)[0] + '.timing.json', clock, self.metadata())
+            shutil.copyfile(peaks.peaks_filename(self.directory), peaks.peaks_filename(self.filename))
+
+def track_for(frame):
+    ''' returns the open track of the satellite that sent "frame", a sequence number
+        starting over at 0 once 0 has been written means the satellite started a new
+        recording (a new take) '''
+    track = tracks.get(frame.satellite_id)
+    if track is not None and frame.seq == 0 and track.next_seq > 0:
+        track.close()
+        # the new take may have begun while the satellite was offline, it's no older than
+        # the satellite's first frame of the session though
+        track = Track(frame.satellite_id, frame, track.take + 1, track.jitter.started)
+        with tracks_lock:
+            tracks[frame.satellite_id] = track
+    elif track is None:
+        track = Track(frame.satellite_id, frame)
+        with tracks_lock:
+            tracks[frame.satellite_id] = track
+    return track
+
+def drain_tracks(now):
+    for track in tracks.values():
+        track.drain(now)
+
+def health(conn, now):
+    ''' connection health of a satellite for the monitoring view '''
+    if conn is None:
+        return 'disconnected'
+    if now - conn.last_seen > stall_timeout:
+        return 'stalled'
+    return ('ok', 'busy', 'overloaded')[conn.flow_level]
+
+def publish_levels(now):
+    ''' tells level_listener about every satellite whose meter reading or health changed
+        since it last heard, at most every meter_interval '''
+    global levels_published
+    if level_listener is None or now - levels_published < meter_interval:
+        return
+    levels_published = now
+    # clients is only written by this thread, no lock needed to read it here
+    connections = {conn.satellite_id: conn for conn in clients.values() if conn.satellite_id is not None}
+    changes = {}
+    for satellite_id in set(tracks) | set(connections):
+        track = tracks.get(satellite_id)
+        conn = connections.get(satellite_id)
+        reading = track.meter.reading(now) if track is not None else None
+        state = health(conn, now)
+        if reading is None and reported_health.get(satellite_id) == state:
+            continue
+        reported_health[satellite_id] = state
+        peak, rms = track.meter.reported if track is not None and track.meter.reported else (meters.FLOOR_DB,) * 2
+        changes[satellite_id] = {'peak': peak, 'rms': rms, 'health': state,
+                                 'address': f"{conn.address[0]}:{conn.address[1]}" if conn is not None else None}
+    if changes:
+        level_listener(changes)
+
+def close_tracks():
+    for track in tracks.values():
+        track.close()
+        if track.silent_frames:
+            print(f"{track.directory}: {track.silent_frames / max(track.frames_written, 1):.0%} silence, not stored")
+    with tracks_lock:
+        tracks.clear()
+
+def client_count():
+    ''' number of connected satellites, safe to call from any thread '''
+    with clients_lock:
+        return len(clients)
+
+def client_list():
+    ''' list of connected satellites (see Connection.info), safe to call from any thread '''
+    with clients_lock:
+        return [conn.info() for conn in clients.values()]
+
 def bind(ip_address, port):
     #  create a socket object
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     # AF_INET : address family, IPv4
     # SOCK_STREAM : TCP
+    # a restarted central node can take its port back while old connections linger in TIME_WAIT
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     # bind to the port
     server_socket.bind((ip_address, port))
     return server_socket
 
 
 
-def listen(server_socket):
-# queue up to 5 requests
-    server_socket.listen(5)
+def listen(server_socket, backlog=None):
+    # queue up to "backlog" connection requests, a crowd of satellites can connect at once
+    server_socket.listen(min(backlog or listen_backlog, socket.SOMAXCONN))
 
 
 
-# recording state
-def handle_client(server_socket):
+def accept(selector, server_socket):
+    ''' accepts every waiting satellite and registers it with the selector '''
     while True:
-        print("chal rha hai")
-        client_socket, address = server_socket.accept()
+        try:
+            client_socket, address = server_socket.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        if len(clients) >= max_satellites:
+            client_socket.close()
+            print(f"Connection from {address} refused, {max_satellites} satellites already connected")
+            continue
+        client_socket.setblocking(False)
+        conn = Connection(client_socket, address)
+        selector.register(client_socket, selectors.EVENT_READ, conn)
+        with clients_lock:
+            clients[conn.fd] = conn
         print(f"Connection from {address} has been established!")
-        if client_socket.recv(1024).decode('ascii') == '200':
-            number_of_clients += 1
-            print(f"Number of connected clients: {number_of_clients}")
-        
 
-        
+def close(selector, conn):
+    ''' unregisters and closes a satellite connection '''
+    with clients_lock:
+        clients.pop(conn.fd, None)
+    try:
+        selector.unregister(conn.sock)
+    except (KeyError, ValueError):
+        pass
+    conn.sock.close()
+    print(f"Connection from {conn.address} closed")
+
+def stop_writing(selector, conn, err):
+    ''' gives up sending to a satellite whose connection failed for writing (e.g. it shut
+        its side after BYE). what it sent before is still unread, the connection stays
+        open until read() reaches its end '''
+    print(f"{conn.address}: {err}")
+    conn.write_failed = True
+    conn.outbuf.clear()
+    selector.modify(conn.sock, selectors.EVENT_READ, conn)
+
+def send(selector, conn, data):
+    ''' queues data for a satellite and sends as much as the socket takes right now,
+        the rest goes out when the selector reports the socket writable '''
+    if conn.sock.fileno() == -1 or conn.write_failed:
+        # closed earlier in this round, or no longer writable
+        return
+    if not conn.outbuf:
+        try:
+            sent = conn.sock.send(data)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError as err:
+            # the satellite went away, a broken pipe mustn't take the event loop down
+            stop_writing(selector, conn, err)
+            return
+        data = data[sent:]
+        if not data:
+            return
+        selector.modify(conn.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, conn)
+    conn.outbuf += data
+
+def flush(selector, conn):
+    ''' sends queued data once the socket is writable '''
+    try:
+        sent = conn.sock.send(conn.outbuf)
+    except (BlockingIOError, InterruptedError):
+        return
+    except OSError as err:
+        stop_writing(selector, conn, err)
+        return
+    del conn.outbuf[:sent]
+    if not conn.outbuf:
+        selector.modify(conn.sock, selectors.EVENT_READ, conn)
+
+def check_track_format(track, frame):
+    ''' raises ProtocolError unless the frame's format is the format of the track it goes to '''
+    if (frame.rate, frame.channels, protocol.SAMPLE_WIDTH[frame.sample_format]) != \
+            (track.rate, track.channels, track.sampwidth):
+        raise protocol.ProtocolError(f"format of satellite {frame.satellite_id} changed within a take")
+
+def check_payload(track, frame):
+    ''' raises ProtocolError unless the frame's audio fits the track it goes to: the same
+        format and at most one chunk (the last one of a take may be shorter) '''
+    check_track_format(track, frame)
+    if len(frame.payload) > track.chunk_bytes:
+        raise protocol.ProtocolError(f"{len(frame.payload)} byte payload, the track's chunks are {track.chunk_bytes}")
+
+def check_run(track, frame):
+    ''' raises ProtocolError unless a SILENCE run fits the track it goes to: the same
+        format and chunks as long as the track's (its count was checked on arrival) '''
+    check_track_format(track, frame)
+    samples = protocol.SILENCE_RUN.unpack(frame.payload)[1]
+    if samples != track.samples_per_chunk:
+        raise protocol.ProtocolError(f"silence run of {samples} sample chunks, the track has {track.samples_per_chunk}")
+
+def handle_frame(selector, conn, frame):
+    ''' dispatches one decoded frame from a satellite '''
+    if frame.type == protocol.HELLO:
+        conn.satellite_id = frame.satellite_id
+        conn.codec = codec.choose(frame.payload, accepted_codecs)
+        # a satellite coming back after losing its connection resumes from here,
+        # everything it captured since is uploaded from its spool
+        track = tracks.get(frame.satellite_id)
+        send(selector, conn, protocol.encode(protocol.Frame(protocol.WELCOME,
+                                                            flags=conn.codec,
+                                                            session_id=session_id,
+                                                            satellite_id=frame.satellite_id,
+                                                            seq=track.next_seq if track else 0)))
+    elif frame.type == protocol.PONG:
+        if len(frame.payload) != clocksync.PONG.size:
+            raise protocol.ProtocolError(f"{len(frame.payload)} byte PONG payload, expected {clocksync.PONG.size}")
+        t0, t1, t2 = clocksync.PONG.unpack(frame.payload)
+        # last_seen is when the bytes carrying this PONG were received
+        clock = clocks.get(conn.satellite_id)
+        if clock is None:
+            clock = clocksync.ClockEstimator()
+            with tracks_lock:
+                clocks[conn.satellite_id] = clock
+        clock.add(t0, t1, t2, conn.last_seen)
+    elif frame.type in (protocol.AUDIO, protocol.BACKLOG):
+        if conn.satellite_id is None:
+            raise protocol.ProtocolError("AUDIO frame before HELLO")
+        conn.frames_received += 1
+        frame_bytes = protocol.check_format(frame)
+        if frame.flags == codec.RICE:
+            # a frame holds one chunk of its track at most (see check_payload), a take's first
+            # frame max_chunk_samples
+            track = tracks.get(frame.satellite_id)
+            max_samples = max_chunk_samples
+            if track is not None and frame.seq != 0:
+                max_samples = track.chunk_bytes // 2
+            frame.payload = codec.timed(codec.decode, frame.payload, conn.codec_stats, max_samples)
+        elif frame.flags != codec.RAW:
+            raise protocol.ProtocolError(f"unknown codec {frame.flags}")
+        if not frame.payload or len(frame.payload) % frame_bytes:
+            raise protocol.ProtocolError(f"{len(frame.payload)} byte payload isn't a whole number of frames")
+        if frame.type == protocol.AUDIO:
+            track = track_for(frame)
+            check_payload(track, frame)
+            track.write(frame, conn.last_seen)
+            conn.last_audio = conn.last_seen
+            if conn.newest_capture is None or frame.timestamp > conn.newest_capture:
+                conn.newest_capture = frame.timestamp
+        else:
+            # a backlog only starts a new take if it begins one (its satellite lost the
+            # connection before the take's first frame got through)
+            track = tracks.get(frame.satellite_id)
+            if track is None or frame.seq == 0:
+                track = track_for(frame)
+            check_payload(track, frame)
+            track.splice(frame, conn.last_seen)
+    elif frame.type == protocol.SILENCE:
+        if conn.satellite_id is None:
+            raise protocol.ProtocolError("SILENCE frame before HELLO")
+        frame_bytes = protocol.check_format(frame)
+        if len(frame.payload) != protocol.SILENCE_RUN.size:
+            raise protocol.ProtocolError(f"{len(frame.payload)} byte SILENCE payload, expected {protocol.SILENCE_RUN.size}")
+        count, samples = protocol.SILENCE_RUN.unpack(frame.payload)
+        # a run is never longer than a batch, and the jitter buffer couldn't hold more anyway
+        if not 0 < count <= jitter_max_frames or not 0 < samples * frame_bytes <= protocol.MAX_PAYLOAD:
+            raise protocol.ProtocolError(f"SILENCE run of {count} chunks of {samples} samples")
+        conn.frames_received += 1
+        track = track_for(frame)
+        check_run(track, frame)
+        track.write_silence(frame, conn.last_seen)
+        conn.silent_bytes += count * track.chunk_bytes
+    elif frame.type == protocol.BYE:
+        # everything the satellite sent came before its BYE, closing our side tells it so
+        close(selector, conn)
+
+def handle_data(selector, conn, data):
+    ''' decodes bytes received from a satellite into frames and handles them '''
+    conn.bytes_received += len(data)
+    try:
+        for frame in conn.reader.feed(data):
+            handle_frame(selector, conn, frame)
+            if conn.sock.fileno() == -1:
+                break
+    except protocol.ProtocolError as err:
+        print(f"{conn.address}: {err}")
+        close(selector, conn)
+
+def read(selector, conn):
+    ''' reads whatever a satellite has sent without blocking the loop, returns True if
+        there was something '''
+    try:
+        data = conn.sock.recv(65536)
+    except (BlockingIOError, InterruptedError):
+        return False
+    except OSError as err:
+        print(f"{conn.address}: {err}")
+        close(selector, conn)
+        return False
+    if not data:
+        # satellite closed the connection
+        close(selector, conn)
+        return False
+    conn.last_seen = time.time()
+    handle_data(selector, conn, data)
+    if conn.newest_capture is not None and conn.satellite_id in clocks:
+        conn.lag = conn.last_seen - clocks[conn.satellite_id].to_local(conn.newest_capture)
+    return True
+
+def ping(selector):
+    ''' sends a clock PING to every satellite that hasn't had one for ping_interval '''
+    now = time.time()
+    with clients_lock:
+        connections = list(clients.values())
+    for conn in connections:
+        if conn.satellite_id is None or now - conn.last_ping < ping_interval:
+            continue
+        conn.last_ping = now
+        send(selector, conn, protocol.encode(protocol.Frame(protocol.PING,
+                                                            session_id=session_id,
+                                                            satellite_id=conn.satellite_id,
+                                                            timestamp=time.time())))
+
+def flow_level(conn):
+    ''' how loaded the central node is for one satellite, see protocol.FLOW_OK... it goes up
+        at once but only comes down one level per report, so satellites that were held back
+        don't all come rushing in together '''
+    track = tracks.get(conn.satellite_id)
+    depth = track.jitter.depth if track is not None else 0
+    if time.time() - conn.last_audio > 2 * flow_interval:
+        # a satellite that stopped sending (maybe because we told it to) has no lag
+        conn.lag = 0.0
+    if conn.lag > overloaded_lag or loop_load > overloaded_load or depth >= jitter_max_frames:
+        level = protocol.FLOW_OVERLOADED
+    elif conn.lag > busy_lag or loop_load > busy_load or depth > jitter_max_frames // 2:
+        level = protocol.FLOW_BUSY
+    else:
+        level = protocol.FLOW_OK
+    return max(level, conn.flow_level - 1)
+
+def flow(selector):
+    ''' sends a FLOW report to every satellite that hasn't had one for flow_interval,
+        so satellites back off before we build up buffers we can't work through '''
+    now = time.time()
+    with clients_lock:
+        connections = list(clients.values())
+    for conn in connections:
+        if conn.satellite_id is None or now - conn.last_flow < flow_interval:
+            continue
+        conn.last_flow = now
+        conn.flow_level = flow_level(conn)
+        track = tracks.get(conn.satellite_id)
+        payload = protocol.FLOW_STATE.pack(track.jitter.depth if track is not None else 0, conn.lag, loop_load)
+        send(selector, conn, protocol.encode(protocol.Frame(protocol.FLOW,
+                                                            flags=conn.flow_level,
+                                                            session_id=session_id,
+                                                            satellite_id=conn.satellite_id,
+                                                            payload=payload)))
+
+def beacon_state():
+    ''' session id, satellites connected and free slots, for the discovery beacon '''
+    with clients_lock:
+        connected = len(clients)
+    return session_id, connected, max(max_satellites - connected, 0)
+
+def collect_metrics():
+    ''' per satellite counters and queue depths the connections and tracks already keep,
+        for metrics.snapshot() (runs on the metrics thread, only reads) '''
+    with clients_lock:
+        connections = list(clients.values())
+    with tracks_lock:
+        open_tracks = list(tracks.values())
+    out = [
+        ('audiomerge_satellites', metrics.GAUGE, "connected satellites", {}, len(connections)),
+        ('audiomerge_loop_load', metrics.GAUGE, "fraction of time the event loop is busy", {}, loop_load),
+    ]
+    for conn in connections:
+        labels = {'satellite': conn.satellite_id}
+        out += [
+            ('audiomerge_bytes_received_total', metrics.COUNTER, "bytes received per satellite", labels, conn.bytes_received),
+            ('audiomerge_frames_received_total', metrics.COUNTER, "frames received per satellite", labels, conn.frames_received),
+            ('audiomerge_send_queue_bytes', metrics.GAUGE, "bytes waiting to be sent per satellite", labels, len(conn.outbuf)),
+            ('audiomerge_lag_seconds', metrics.GAUGE, "capture to reception lag per satellite", labels, conn.lag),
+        ]
+    for track in open_tracks:
+        labels = {'satellite': track.satellite_id, 'take': track.take}
+        jitter_buffer = track.jitter
+        out += [
+            ('audiomerge_jitter_depth_frames', metrics.GAUGE, "frames held by the jitter buffer", labels, jitter_buffer.depth),
+            ('audiomerge_concealed_frames_total', metrics.COUNTER, "frames concealed (never arrived in time)",
+             labels, jitter_buffer.concealed),
+            ('audiomerge_late_frames_total', metrics.COUNTER, "frames that arrived after being concealed",
+             labels, jitter_buffer.late),
+            ('audiomerge_out_of_range_frames_total', metrics.COUNTER, "frames dropped for a seq further along than the session",
+             labels, jitter_buffer.out_of_range),
+            ('audiomerge_recovered_frames_total', metrics.COUNTER, "concealed frames replaced by the real audio later",
+             labels, jitter_buffer.recovered),
+        ]
+    live = mixer
+    if live is not None:
+        out.append(('audiomerge_live_mix_blocks_total', metrics.COUNTER, "blocks written by the live mix",
+                    {}, live.blocks_mixed))
+    return out
+
+def handle_client(server_socket):
+    ''' event loop of the central node: accepts satellites and keeps reading from all of them
+        at once on a single thread, until stop() is called '''
+    global session_id, mixer, loop_load, beacon
+    session_id = random.getrandbits(32)
+    with tracks_lock:
+        clocks.clear()
+    reported_health.clear()
+    if live_mix:
+        mixer = livemix.LiveMixer(os.path.join(output_dir, f"audiomerge_session{session_id:08x}_live.wav"))
+    server_socket.setblocking(False)
+    selector = selectors.DefaultSelector()
+    # the listening socket is registered without data, connections carry their Connection
+    selector.register(server_socket, selectors.EVENT_READ, None)
+    stop_event.clear()
+    if advertise:
+        beacon = discovery.Beacon(server_socket.getsockname()[1], beacon_state, beacon_interval)
+    metrics.add_collector(collect_metrics)
+    exporter = metrics.Exporter(metrics_port, log_interval=metrics_log_interval)
+    try:
+        while not stop_event.is_set():
+            # timeout so a stop() request and pings are handled even when nobody is sending
+            started = time.perf_counter()
+            events = selector.select(timeout=0.25)
+            waited = time.perf_counter() - started
+            for key, mask in events:
+                if key.data is None:
+                    accept(selector, key.fileobj)
+                    continue
+                conn = key.data
+                if mask & selectors.EVENT_WRITE and conn.sock.fileno() != -1:
+                    flush(selector, conn)
+                # the connection may have been closed earlier in this round
+                if mask & selectors.EVENT_READ and conn.sock.fileno() != -1:
+                    read(selector, conn)
+            now = time.time()
+            drain_tracks(now)
+            if mixer is not None:
+                mixer.tick(now)
+            ping(selector)
+            flow(selector)
+            publish_levels(now)
+            # busy fraction of this round, smoothed over about a second of rounds
+            elapsed = time.perf_counter() - started
+            round_seconds.observe(elapsed - waited)
+            if elapsed > 0:
+                weight = min(elapsed, 1.0)
+                loop_load += ((1 - waited / elapsed) - loop_load) * weight
+    finally:
+        exporter.stop()
+        if beacon is not None:
+            beacon.stop()
+            beacon = None
+        for key in list(selector.get_map().values()):
+            if key.data is not None:
+                # audio already received but not read yet still goes into the tracks
+                while key.data.sock.fileno() != -1 and read(selector, key.data):
+                    pass
+                if key.data.sock.fileno() != -1:
+                    close(selector, key.data)
+        selector.close()
+        server_socket.close()
+        close_tracks()
+        if mixer is not None:
+            mixer.close()
+            mixer = None
 
+def stop():
+    ''' asks the event loop to close all connections and return '''
+    stop_event.set()
@@ -0,0 +1,361 @@
+''' Session container, the crash safe on-disk format of a recording session.
+
+    a session is a directory holding one directory per track:
+
+        audiomerge_session<id>/
+            satellite<id>_take<n>/
+                track.json          format and identity of the track, written once
+                index               one fixed size record per chunk file
+                00000000.pcm        raw PCM, chunk_seconds each (the last one may be shorter)
+                00000001.pcm
+                ...
+                peaks.bin           waveform peaks (see peaks.py), written on close
+
+    a chunk file is fsynced when it is full, its index record goes out with the next
+    batch (every sync_every chunks, and on close). since every chunk but the last is
+    full, sample n lives in chunk n // chunk_samples, so seeking costs nothing however
+    long the session runs, and a reader only ever maps the chunks it touches.
+
+    silence the satellites didn't send (see vad.py) is left as holes in the chunk files:
+    where the file system supports sparse files it takes no disk space, and it reads as
+    zeros, so every position stays sample accurate.
+
+    after a crash everything up to the last chunk is still there: the index covers what
+    was synced, and chunk files written after the last index batch are picked up by their
+    size (see recover_track) '''
+
+import os
+import json
+import math
+import time
+import wave
+import struct
+import numpy as np
+
+import metrics
+
+# chunk number, first sample, sample count, first seq, seq past the last one,
+# capture time of the first sample (satellite clock, nan if unknown)
+INDEX = struct.Struct('<IQIIId')
+
+
+def chunk_filename(directory, number):
+    return os.path.join(directory, f"{number:08d}.pcm")
+
+
+# how long the track writers' fsyncs take, the event loop waits for them
+fsync_seconds = metrics.histogram('audiomerge_fsync_seconds', "duration of track data and index fsyncs")
+
+
+def timed_fsync(fd):
+    started = time.perf_counter()
+    os.fsync(fd)
+    fsync_seconds.observe(time.perf_counter() - started)
+
+
+def fsync_directory(directory):
+    ''' makes new files in a directory survive a crash (a no-op where directories can't be opened) '''
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class TrackWriter:
+    ''' appends a track's PCM to chunk files and keeps its index '''
+
+    def __init__(self, directory, rate, channels=1, sampwidth=2, chunk_seconds=10.0, sync_every=3, info=None):
+        self.directory = directory
+        self.rate = rate
+        self.frame_size = channels * sampwidth
+        self.chunk_samples = int(chunk_seconds * rate)
+        self.chunk_bytes = self.chunk_samples * self.frame_size
+        self.sync_every = sync_every
+        os.makedirs(directory, exist_ok=True)
+
+        with open(os.path.join(directory, 'track.json'), 'w') as f:
+            json.dump(dict(info or {}, rate=rate, channels=channels, sampwidth=sampwidth,
+                           chunk_samples=self.chunk_samples), f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        self.index = open(os.path.join(directory, 'index'), 'wb')
+        fsync_directory(directory)
+
+        # index records waiting for the next batch
+        self.pending = []
+        self.chunks = 0
+        self.samples = 0
+        # samples appended as holes by skip()
+        self.skipped = 0
+        # the chunk being filled and what its index record will say
+        self.file = None
+        self.filled = 0
+        self.first_seq = None
+        self.end_seq = None
+        self.timestamp = math.nan
+        # (sample, capture time) of the latest real frame, to timestamp chunks that start in a gap
+        self.last_time = None
+
+    def write(self, payload, seq=None, timestamp=None):
+        ''' appends PCM; seq and timestamp (capture time of its first sample) are what the
+            index records for the chunks it lands in, None for concealed audio '''
+        data = memoryview(payload).cast('B')
+        self.append(data, len(data), seq, timestamp)
+
+    def skip(self, samples, seq=None, timestamp=None):
+        ''' appends silence without writing it: the chunk file gets a hole there (sparse
+            where the file system supports it, nothing is allocated) and reads as zeros '''
+        self.append(None, samples * self.frame_size, seq, timestamp)
+        self.skipped += samples
+
+    def append(self, data, size, seq, timestamp):
+        if timestamp is not None:
+            self.last_time = (self.samples, timestamp)
+        while size:
+            if self.file is None:
+                self.open_chunk()
+            n = min(size, self.chunk_bytes - self.filled)
+            if data is None:
+                self.file.seek(n, os.SEEK_CUR)
+            else:
+                self.file.write(data[:n])
+                data = data[n:]
+            self.filled += n
+            self.samples += n // self.frame_size
+            if seq is not None:
+                if self.first_seq is None:
+                    self.first_seq = seq
+                self.end_seq = seq + 1
+            size -= n
+            if self.filled == self.chunk_bytes:
+                self.close_chunk()
+
+    def write_at(self, sample, payload):
+        ''' overwrites PCM already written from "sample" on (a late frame spliced over its
+            concealment), the chunks it touches are fsynced again '''
+        data = memoryview(payload).cast('B')
+        position = sample * self.frame_size
+        while len(data):
+            number, offset = divmod(position, self.chunk_bytes)
+            n = min(len(data), self.chunk_bytes - offset)
+            if number == self.chunks and self.file is not None:
+                self.file.seek(offset)
+                self.file.write(data[:n])
+                self.file.seek(self.filled)
+            else:
+                with open(chunk_filename(self.directory, number), 'r+b') as f:
+                    f.seek(offset)
+                    f.write(data[:n])
+                    f.flush()
+                    timed_fsync(f.fileno())
+            position += n
+            data = data[n:]
+
+    def open_chunk(self):
+        # unbuffered, whatever was written survives the process crashing
+        self.file = open(chunk_filename(self.directory, self.chunks), 'wb', buffering=0)
+        self.filled = 0
+        self.first_seq = self.end_seq = None
+        self.timestamp = math.nan
+        if self.last_time is not None:
+            sample, timestamp = self.last_time
+            self.timestamp = timestamp + (self.samples - sample) / self.rate
+
+    def close_chunk(self):
+        ''' finishes the chunk being filled: its data is fsynced right away, its index
+            record goes out with the next batch '''
+        # a chunk ending in silence has to be extended over its trailing hole
+        self.file.truncate(self.filled)
+        timed_fsync(self.file.fileno())
+        self.file.close()
+        self.file = None
+        samples = self.filled // self.frame_size
+        first_seq = self.first_seq if self.first_seq is not None else 0
+        end_seq = self.end_seq if self.end_seq is not None else first_seq
+        self.pending.append(INDEX.pack(self.chunks, self.samples - samples, samples,
+                                       first_seq, end_seq, self.timestamp))
+        self.chunks += 1
+        if self.chunks == 1:
+            # the first chunk file has to survive a crash along with the directory
+            fsync_directory(self.directory)
+        if len(self.pending) >= self.sync_every:
+            self.sync()
+
+    def sync(self):
+        ''' writes the pending index records and fsyncs the index '''
+        if not self.pending:
+            return
+        self.index.write(b''.join(self.pending))
+        self.index.flush()
+        timed_fsync(self.index.fileno())
+        self.pending = []
+
+    def close(self):
+        if self.file is not None and self.filled:
+            self.close_chunk()
+        elif self.file is not None:
+            self.file.close()
+            os.remove(chunk_filename(self.directory, self.chunks))
+            self.file = None
+        self.sync()
+        self.index.close()
+
+
+class TrackReader:
+    ''' reads a track of a session directory as one long int16 array.
+
+        len() is the sample count and slicing (reader[a:b]) returns the samples, so a
+        reader can stand in for the memmapped WAV of a merge.Track. every chunk file is
+        memory mapped on first use only, release() unmaps the ones a pass is done with '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'track.json')) as f:
+            self.info = json.load(f)
+        self.rate = self.info['rate']
+        self.chunk_samples = self.info['chunk_samples']
+        self.entries = []
+        self.index_bytes = 0
+        self.maps = {}
+        self.refresh()
+
+    def refresh(self):
+        ''' picks up chunks indexed since the last call (the track may still be recording),
+            returns how many samples were added '''
+        before = len(self)
+        with open(os.path.join(self.directory, 'index'), 'rb') as f:
+            f.seek(self.index_bytes)
+            data = f.read()
+        # a torn record at the end (crash during a batch) is left for the next call
+        whole = len(data) - len(data) % INDEX.size
+        self.entries.extend(INDEX.iter_unpack(data[:whole]))
+        self.index_bytes += whole
+        return len(self) - before
+
+    def __len__(self):
+        if not self.entries:
+            return 0
+        number, first_sample, samples, first_seq, end_seq, timestamp = self.entries[-1]
+        return first_sample + samples
+
+    def chunk(self, number):
+        samples = self.maps.get(number)
+        if samples is None:
+            count = self.entries[number][2]
+            samples = np.memmap(chunk_filename(self.directory, number), dtype='<i2', mode='r',
+                                shape=(count,)) if count else np.zeros(0, dtype='<i2')
+            self.maps[number] = samples
+        return samples
+
+    def read(self, start, count):
+        ''' samples [start, start + count) as one array, clipped to the track '''
+        end = min(start + count, len(self))
+        start = max(start, 0)
+        if end <= start:
+            return np.zeros(0, dtype='<i2')
+        first = start // self.chunk_samples
+        last = (end - 1) // self.chunk_samples
+        if first == last:
+            offset = first * self.chunk_samples
+            return self.chunk(first)[start - offset:end - offset]
+        out = np.empty(end - start, dtype='<i2')
+        for number in range(first, last + 1):
+            offset = number * self.chunk_samples
+            a = max(start, offset)
+            b = min(end, offset + self.chunk_samples)
+            out[a - start:b - start] = self.chunk(number)[a - offset:b - offset]
+        return out
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice) or key.step not in (None, 1):
+            raise TypeError("a track is only read in contiguous slices")
+        start, stop, step = key.indices(len(self))
+        return self.read(start, stop - start)
+
+    def release(self, upto):
+        ''' unmaps every chunk that lies completely before sample "upto" '''
+        for number in [number for number in self.maps if (number + 1) * self.chunk_samples <= upto]:
+            del self.maps[number]
+
+
+def recover_track(directory):
+    ''' rebuilds the index entries of chunk files written after the last synced index batch
+        (a crash, or a writer that was never closed), returns the number of chunks recovered.
+        their capture times are extrapolated from the last indexed chunk. a track a writer
+        still has open looks just like a crashed one, it must not be recovered meanwhile '''
+    reader = TrackReader(directory)
+    frame_size = reader.info['channels'] * reader.info['sampwidth']
+    entries = reader.entries
+    # chunks are indexed in order, a torn tail of the index file is cut off
+    with open(os.path.join(directory, 'index'), 'r+b') as f:
+        f.truncate(len(entries) * INDEX.size)
+
+    records = []
+    number = len(entries)
+    first_sample = len(reader)
+    last = entries[-1] if entries else None
+    if last is not None and last[2] < reader.chunk_samples:
+        # the writer closed the track properly, its short last chunk is indexed
+        return 0
+    while os.path.exists(chunk_filename(directory, number)):
+        size = os.path.getsize(chunk_filename(directory, number))
+        samples = size // frame_size
+        if samples == 0:
+            break
+        timestamp = math.nan
+        seq = last[4] if last else 0
+        if last is not None and not math.isnan(last[5]):
+            timestamp = last[5] + (first_sample - last[1]) / reader.rate
+        record = (number, first_sample, samples, seq, seq, timestamp)
+        records.append(INDEX.pack(*record))
+        first_sample += samples
+        number += 1
+        if samples < reader.chunk_samples:
+            # only the last chunk can be short, anything after it is not part of the track
+            break
+
+    if records:
+        with open(os.path.join(directory, 'index'), 'ab') as f:
+            f.write(b''.join(records))
+            f.flush()
+            os.fsync(f.fileno())
+    return len(records)
+
+
+def track_directories(session_directory):
+    ''' track directories of a session, in name order '''
+    return [os.path.join(session_directory, name) for name in sorted(os.listdir(session_directory))
+            if os.path.exists(os.path.join(session_directory, name, 'track.json'))]
+
+
+def recover_session(session_directory):
+    ''' recovers every track of a session (see recover_track), returns {track directory: chunks recovered} '''
+    return {directory: recover_track(directory) for directory in track_directories(session_directory)}
+
+
+def recover(path):
+    ''' recovers a track directory, or every track of a session directory, returns
+        {track directory: chunks recovered} '''
+    if os.path.exists(os.path.join(path, 'track.json')):
+        return {path: recover_track(path)}
+    return recover_session(path)
+
+
+def export_wav(directory, filename, block_samples=1 << 18):
+    ''' writes a track out as a WAV file in one streaming pass over its chunks,
+        returns the number of frames written '''
+    reader = TrackReader(directory)
+    with wave.open(filename, 'wb') as wf:
+        wf.setnchannels(reader.info['channels'])
+        wf.setsampwidth(reader.info['sampwidth'])
+        wf.setframerate(reader.rate)
+        for start in range(0, len(reader), block_samples):
+            wf.writeframesraw(reader.read(start, block_samples).tobytes())
+            reader.release(start + block_samples)
+    return len(reader)
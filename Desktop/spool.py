@@ -0,0 +1,76 @@
+import os
+import bisect
+import struct
+
+
+class Spool:
+    ''' Append-only file of every chunk a satellite captured, kept on the satellite.
+
+        every record is a small header (sequence number, capture timestamp) followed by
+        one whole chunk of PCM, so all records have the same size and any range of them
+        is found without scanning. sequence numbers only jump after a ring overrun, a new
+        run starts then; the runs are the whole index. when the connection drops the audio
+        keeps going into the spool, and whatever the central node missed is read back from
+        it once the satellite has reconnected '''
+
+    # sequence number, capture timestamp (satellite clock)
+    RECORD = struct.Struct('<Id')
+
+    def __init__(self, filename, chunk_bytes):
+        self.filename = filename
+        self.chunk_bytes = chunk_bytes
+        self.record_size = self.RECORD.size + chunk_bytes
+        # unbuffered, so appended records are in the file right away
+        self.f = open(filename, 'a+b', buffering=0)
+        # (first seq, first record index) of every run of consecutive sequence numbers
+        self.runs = []
+        self.records = 0
+        self.next_seq = None
+
+    @property
+    def first_seq(self):
+        return self.runs[0][0] if self.runs else None
+
+    def append(self, chunks):
+        ''' appends (seq, timestamp, payload) chunks, all in one write '''
+        parts = []
+        for seq, timestamp, payload in chunks:
+            if seq != self.next_seq:
+                self.runs.append((seq, self.records))
+            parts.append(self.RECORD.pack(seq, timestamp))
+            parts.append(payload)
+            self.records += 1
+            self.next_seq = seq + 1
+        self.f.write(b''.join(parts))
+
+    def read(self, seq, count):
+        ''' reads up to "count" records starting at the first one at or after "seq",
+            returns them as a list of (seq, timestamp, payload) '''
+        if not self.runs or seq >= self.next_seq:
+            return []
+        # the run holding seq; a seq lost in an overrun starts at the next run instead
+        i = bisect.bisect_right(self.runs, (seq, self.records)) - 1
+        if i < 0:
+            i, seq = 0, self.runs[0][0]
+        first, index = self.runs[i]
+        run_end = self.runs[i + 1][1] if i + 1 < len(self.runs) else self.records
+        if seq - first >= run_end - index:
+            first, index = self.runs[i + 1]
+            seq = first
+        # every record carries its own seq, a read may run on into the next run
+        index += seq - first
+        end = min(index + count, self.records)
+
+        self.f.seek(index * self.record_size)
+        data = self.f.read((end - index) * self.record_size)
+        out = []
+        for offset in range(0, len(data) - self.record_size + 1, self.record_size):
+            record_seq, timestamp = self.RECORD.unpack_from(data, offset)
+            start = offset + self.RECORD.size
+            out.append((record_seq, timestamp, data[start:start + self.chunk_bytes]))
+        return out
+
+    def close(self, remove=False):
+        self.f.close()
+        if remove:
+            os.remove(self.filename)
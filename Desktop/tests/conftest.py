@@ -0,0 +1,62 @@
+''' the desktop modules are plain scripts next to each other, importable from here '''
+
+import os
+import sys
+import time
+import socket
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server
+import protocol
+
+
+@pytest.fixture
+def central(tmp_path, monkeypatch):
+    ''' a central node event loop on a free localhost port, recording into tmp_path.
+        yields (port, thread) and stops it afterwards '''
+    monkeypatch.setattr(server, 'output_dir', str(tmp_path))
+    monkeypatch.setattr(server, 'advertise', False)
+    monkeypatch.setattr(server, 'metrics_port', None)
+    monkeypatch.setattr(server, 'metrics_log_interval', None)
+    monkeypatch.setattr(server, 'live_mix', False)
+    server_socket = server.bind('127.0.0.1', 0)
+    server.listen(server_socket)
+    port = server_socket.getsockname()[1]
+    thread = threading.Thread(target=server.handle_client, args=(server_socket,), daemon=True)
+    thread.start()
+    yield port, thread
+    server.stop()
+    thread.join(10)
+
+
+def connect(port, satellite_id=1, codecs=b'\x00'):
+    ''' a raw satellite connection that has said HELLO and read its WELCOME '''
+    sock = socket.create_connection(('127.0.0.1', port), timeout=5)
+    sock.sendall(protocol.encode(protocol.Frame(protocol.HELLO, satellite_id=satellite_id, payload=codecs)))
+    reader = protocol.FrameReader()
+    while True:
+        data = sock.recv(65536)
+        assert data, "central node closed the connection before WELCOME"
+        frames = reader.feed(data)
+        if any(frame.type == protocol.WELCOME for frame in frames):
+            return sock
+
+
+def closed_by_peer(sock, timeout=3.0):
+    ''' True if the central node closes the connection within "timeout" seconds (frames
+        it sends meanwhile, like PINGs, are skipped) '''
+    deadline = time.time() + timeout
+    try:
+        while time.time() < deadline:
+            sock.settimeout(max(deadline - time.time(), 0.01))
+            if not sock.recv(65536):
+                return True
+    except socket.timeout:
+        pass
+    except ConnectionResetError:
+        return True
+    return False
@@ -0,0 +1,38 @@
+''' cross-correlation finds how far one satellite's recording is off another's '''
+
+import numpy as np
+
+import align
+import merge
+
+RATE = 8000
+
+
+def speech_like(seconds, seed=0):
+    ''' noise bursts of random length and loudness, so the envelope has a shape to match '''
+    rng = np.random.default_rng(seed)
+    samples = rng.normal(0, 300, seconds * RATE)
+    position = 0
+    while position < len(samples):
+        length = int(rng.integers(RATE // 10, RATE // 2))
+        samples[position:position + length] *= rng.uniform(0, 20)
+        position += length + int(rng.integers(RATE // 20, RATE // 3))
+    return np.clip(samples, -32768, 32767).astype('<i2')
+
+
+def test_known_lag_is_recovered():
+    reference = speech_like(20)
+    # the target started 1.5 s (and a bit) later than the reference
+    lag = 12345
+    target = reference[lag:lag + 15 * RATE]
+    result = align.estimate_lag(reference, target, RATE, max_lag=3.0, window=5.0)
+    assert result.lag == lag
+    assert result.confidence > 0.9
+
+
+def test_align_tracks_moves_the_late_track():
+    reference = speech_like(20, seed=1)
+    target = reference[4000:]
+    tracks = [merge.Track(reference), merge.Track(target)]
+    align.align_tracks(tracks, RATE, max_lag=2.0, window=5.0)
+    assert [track.offset for track in tracks] == [0, 4000]
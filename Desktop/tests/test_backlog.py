@@ -0,0 +1,63 @@
+''' a satellite that started a new take while offline uploads it from its spool once it's back '''
+
+import time
+import socket
+
+import client
+import protocol
+import ringbuffer
+import server
+from conftest import connect
+
+CHUNK = 1024
+
+
+def audio(seq):
+    return protocol.encode(protocol.Frame(protocol.AUDIO, satellite_id=1, seq=seq, timestamp=time.time(),
+                                          rate=44100, sample_format=protocol.INT16, channels=1,
+                                          payload=bytes(2 * CHUNK)))
+
+
+def test_new_take_recorded_offline_opens_before_its_live_frames(central, tmp_path, monkeypatch):
+    port, _ = central
+    monkeypatch.setattr(client, 'satellite_id', 1)
+    monkeypatch.setattr(client, 'delivered_spools', [])
+    # the old take, 100 chunks long
+    sock = connect(port)
+    sock.sendall(b''.join(audio(seq) for seq in range(100)))
+    sock.shutdown(socket.SHUT_WR)
+    sock.recv(65536)
+    sock.close()
+
+    # a new take starts while the satellite is offline, it only goes to the spool
+    ring = ringbuffer.RingBuffer(2 * CHUNK * 256)
+    streamer = client.AudioStreamer(None, ring, time.time(), frames_per_chunk=CHUNK,
+                                    spool_filename=str(tmp_path / 'take.spool'))
+    try:
+        for _ in range(20):
+            ring.write(bytes(2 * CHUNK), time.time())
+        deadline = time.time() + 3
+        while streamer.cursor.position < 20 * 2 * CHUNK and time.time() < deadline:
+            time.sleep(0.01)
+
+        # back online: the central node asks for frame 100 of the old take
+        assert not isinstance(client.connect('127.0.0.1', port), str)
+        assert client.resume_seq == 100
+        for _ in range(10):
+            ring.write(bytes(2 * CHUNK), time.time())
+            time.sleep(0.01)
+    finally:
+        streamer.stop()
+        streamer.thread.join(5)
+        client.disconnect()
+
+    deadline = time.time() + 5
+    while time.time() < deadline:
+        track = server.tracks.get(1)
+        if track is not None and track.take == 1 and track.next_seq == 30:
+            break
+        time.sleep(0.05)
+    # every chunk of the new take made it there, the live ones weren't lost to the old take
+    assert (track.take, track.next_seq) == (1, 30)
+    assert track.jitter.concealed == 0
+    assert track.jitter.late == 0
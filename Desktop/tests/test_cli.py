@@ -0,0 +1,26 @@
+''' the command line central node '''
+
+import os
+import sys
+import subprocess
+
+from conftest import connect
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'audiomerge.py')
+
+
+def test_central_reports_the_port_the_os_assigned(tmp_path):
+    central = subprocess.Popen([sys.executable, SCRIPT, 'central', '--bind', '127.0.0.1', '--duration', '10',
+                                '--output-dir', str(tmp_path), '--no-advertise', '--metrics-port', '0'],
+                               stdout=subprocess.PIPE, text=True)
+    try:
+        for line in central.stdout:
+            if line.startswith("central node listening on"):
+                break
+        port = int(line.rsplit(':', 1)[1])
+        assert port > 0
+        # the port it printed is the one it listens on
+        connect(port).close()
+    finally:
+        central.kill()
+        central.wait()
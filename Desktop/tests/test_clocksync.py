@@ -0,0 +1,120 @@
+''' clock offset and drift estimates, and the timing maps built from them, against
+    satellite clocks whose offset and drift are known '''
+
+import os
+import json
+import glob
+import time
+import random
+import socket
+
+import clocksync
+import protocol
+import server
+from conftest import connect
+
+RATE = 44100
+
+
+class SimulatedClock:
+    ''' a satellite clock: remote = local + offset + drift * (local - start) '''
+
+    def __init__(self, offset, drift, start=1000.0):
+        self.offset = offset
+        self.drift = drift
+        self.start = start
+
+    def remote(self, local):
+        return local + self.offset + self.drift * (local - self.start)
+
+    def local(self, remote):
+        return self.start + (remote - self.offset - self.start) / (1 + self.drift)
+
+
+def simulate_exchanges(clock, estimator, seconds, seed=0):
+    ''' one exchange a second over a link with random (asymmetric) queueing delays '''
+    rng = random.Random(seed)
+    for i in range(int(seconds)):
+        t0 = clock.start + i
+        up = 0.002 + rng.expovariate(1 / 0.004)
+        down = 0.002 + rng.expovariate(1 / 0.004)
+        t1 = clock.remote(t0 + up)
+        t2 = t1 + 0.0005
+        t3 = t0 + up + 0.0005 + down
+        estimator.add(t0, t1, t2, t3)
+
+
+def test_estimate_follows_offset_and_drift():
+    clock = SimulatedClock(offset=12.5, drift=40e-6)
+    estimator = clocksync.ClockEstimator()
+    simulate_exchanges(clock, estimator, 600)
+    # the live estimate only covers the last minute, it's right about the present
+    local = clock.start + 590
+    assert abs(estimator.to_local(clock.remote(local)) - local) < 0.001
+    # fitted over the whole session the drift is right too, and so is the distant past
+    session = estimator.whole_session()
+    assert abs(session.drift - 40e-6) < 1e-6
+    assert abs(session.to_local(clock.remote(clock.start)) - clock.start) < 0.001
+
+
+def test_timing_map_of_a_long_take():
+    ''' three hours at 40 ppm: the map must place sample 0 where it was captured, not
+        where the last minute's slope extrapolates it to '''
+    clock = SimulatedClock(offset=-3.25, drift=40e-6)
+    estimator = clocksync.ClockEstimator()
+    simulate_exchanges(clock, estimator, 3 * 3600)
+
+    # the sound card runs at exactly RATE on the satellite clock, from 5 s in
+    timing = clocksync.TrackTiming(RATE)
+    first = clock.remote(clock.start + 5)
+    for n in range(0, RATE * (3 * 3600 - 10), 1024):
+        timing.add(n, first + n / RATE)
+    result = timing.build(estimator)
+
+    assert abs(result['start_time'] - (clock.start + 5)) < 0.001
+    # on the central clock the card delivers RATE * (1 + drift) samples a second
+    assert abs(result['rate'] - RATE * (1 + 40e-6)) < 0.05
+
+
+def test_loopback_offset_and_timing_map(central, tmp_path, monkeypatch):
+    ''' a satellite on localhost whose clock is 1000 s ahead streams a few seconds of
+        timestamped audio; the central node's timing map must undo the offset '''
+    monkeypatch.setattr(server, 'ping_interval', 0.1)
+    port, thread = central
+    clock = SimulatedClock(offset=1000.0, drift=0.0, start=time.time())
+    sock = connect(port)
+    sock.settimeout(0.005)
+    reader = protocol.FrameReader()
+    chunk = 1024
+    started = time.time()
+    seq = 0
+    while time.time() - started < 3.0:
+        # capture paced in real time, timestamped on the satellite clock
+        while seq * chunk / RATE <= time.time() - started:
+            sock.sendall(protocol.encode(protocol.Frame(
+                protocol.AUDIO, satellite_id=1, seq=seq, timestamp=clock.remote(started) + seq * chunk / RATE,
+                rate=RATE, sample_format=protocol.INT16, channels=1, payload=bytes(2 * chunk))))
+            seq += 1
+        try:
+            data = sock.recv(65536)
+        except socket.timeout:
+            continue
+        for frame in reader.feed(data):
+            if frame.type == protocol.PING:
+                now = clock.remote(time.time())
+                sock.sendall(protocol.encode(protocol.Frame(
+                    protocol.PONG, satellite_id=1, payload=clocksync.PONG.pack(frame.timestamp, now, now))))
+    sock.sendall(protocol.encode(protocol.Frame(protocol.BYE, satellite_id=1)))
+    sock.close()
+    time.sleep(0.2)
+    server.stop()
+    thread.join(10)
+
+    timing_files = glob.glob(os.path.join(str(tmp_path), 'audiomerge_session*', 'satellite1_take0', 'timing.json'))
+    assert len(timing_files) == 1
+    with open(timing_files[0]) as f:
+        timing = json.load(f)
+    assert timing['clock']['exchanges'] >= 10
+    assert abs(timing['clock']['offset'] - 1000.0) < 0.005
+    assert abs(timing['start_time'] - started) < 0.005
+    assert abs(timing['rate'] - RATE) < RATE * 0.001
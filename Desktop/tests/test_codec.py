@@ -0,0 +1,49 @@
+''' the lossless frame codec: exact round trips, and garbage rejected as a protocol error '''
+
+import numpy as np
+import pytest
+
+import codec
+import protocol
+
+
+def signals():
+    rng = np.random.default_rng(0)
+    t = np.arange(1024) / 44100
+    yield np.zeros(1024, dtype='<i2')
+    yield (np.sin(2 * np.pi * 440 * t) * 12000).astype('<i2')
+    yield rng.integers(-32768, 32768, 1024).astype('<i2')
+    yield np.full(1024, -32768, dtype='<i2')
+
+
+@pytest.mark.parametrize('samples', list(signals()))
+def test_round_trip(samples):
+    assert codec.decode(codec.encode(samples.tobytes())) == samples.tobytes()
+
+
+@pytest.mark.parametrize('samples', list(signals()))
+def test_truncated_or_corrupted_payloads_raise_protocol_errors(samples):
+    coded = codec.encode(samples.tobytes())
+    rng = np.random.default_rng(1)
+    candidates = [coded[:cut] for cut in range(len(coded))]
+    for _ in range(200):
+        corrupted = bytearray(coded)
+        corrupted[rng.integers(len(corrupted))] = rng.integers(256)
+        candidates.append(bytes(corrupted))
+    for data in candidates:
+        try:
+            codec.decode(data)
+        except protocol.ProtocolError:
+            pass
+
+
+def test_sample_count_beyond_the_chunk_is_rejected_before_decoding():
+    samples = np.zeros(1024, dtype='<i2').tobytes()
+    assert codec.decode(codec.encode(samples), max_samples=1024) == samples
+    with pytest.raises(protocol.ProtocolError):
+        codec.decode(codec.encode(samples), max_samples=512)
+    # a header claiming millions of samples, and a unary stream far longer than any encode() output
+    with pytest.raises(protocol.ProtocolError):
+        codec.decode(codec.HEADER.pack(0, 0, 4_000_000, 0), max_samples=16384)
+    with pytest.raises(protocol.ProtocolError):
+        codec.decode(codec.HEADER.pack(0, 0, 16, 1 << 20) + bytes(1 << 20))
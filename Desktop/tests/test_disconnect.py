@@ -0,0 +1,45 @@
+''' a satellite stopping normally: its spools go once the central node has acknowledged BYE '''
+
+import socket
+import threading
+
+import client
+import protocol
+
+
+def test_acknowledged_bye_removes_delivered_spools(central, tmp_path, monkeypatch):
+    port, _ = central
+    spool_file = tmp_path / 'take.spool'
+    spool_file.write_bytes(bytes(16))
+    monkeypatch.setattr(client, 'delivered_spools', [str(spool_file)])
+    assert not isinstance(client.connect('127.0.0.1', port), str)
+    assert client.disconnect()
+    assert not spool_file.exists()
+
+
+def test_unacknowledged_bye_keeps_delivered_spools(tmp_path, monkeypatch):
+    # a central node that welcomes the satellite and then never closes its side
+    listener = socket.create_server(('127.0.0.1', 0))
+    accepted = []
+
+    def welcome():
+        sock, _ = listener.accept()
+        accepted.append(sock)
+        sock.recv(65536)
+        sock.sendall(protocol.encode(protocol.Frame(protocol.WELCOME, satellite_id=client.satellite_id)))
+    thread = threading.Thread(target=welcome, daemon=True)
+    thread.start()
+
+    spool_file = tmp_path / 'take.spool'
+    spool_file.write_bytes(bytes(16))
+    monkeypatch.setattr(client, 'delivered_spools', [str(spool_file)])
+    monkeypatch.setattr(client, 'link_timeout', 0.5)
+    try:
+        assert not isinstance(client.connect('127.0.0.1', listener.getsockname()[1]), str)
+        assert not client.disconnect()
+        assert spool_file.exists()
+    finally:
+        thread.join(5)
+        for sock in accepted:
+            sock.close()
+        listener.close()
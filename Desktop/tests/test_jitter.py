@@ -0,0 +1,77 @@
+''' the jitter buffer puts frames back in order and conceals what never arrives '''
+
+import time
+
+import jitter
+import protocol
+import server
+from conftest import connect
+
+
+def frame(seq, payload=bytes(2048)):
+    return protocol.Frame(protocol.AUDIO, seq=seq, timestamp=seq * 0.02, payload=payload)
+
+
+def audio_fields(seq):
+    return dict(satellite_id=1, seq=seq, timestamp=time.time(), rate=44100,
+                sample_format=protocol.INT16, channels=1, payload=bytes(2048))
+
+
+def audio(seq):
+    return protocol.encode(protocol.Frame(protocol.AUDIO, **audio_fields(seq)))
+
+
+def test_short_gap_is_concealed():
+    buffer = jitter.JitterBuffer(2048)
+    assert buffer.push(frame(0), 0.0)
+    assert buffer.push(frame(3), 0.0)
+    released = buffer.pop(1.0, flush=True)
+    assert [seq for seq, payload, timestamp in released] == [0, 1, 2, 3]
+    assert buffer.gaps == [(1, 2)]
+
+
+def test_seq_further_along_than_the_session_is_dropped_not_concealed():
+    buffer = jitter.JitterBuffer(2048, frame_rate=10, max_lead=100)
+    assert buffer.push(frame(0), 0.0)
+    assert not buffer.push(frame(2 ** 31), 0.0)
+    assert not buffer.hold(frame(5000), 1.0)
+    assert buffer.state()['out_of_range'] == 2
+    assert len(buffer.pop(1.0, flush=True)) == 1
+    # the stream goes on where it was
+    assert buffer.push(frame(1), 1.0)
+    assert [seq for seq, payload, timestamp in buffer.pop(2.0, flush=True)] == [1]
+
+
+def test_outage_longer_than_the_lead_is_concealed():
+    buffer = jitter.JitterBuffer(2048, frame_rate=10, max_lead=100)
+    assert buffer.push(frame(0), 0.0)
+    # a minute offline, the satellite comes back 600 frames on
+    assert buffer.push(frame(600), 60.0)
+    assert buffer.hold(frame(1), 60.0)
+    released = buffer.pop(61.0, flush=True)
+    assert [seq for seq, payload, timestamp in released] == list(range(601))
+    assert buffer.gaps == [(2, 598)]
+
+
+def test_satellite_reconnecting_after_a_long_outage_keeps_its_live_frames(central, monkeypatch):
+    port, _ = central
+    # a lead of two frames, a second offline is more than that
+    monkeypatch.setattr(server, 'jitter_max_lead', 2 * 1024 / 44100)
+    sock = connect(port)
+    sock.sendall(audio(0))
+    sock.close()
+    time.sleep(1.0)
+    sock = connect(port)
+    # the live stream goes on 40 frames later, its backlog fills in what's between
+    sock.sendall(audio(40) + b''.join(protocol.encode(protocol.Frame(protocol.BACKLOG, **audio_fields(seq)))
+                                      for seq in range(1, 40)))
+    deadline = time.time() + 5
+    while time.time() < deadline:
+        track = server.tracks.get(1)
+        if track is not None and track.next_seq == 41:
+            break
+        time.sleep(0.05)
+    assert track.next_seq == 41
+    assert track.jitter.out_of_range == 0
+    sock.close()
+
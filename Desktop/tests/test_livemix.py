@@ -0,0 +1,48 @@
+''' the live mix places every satellite on one timeline, whatever order they register in '''
+
+import wave
+
+import numpy as np
+
+import livemix
+
+
+def mixed(filename):
+    with wave.open(filename) as wf:
+        return np.frombuffer(wf.readframes(wf.getnframes()), dtype='<i2').astype(np.int32)
+
+
+def test_source_registering_late_but_starting_early_leads_the_timeline(tmp_path):
+    filename = str(tmp_path / 'live.wav')
+    mixer = livemix.LiveMixer(filename, rate=1000, block_size=100)
+    mixer.add_source('a', 100.0)
+    # started half a second before "a", its PONG only came in later
+    mixer.add_source('b', 99.5)
+    mixer.feed('a', np.full(1000, 1000, dtype='<i2').tobytes())
+    mixer.feed('b', np.full(1000, 2000, dtype='<i2').tobytes())
+    mixer.close()
+
+    samples = mixed(filename)
+    assert len(samples) == 1500
+    # "b" alone, both, then "a" alone (dither moves samples by one at most)
+    assert np.abs(samples[:500] - 2000).max() <= 1
+    assert np.abs(samples[500:1000] - 3000).max() <= 1
+    assert np.abs(samples[1000:] - 1000).max() <= 1
+
+
+def test_source_joining_later_starts_where_its_first_sample_lands(tmp_path):
+    filename = str(tmp_path / 'live.wav')
+    mixer = livemix.LiveMixer(filename, rate=1000, block_size=100, latency=0.5)
+    mixer.add_source('a', 100.0)
+    mixer.feed('a', np.full(2000, 1000, dtype='<i2').tobytes())
+    # "b" joins 1.25 s into the session
+    mixer.add_source('b', 101.25)
+    mixer.feed('b', np.full(500, 2000, dtype='<i2').tobytes())
+    mixer.end_source('b')
+    mixer.close()
+
+    samples = mixed(filename)
+    assert len(samples) == 2000
+    assert np.abs(samples[:1250] - 1000).max() <= 1
+    assert np.abs(samples[1250:1750] - 3000).max() <= 1
+    assert np.abs(samples[1750:] - 1000).max() <= 1
@@ -0,0 +1,41 @@
+''' many satellites streaming to one central node on localhost at once, driven by the
+    benchmark harness: every satellite drains and every track comes out complete '''
+
+import os
+import glob
+import json
+import wave
+
+import benchmark
+
+SATELLITES = 8
+
+
+def test_many_satellites_complete_without_drops(tmp_path):
+    results_file = str(tmp_path / 'results.json')
+    status = benchmark.main(['--satellites', str(SATELLITES), '--duration', '3', '--speed', '4',
+                             '--output', results_file, '--output-dir', str(tmp_path)])
+    with open(results_file) as f:
+        results = json.load(f)
+    assert status == 0
+
+    frames = results['frames']
+    assert frames['captured'] > 0
+    assert frames['dropped'] == 0
+    assert frames['late'] == 0
+    assert frames['concealed'] == 0
+    assert frames['capture_overruns'] == 0
+
+    satellites = results['satellites']
+    assert sorted(report['id'] for report in satellites) == list(range(1, SATELLITES + 1))
+    for report in satellites:
+        assert 'error' not in report
+        assert report['drained']
+        assert report['frames_sent'] + report['backlog_sent'] == report['frames_captured']
+        # the central node's track holds every sample the satellite captured
+        tracks = glob.glob(os.path.join(str(tmp_path), f"audiomerge_session*_satellite{report['id']}_take*.wav"))
+        assert len(tracks) == 1
+        with wave.open(tracks[0]) as track:
+            assert track.getnframes() == report['frames_captured'] * benchmark.FRAMES_PER_BUFFER
+
+    assert results['merge']['tracks'] == SATELLITES
@@ -0,0 +1,112 @@
+''' a satellite sending garbage loses its own connection, the central node goes on (and
+    garbage from the central node ends only the satellite's connection) '''
+
+import time
+import socket
+import threading
+
+import pytest
+
+import client
+import codec
+import protocol
+from conftest import connect, closed_by_peer
+
+
+def audio(payload, **fields):
+    header = dict(satellite_id=1, rate=44100, sample_format=protocol.INT16, channels=1)
+    header.update(fields)
+    return protocol.encode(protocol.Frame(protocol.AUDIO, payload=payload, **header))
+
+
+def silence(payload, **fields):
+    header = dict(satellite_id=1, rate=44100, sample_format=protocol.INT16, channels=1)
+    header.update(fields)
+    return protocol.encode(protocol.Frame(protocol.SILENCE, payload=payload, **header))
+
+
+BAD_FRAMES = {
+    'unknown sample format': audio(bytes(2048), sample_format=0),
+    'no channels': audio(bytes(2048), channels=0),
+    'no sample rate': audio(bytes(2048), rate=0),
+    'partial sample': audio(bytes(2047)),
+    'empty payload': audio(b''),
+    'RICE payload shorter than its header': audio(bytes(3), flags=codec.RICE),
+    'truncated RICE payload': audio(codec.encode(bytes(range(256)) * 8)[:40], flags=codec.RICE),
+    'short SILENCE run': silence(bytes(3)),
+    'SILENCE run of no chunks': silence(protocol.SILENCE_RUN.pack(0, 1024)),
+    'SILENCE run of empty chunks': silence(protocol.SILENCE_RUN.pack(4, 0)),
+    'endless SILENCE run': silence(protocol.SILENCE_RUN.pack(2 ** 32 - 1, 1024)),
+    'short PONG': protocol.encode(protocol.Frame(protocol.PONG, satellite_id=1, payload=bytes(4))),
+}
+
+
+@pytest.mark.parametrize('name', sorted(BAD_FRAMES))
+def test_bad_frame_closes_only_its_connection(central, name):
+    port, thread = central
+    bystander = connect(port, satellite_id=2)
+    sock = connect(port, satellite_id=1)
+    sock.sendall(BAD_FRAMES[name])
+    assert closed_by_peer(sock)
+    assert thread.is_alive()
+    # the other satellite is still served, and new ones are let in
+    bystander.sendall(audio(bytes(2048), satellite_id=2))
+    connect(port, satellite_id=3).close()
+    bystander.close()
+
+
+def test_payload_bigger_than_the_tracks_chunks(central):
+    port, thread = central
+    sock = connect(port)
+    sock.sendall(audio(bytes(2048)))
+    sock.sendall(audio(bytes(4096), seq=1))
+    assert closed_by_peer(sock)
+    assert thread.is_alive()
+
+
+@pytest.mark.parametrize('run', [
+    silence(protocol.SILENCE_RUN.pack(2, 512), seq=1),
+    silence(protocol.SILENCE_RUN.pack(2, 1024), seq=1, channels=2),
+    silence(protocol.SILENCE_RUN.pack(2, 1024), seq=1, rate=48000),
+], ids=['other chunk length', 'other channel count', 'other sample rate'])
+def test_silence_run_that_doesnt_fit_the_track(central, run):
+    port, thread = central
+    sock = connect(port)
+    sock.sendall(audio(bytes(2048)))
+    sock.sendall(run)
+    assert closed_by_peer(sock)
+    assert thread.is_alive()
+
+
+def test_bad_flow_report_loses_the_satellites_connection(monkeypatch):
+    ''' the other direction: a garbled FLOW from the central node ends the satellite's
+        connection the way any broken link does, instead of killing its receiver '''
+    listener = socket.create_server(('127.0.0.1', 0))
+    accepted = []
+
+    def central():
+        sock, _ = listener.accept()
+        accepted.append(sock)
+        sock.recv(65536)
+        sock.sendall(protocol.encode(protocol.Frame(protocol.WELCOME, satellite_id=client.satellite_id)))
+        # after connect() has read the WELCOME, the receiver thread gets the FLOW
+        time.sleep(0.2)
+        sock.sendall(protocol.encode(protocol.Frame(protocol.FLOW, payload=bytes(3))))
+    thread = threading.Thread(target=central, daemon=True)
+    thread.start()
+    lost = []
+    monkeypatch.setattr(client, 'connection_lost', lambda sock, retry=True: lost.append(sock))
+    try:
+        sock = client.connect('127.0.0.1', listener.getsockname()[1])
+        assert not isinstance(sock, str)
+        deadline = time.time() + 3
+        while not lost and time.time() < deadline:
+            time.sleep(0.02)
+        assert lost == [sock]
+        sock.close()
+    finally:
+        thread.join(5)
+        for sock in accepted:
+            sock.close()
+        listener.close()
+        client.connection = client.server_address = None
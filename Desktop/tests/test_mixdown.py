@@ -0,0 +1,52 @@
+''' merging memory mapped WAV files block by block gives the sum of the tracks '''
+
+import wave
+
+import numpy as np
+
+import merge
+
+RATE = 8000
+
+
+def write(filename, samples):
+    with wave.open(filename, 'wb') as wf:
+        wf.setnchannels(1)
+        wf.setsampwidth(2)
+        wf.setframerate(RATE)
+        wf.writeframes(samples.astype('<i2').tobytes())
+
+
+def read(filename):
+    with wave.open(filename) as wf:
+        return np.frombuffer(wf.readframes(wf.getnframes()), dtype='<i2').astype(np.int32)
+
+
+def test_memmapped_mixdown_equals_the_in_memory_sum(tmp_path):
+    rng = np.random.default_rng(0)
+    # quiet enough that the soft limiter leaves the sum alone, of different lengths
+    a = rng.integers(-8000, 8000, 25000)
+    b = rng.integers(-8000, 8000, 18000)
+    write(str(tmp_path / 'a.wav'), a)
+    write(str(tmp_path / 'b.wav'), b)
+
+    output = str(tmp_path / 'merged.wav')
+    frames = merge.merge_files([str(tmp_path / 'a.wav'), str(tmp_path / 'b.wav')], output,
+                               rate=RATE, block_size=4096)
+    expected = a.copy()
+    expected[:len(b)] += b
+    assert frames == len(a)
+    # blocks don't line up with anything, the dither moves a sample by one at most
+    assert np.abs(read(output) - expected).max() <= 1
+
+
+def test_multichannel_mixdown_keeps_every_track_on_its_own_channel():
+    a = np.arange(-5000, 5000, 2, dtype='<i2')
+    b = np.full(3000, 1234, dtype='<i2')
+    tracks = [merge.Track(a), merge.Track(b, offset=1000)]
+    out = np.concatenate(list(merge.mixdown(tracks, multichannel=True, block_size=1024))).astype(np.int32)
+    assert out.shape == (len(a), 2)
+    assert np.abs(out[:, 0] - a).max() <= 1
+    expected = np.zeros(len(a), dtype=np.int32)
+    expected[1000:4000] = 1234
+    assert np.abs(out[:, 1] - expected).max() <= 1
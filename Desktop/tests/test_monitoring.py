@@ -0,0 +1,47 @@
+''' the GUI and metrics threads read the satellites' state while the event loop adds
+    and replaces tracks and clocks '''
+
+import threading
+
+import clocksync
+import protocol
+import server
+from conftest import connect
+from test_malformed_frames import audio
+
+
+def test_readers_on_other_threads_see_consistent_snapshots(central):
+    port, thread = central
+    errors = []
+    done = threading.Event()
+
+    def read_state():
+        while not done.is_set():
+            try:
+                server.client_list()
+                server.collect_metrics()
+            except Exception as err:
+                errors.append(err)
+
+    reader = threading.Thread(target=read_state)
+    reader.start()
+    try:
+        for satellite_id in range(1, 21):
+            sock = connect(port, satellite_id=satellite_id)
+            sock.sendall(protocol.encode(protocol.Frame(protocol.PONG, satellite_id=satellite_id,
+                                                        payload=clocksync.PONG.pack(0.0, 0.0, 0.0))))
+            # a second take replaces the satellite's track
+            for take in range(2):
+                for seq in range(4):
+                    sock.sendall(audio(bytes(2048), satellite_id=satellite_id, seq=seq))
+            sock.close()
+        # wait for the loop to have handled everything sent
+        connect(port, satellite_id=99).close()
+        assert thread.is_alive()
+        # the end of the session closes and forgets every track while they're read
+        server.stop()
+        thread.join(10)
+    finally:
+        done.set()
+        reader.join()
+    assert not errors
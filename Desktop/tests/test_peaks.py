@@ -0,0 +1,51 @@
+''' the waveform peak pyramid agrees with the samples it summarizes '''
+
+import os
+
+import numpy as np
+
+import peaks
+import session
+
+
+def test_every_level_matches_a_direct_min_max(tmp_path):
+    rng = np.random.default_rng(0)
+    samples = rng.integers(-32768, 32768, 300000).astype('<i2')
+    builder = peaks.PeakBuilder(8000, base=256, factor=4)
+    # fed in chunks the way a recording arrives
+    for start in range(0, len(samples), 1024):
+        builder.add(samples[start:start + 1024])
+    filename = str(tmp_path / 'track.peaks')
+    builder.save(filename)
+
+    reader = peaks.PeakReader(filename)
+    assert reader.length == len(samples)
+    for level, entries in enumerate(reader.levels):
+        size = reader.samples_per_entry(level)
+        assert len(entries) == -(-len(samples) // size)
+        groups = np.arange(0, len(samples), size)
+        assert np.array_equal(entries['min'], np.minimum.reduceat(samples, groups))
+        assert np.array_equal(entries['max'], np.maximum.reduceat(samples, groups))
+    assert len(reader.levels[-1]) == 1
+
+    # a query over the whole track, one column per level 1 entry
+    columns = len(reader.levels[1])
+    lows, highs, rms = reader.query(0, columns * 1024, columns)
+    groups = np.arange(0, len(samples), 1024)
+    assert np.allclose(lows, np.minimum.reduceat(samples, groups) / 32768.0)
+    assert np.allclose(highs, np.maximum.reduceat(samples, groups) / 32768.0)
+
+
+def test_review_sources_of_a_session(tmp_path):
+    directory = tmp_path / 'audiomerge_session00000001'
+    for name in ('satellite2_take0', 'satellite1_take0'):
+        session.TrackWriter(str(directory / name), 8000).close()
+    (tmp_path / 'audiomerge_session00000001_live.wav').write_bytes(b'')
+
+    sources = peaks.review_sources(str(directory))
+    assert sources == [str(tmp_path / 'audiomerge_session00000001_live.wav'),
+                       str(directory / 'satellite1_take0'), str(directory / 'satellite2_take0')]
+    assert peaks.review_sources(str(directory / 'satellite1_take0')) == [str(directory / 'satellite1_take0')]
+    assert peaks.review_sources('take.wav') == ['take.wav']
+    assert peaks.peaks_filename(str(directory / 'satellite1_take0')) == \
+        os.path.join(str(directory / 'satellite1_take0'), 'peaks.bin')
@@ -0,0 +1,56 @@
+''' the best microphone merge mode '''
+
+import json
+
+import numpy as np
+
+import merge
+
+RATE = 44100
+
+
+def takes(seconds=6.0, seed=0):
+    ''' the same speech-like bursts (starting right away) on a noisy and a clean mic '''
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * RATE)) / RATE
+    voice = np.sin(2 * np.pi * 220 * t) * 6000 * ((t % 1.5) < 1.0)
+    noisy = voice + rng.normal(0, 1500, len(t))
+    clean = voice + rng.normal(0, 30, len(t))
+    return [merge.Track(noisy.astype('<i2'), name='noisy'), merge.Track(clean.astype('<i2'), name='clean')]
+
+
+def test_clean_mic_wins_from_the_first_segment():
+    decisions = []
+    blocks = list(merge.select_mixdown(takes(), RATE, decisions=decisions))
+    assert sum(len(block) for block in blocks) == int(6.0 * RATE)
+    # the take is loud from its first segment, its floor still comes from the quiet parts
+    assert decisions[0]['winner'] == 'clean'
+    assert decisions[0]['scores'][1] > 20
+    winners = [decision['winner'] for decision in decisions]
+    assert winners.count('clean') == len(winners)
+
+
+def test_start_skips_the_output_before_it():
+    tracks = takes()
+    whole = np.concatenate(list(merge.select_mixdown(tracks, RATE, block_size=1 << 15)))
+    start = 1 << 16
+    tail = np.concatenate(list(merge.select_mixdown(tracks, RATE, block_size=1 << 15, start=start)))
+    assert len(tail) == len(whole) - start
+    # the same mic plays, only the dither differs
+    assert np.abs(tail.astype(np.int32) - whole[start:]).max() <= 2
+
+
+def test_decision_log_is_written_as_the_merge_goes(tmp_path):
+    filenames = []
+    for track in takes(seconds=3.0):
+        filename = str(tmp_path / f'{track.name}.wav')
+        merge.write_wav(filename, [track.samples], RATE)
+        filenames.append(filename)
+    output = str(tmp_path / 'best.wav')
+    merge.merge_files(filenames, output, rate=RATE, select=True)
+
+    with open(str(tmp_path / 'best.decisions.json')) as f:
+        log = json.load(f)
+    assert log['tracks'] == filenames
+    assert len(log['segments']) == -(-int(3.0 * RATE) // 8192)
+    assert all(decision['winner'] == filenames[1] for decision in log['segments'])
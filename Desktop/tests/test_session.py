@@ -0,0 +1,39 @@
+''' a central node that crashed mid-session: "recover" brings back the chunks written
+    after the last index sync '''
+
+import os
+
+import numpy as np
+
+import audiomerge
+import merge
+import session
+
+
+def crashed_track(directory, chunks=5):
+    ''' a track whose writer died without closing, after "chunks" full chunks and a partial one '''
+    writer = session.TrackWriter(str(directory), 8000, chunk_seconds=0.1, sync_every=3)
+    samples = np.arange(chunks * writer.chunk_samples + 100, dtype='<i2')
+    writer.write(samples.tobytes())
+    return samples
+
+
+def test_recover_indexes_chunks_written_after_the_last_sync(tmp_path):
+    directory = tmp_path / 'audiomerge_session00000001' / 'satellite1_take0'
+    samples = crashed_track(directory)
+    assert len(session.TrackReader(str(directory))) < len(samples)
+
+    assert audiomerge.main(['recover', str(tmp_path / 'audiomerge_session00000001')]) == 0
+    reader = session.TrackReader(str(directory))
+    assert np.array_equal(reader[0:len(reader)], samples)
+    assert os.path.exists(os.path.join(str(directory), 'peaks.bin'))
+
+    # a second pass has nothing left to do
+    assert session.recover(str(directory)) == {str(directory): 0}
+
+
+def test_merge_recovers_session_tracks(tmp_path):
+    directory = tmp_path / 'satellite1_take0'
+    samples = crashed_track(directory)
+    frames = merge.merge_files([str(directory)], str(tmp_path / 'merged.wav'), rate=8000)
+    assert frames == len(samples)
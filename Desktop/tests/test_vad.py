@@ -0,0 +1,37 @@
+''' the voice detector at any capture buffer size '''
+
+import numpy as np
+import pytest
+
+import vad
+
+RATE = 44100
+
+
+def take(seconds_silent, seconds_loud, seed=0):
+    ''' low noise, then a tone in bursts over it '''
+    rng = np.random.default_rng(seed)
+    n_silent, n_loud = int(seconds_silent * RATE), int(seconds_loud * RATE)
+    t = np.arange(n_loud) / RATE
+    loud = np.sin(2 * np.pi * 220 * t) * 8000
+    pcm = np.concatenate((np.zeros(n_silent), loud)) + rng.normal(0, 30, n_silent + n_loud)
+    return pcm.astype('<i2')
+
+
+@pytest.mark.parametrize('chunk_samples', [1024, 1000, 441, 100, 4096, 300])
+def test_any_chunk_size(chunk_samples):
+    detector = vad.VoiceDetector(RATE, chunk_samples)
+    pcm = take(2.0, 1.0)
+    chunks = len(pcm) // chunk_samples
+    active = np.concatenate([detector.detect(pcm[i:i + 8 * chunk_samples].tobytes())
+                             for i in range(0, chunks * chunk_samples, 8 * chunk_samples)])
+    assert len(active) == chunks
+    silent_part = int(2.0 * RATE) // chunk_samples
+    # the noise at the start is gated (after the floor settles), the tone isn't
+    assert not active[silent_part // 2:silent_part - 1].any()
+    assert active[silent_part + 1:].all()
+
+
+def test_only_whole_chunks_are_classified():
+    detector = vad.VoiceDetector(RATE, 1000)
+    assert len(detector.detect(take(0.0, 0.1)[:2500].tobytes())) == 2
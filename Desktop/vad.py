@@ -0,0 +1,101 @@
+''' Voice activity detection on the satellites.
+
+    every chunk of captured audio is split into short analysis frames, and two features
+    are computed for all of them at once with NumPy: the frame energy (in dB full scale)
+    and its zero crossing rate. a frame is speech when its energy stands well above the
+    tracked noise floor, or a little above it with a high zero crossing rate (unvoiced
+    sounds like "s" and "f" are quiet but noisy). a chunk with any speech frame is
+    active, and a hangover keeps the gate open for a while after the last one so word
+    endings and short pauses aren't cut.
+
+    inactive chunks are sent as SILENCE runs instead of PCM (see protocol.py), the
+    central node keeps the timeline sample accurate and doesn't store them '''
+
+import time
+import numpy as np
+
+
+class VoiceDetector:
+    ''' decides chunk by chunk whether a stream carries speech '''
+
+    def __init__(self, rate=44100, chunk_samples=1024, frame_samples=256, margin_db=12.0,
+                 fricative_margin_db=5.0, fricative_zcr=0.2, min_db=-60.0, floor_rise_db=3.0,
+                 hangover=0.4):
+        self.rate = rate
+        self.chunk_samples = chunk_samples
+        # analysis frames split every chunk evenly, about frame_samples long whatever
+        # buffer size the capture uses (the few samples left over aren't analysed)
+        self.frames_per_chunk = max(chunk_samples // frame_samples, 1)
+        self.frame_samples = chunk_samples // self.frames_per_chunk
+        self.margin_db = margin_db
+        self.fricative_margin_db = fricative_margin_db
+        self.fricative_zcr = fricative_zcr
+        # anything quieter than this is silence whatever the floor is
+        self.min_db = min_db
+        # the noise floor follows the quietest frames down at once and creeps up this many dB
+        # per second, so it adapts to a louder room without rising into speech
+        self.floor_rise_db = floor_rise_db
+        self.hangover_chunks = int(hangover * rate / chunk_samples)
+
+        self.floor = None
+        self.hold = 0
+
+        self.active_chunks = 0
+        self.silent_chunks = 0
+        self.cpu_seconds = 0.0
+
+    def detect(self, pcm):
+        ''' classifies whole chunks of int16 PCM (bytes or a buffer), returns one bool per chunk '''
+        start = time.thread_time()
+        samples = np.frombuffer(pcm, dtype='<i2')
+        chunks = len(samples) // self.chunk_samples
+        frames = samples[:chunks * self.chunk_samples].reshape(chunks, self.chunk_samples)
+        frames = frames[:, :self.frames_per_chunk * self.frame_samples].reshape(
+            chunks, self.frames_per_chunk, self.frame_samples)
+
+        x = frames.astype(np.float32)
+        energy = np.einsum('cfs,cfs->cf', x, x) / (self.frame_samples * 32768.0 * 32768.0)
+        level = 10 * np.log10(energy + 1e-12)
+        signs = np.signbit(frames)
+        zcr = np.count_nonzero(signs[:, :, 1:] != signs[:, :, :-1], axis=2) / (self.frame_samples - 1)
+
+        quietest = float(level.min()) if level.size else 0.0
+        seconds = chunks * self.chunk_samples / self.rate
+        if self.floor is None:
+            self.floor = quietest
+        else:
+            self.floor = min(quietest, self.floor + self.floor_rise_db * seconds)
+
+        loud = level > self.floor + self.margin_db
+        fricative = (level > self.floor + self.fricative_margin_db) & (zcr > self.fricative_zcr)
+        active = ((loud | fricative) & (level > self.min_db)).any(axis=1)
+
+        # hangover, a handful of chunks per call so a plain loop is cheapest
+        for i in range(chunks):
+            if active[i]:
+                self.hold = self.hangover_chunks
+            elif self.hold:
+                self.hold -= 1
+                active[i] = True
+
+        count = int(active.sum())
+        self.active_chunks += count
+        self.silent_chunks += chunks - count
+        self.cpu_seconds += time.thread_time() - start
+        return active
+
+    @property
+    def cpu_per_audio_second(self):
+        ''' cpu seconds spent per second of audio, 0.01 means 1 % of a core per stream '''
+        audio_seconds = (self.active_chunks + self.silent_chunks) * self.chunk_samples / self.rate
+        return self.cpu_seconds / audio_seconds if audio_seconds else 0.0
+
+    def state(self):
+        chunks = self.active_chunks + self.silent_chunks
+        return {
+            'active_chunks': self.active_chunks,
+            'silent_chunks': self.silent_chunks,
+            'silent_fraction': self.silent_chunks / chunks if chunks else 0.0,
+            'noise_floor_db': self.floor,
+            'cpu_per_audio_second': self.cpu_per_audio_second,
+        }